@@ -0,0 +1,7 @@
+# usage: ./deploy.sh <name of the cleanup lambda function>
+# clients.py, constants.py, metrics.py, cold_start.py, s3_utils.py, capacity.py and pool_reconciler.py are shared with
+# the scheduler and packaged from lambdascript
+python ../lambdascript/profile_cold_start.py lambda_function.py
+zip lambda.zip lambda_function.py
+zip -j lambda.zip ../lambdascript/clients.py ../lambdascript/constants.py ../lambdascript/metrics.py ../lambdascript/cold_start.py ../lambdascript/s3_utils.py ../lambdascript/capacity.py ../lambdascript/pool_reconciler.py
+aws lambda update-function-code --function-name "${1:?name of the cleanup lambda function required}" --zip-file fileb://lambda.zip
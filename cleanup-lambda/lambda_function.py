@@ -1,29 +1,144 @@
-from datetime import datetime
-from dateutil.tz import tzlocal
+import json
+import time
 
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+# imported first, so that cold-start profiling sees the imports below
+import cold_start
+import metrics
+
+from clients import get_client_provider
+from pool_reconciler import get_in_progress_ticket_names
+from s3_utils import BatchDeleter, iter_objects
 
 CLEANUP_THRESHOLD_IN_SECONDS = 86400  # 24 hours
+# Thresholds of the statuses that go stale sooner or later than CLEANUP_THRESHOLD_IN_SECONDS: an entry left in
+# preparing by a Job Executor that never started holds capacity no job uses. Entries are not promoted out of preparing
+# while their build runs, so stale entries of builds still in progress are kept whatever their status
+CLEANUP_THRESHOLDS_BY_STATUS = {
+    "preparing": 7200,  # 2 hours
+    "running": 86400,  # 24 hours
+}
 BUCKET_NAME = "dlc-test-tickets"
 FOLDER_NAME = "resource_pool/"
+# Last key scanned by an invocation that ran out of time, the next one resumes the pass after it
+CURSOR_KEY = "scheduler_state/cleanup_cursor.json"
+METRICS_NAMESPACE = "DLCTestScheduler"
+# Number of delete_objects requests of up to 1000 keys sent concurrently
+DELETE_CONCURRENCY = 4
+# Time kept in reserve at the end of an invocation to finish the deletes in flight and save the cursor
+DEADLINE_SAFETY_MARGIN_SECONDS = 30
 
 
 def lambda_handler(event, context):
-    s3_client = boto3.client("s3")
-    list_objects_response = s3_client.list_objects(Bucket=BUCKET_NAME, Prefix=FOLDER_NAME)
-
-    # Scan for outdated resource pool entries
-    deletion_list = []
-    for file in list_objects_response["Contents"]:
-        if file["Key"].endswith(".json"):
-            last_modified_time = file["LastModified"]
-            total_seconds_passed = (datetime.now(tzlocal()) - last_modified_time).total_seconds()
-            if total_seconds_passed >= CLEANUP_THRESHOLD_IN_SECONDS:
-                    deletion_list.append({"Key": file["Key"]})
-
-    # Delete outdated resource pool entries
-    if len(deletion_list) != 0:
-        deletion_response = s3_client.delete_objects(Bucket=BUCKET_NAME, Delete={"Objects": deletion_list, "Quiet":False})
-        print(deletion_response)
-
-    print(f"Deleted {str(len(deletion_list))} resource pool tickets.")
\ No newline at end of file
+    recorder = metrics.start_invocation(METRICS_NAMESPACE, "cleanup")
+    if cold_start.invocation_started():
+        recorder.increment("ColdStart")
+    deadline_time = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_SAFETY_MARGIN_SECONDS
+    try:
+        provider = get_client_provider()
+        clean_resource_pool(provider.client("s3"), provider.client("codebuild"), deadline_time, recorder)
+    finally:
+        recorder.emit()
+        cold_start.report()
+
+
+def get_cleanup_threshold(key):
+    """
+    Naming convention of resource pool entries: resource_pool/(instance type)-(job type)/(request ticket name)#(num of
+    instances)-(status).json
+
+    :param key: <string> key of the resource pool entry
+    :return: <int> age in seconds after which the entry is stale, or None if the key is not a resource pool entry
+    """
+    if not key.endswith(".json"):
+        return None
+    status = key[: -len(".json")].rpartition("-")[2]
+    return CLEANUP_THRESHOLDS_BY_STATUS.get(status, CLEANUP_THRESHOLD_IN_SECONDS)
+
+
+def load_cursor(s3_client):
+    """
+    :param s3_client: boto3 S3 client
+    :return: <string> last key scanned by the previous invocation, None if it went through the whole resource pool
+    """
+    try:
+        cursor_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=CURSOR_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return None
+    return json.loads(cursor_object["Body"].read().decode("utf-8"))["START_AFTER"]
+
+
+def get_ticket_name_of_entry(key):
+    """
+    :param key: <string> key of the resource pool entry
+    :return: <string> name of the request ticket the entry was booked for
+    """
+    return key.split("/")[-1].rpartition("#")[0]
+
+
+def clean_resource_pool(s3_client, cb_client, deadline_time, recorder):
+    """
+    Delete the resource pool entries that were not updated within the cleanup threshold of their status, unless the
+    Job Executor build of their ticket is still in progress.
+    The pool is streamed page by page and stale entries are deleted in batches of 1000 keys, several batches at a
+    time. An invocation reaching its deadline saves the last key it scanned, and the next one carries on from there.
+
+    :param s3_client: boto3 S3 client
+    :param cb_client: boto3 CodeBuild client, only called once some entry is stale
+    :param deadline_time: <float> time.monotonic() after which no more entries are scanned
+    :param recorder: <MetricsRecorder> metrics of the current invocation
+    """
+    start_after = load_cursor(s3_client)
+    if start_after:
+        print(f"Resuming the cleanup after {start_after}")
+    now = datetime.now(timezone.utc)
+    last_key = None
+    scanned = 0
+    kept = 0
+    finished = False
+    # names of the tickets whose build is in progress, listed when the first stale entry is found
+    in_progress_ticket_names = None
+
+    listing = iter_objects(s3_client, BUCKET_NAME, FOLDER_NAME, start_after=start_after)
+    with ThreadPoolExecutor(max_workers=DELETE_CONCURRENCY) as executor:
+        deleter = BatchDeleter(s3_client, BUCKET_NAME, executor=executor)
+        try:
+            for file in listing:
+                if time.monotonic() >= deadline_time:
+                    break
+                threshold = get_cleanup_threshold(file["Key"])
+                if threshold is not None and (now - file["LastModified"]).total_seconds() >= threshold:
+                    if in_progress_ticket_names is None:
+                        in_progress_ticket_names = get_in_progress_ticket_names(cb_client, now)
+                    if get_ticket_name_of_entry(file["Key"]) in in_progress_ticket_names:
+                        print(f"Resource pool entry {file['Key']} is stale, but its build is still in progress.")
+                        kept += 1
+                    else:
+                        deleter.add(file["Key"])
+                last_key = file["Key"]
+                scanned += 1
+            else:
+                finished = True
+        finally:
+            listing.close()
+            deleter.flush()
+    recorder.increment("PoolEntriesScanned", scanned)
+    recorder.increment("PoolEntriesDeleted", len(deleter.deleted_keys))
+    recorder.increment("PoolEntriesKeptInProgress", kept)
+
+    # the cursor is only moved once the deletes before it went through
+    if finished:
+        if start_after:
+            s3_client.delete_object(Bucket=BUCKET_NAME, Key=CURSOR_KEY)
+    else:
+        recorder.increment("CleanupDeadlineReached")
+        cursor = {"START_AFTER": last_key or start_after}
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=CURSOR_KEY, Body=json.dumps(cursor).encode("UTF-8"))
+
+    print(f"Deleted {len(deleter.deleted_keys)} resource pool tickets out of {scanned} scanned.")
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import sys
+
+from datetime import datetime, timedelta, timezone
+
+# the shared modules and the fakes live next to the scheduler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdascript"))
+
+import clients
+
+from fakes import FakeClientProvider, FakeCodeBuildClient, FakeLambdaContext, FakeS3Client
+from lambda_function import CURSOR_KEY, DEADLINE_SAFETY_MARGIN_SECONDS, lambda_handler
+
+"""
+How tests are executed:
+- place more stale resource pool entries than fit in one delete request in the in-memory fake of S3, along with
+entries that are not stale yet for their status, and run the cleanup lambda handler with no time left. The desired
+behavior:
+    1. nothing is deleted, and a cursor is saved for the next invocation.
+- write a cursor pointing into the middle of the resource pool, as left by an invocation that ran out of time, and
+run the cleanup lambda handler. The desired behavior:
+    1. only the stale entries after the cursor are deleted, in requests of at most 1000 keys, and the cursor is
+    removed once the pass reaches the end of the resource pool.
+- run the cleanup lambda handler again. The desired behavior:
+    1. the remaining stale entries are deleted: preparing entries older than their short threshold and running
+    entries older than their long threshold; younger running entries and other objects are left untouched.
+    2. stale preparing entries whose Job Executor build is still in progress are kept, those of finished builds are
+    deleted.
+
+Note: no AWS account is needed, the test runs against the fakes in lambdascript/fakes.py.
+"""
+
+# Test parameters
+NUM_OF_STALE_ENTRIES = 1500
+NUM_OF_FRESH_ENTRIES = 10
+NUM_OF_IN_PROGRESS_ENTRIES = 3
+PREPARING_AGE = timedelta(hours=3)
+RUNNING_AGE = timedelta(hours=3)
+STALE_RUNNING_AGE = timedelta(hours=25)
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+POOL_FOLDER = "resource_pool/ml.p3.8xlarge-training"
+TICKET_FOLDER = "request_tickets"
+JOB_EXECUTOR_PROJECT_NAME = "DLCTestJobExecutor"
+UNRELATED_KEY = "resource_pool/README.txt"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def place_pool_entries(s3_client, cb_client):
+    """
+    Put resource pool entries in the fake S3, backdated by the given ages, and start the builds of the preparing
+    entries that are still being worked on
+
+    :return: <tuple> (keys of the stale entries, keys of the entries that must be kept)
+    """
+    now = datetime.now(timezone.utc)
+    stale_keys, kept_keys = [], []
+    for i in range(NUM_OF_STALE_ENTRIES):
+        status, age = ("preparing", PREPARING_AGE) if i % 2 else ("running", STALE_RUNNING_AGE)
+        stale_keys.append(f"{POOL_FOLDER}/cleanup-{i:05d}_2020-06-01-00-00-00#1-{status}.json")
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=stale_keys[-1], Body=json.dumps({"STATUS": status}))
+        s3_client.set_last_modified(BUCKET_NAME, stale_keys[-1], now - age)
+    for i in range(NUM_OF_FRESH_ENTRIES):
+        kept_keys.append(f"{POOL_FOLDER}/cleanup-{i:05d}_2020-06-02-00-00-00#1-running.json")
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=kept_keys[-1], Body=json.dumps({"STATUS": "running"}))
+        s3_client.set_last_modified(BUCKET_NAME, kept_keys[-1], now - RUNNING_AGE)
+    for i in range(2 * NUM_OF_IN_PROGRESS_ENTRIES):
+        ticket_name = f"cleanup-{i:05d}_2020-06-03-00-00-00"
+        build = cb_client.start_build(
+            projectName=JOB_EXECUTOR_PROJECT_NAME,
+            environmentVariablesOverride=[
+                {"name": "TICKET_KEY", "value": f"{TICKET_FOLDER}/{ticket_name}.json", "type": "PLAINTEXT"}
+            ],
+        )
+        # every other build has finished, the entries of those are stale
+        if i % 2:
+            cb_client.finish_build(build["build"]["id"])
+            keys = stale_keys
+        else:
+            keys = kept_keys
+        keys.append(f"{POOL_FOLDER}/{ticket_name}#1-preparing.json")
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=keys[-1], Body=json.dumps({"STATUS": "preparing"}))
+        s3_client.set_last_modified(BUCKET_NAME, keys[-1], now - PREPARING_AGE)
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=UNRELATED_KEY, Body=b"not a pool entry")
+    s3_client.set_last_modified(BUCKET_NAME, UNRELATED_KEY, now - STALE_RUNNING_AGE)
+    kept_keys.append(UNRELATED_KEY)
+    return stale_keys, kept_keys
+
+
+def test():
+    s3_client = FakeS3Client()
+    cb_client = FakeCodeBuildClient()
+    previous_provider = clients.set_client_provider(FakeClientProvider(s3=s3_client, codebuild=cb_client))
+    try:
+        stale_keys, kept_keys = place_pool_entries(s3_client, cb_client)
+        pool_keys = sorted(stale_keys + kept_keys)
+
+        # check an invocation out of time deletes nothing and leaves a cursor
+        lambda_handler("dummy_event", FakeLambdaContext(timeout_seconds=DEADLINE_SAFETY_MARGIN_SECONDS))
+        assert s3_client.keys(BUCKET_NAME, "resource_pool/") == pool_keys, "Entries deleted past the deadline."
+        assert s3_client.keys(BUCKET_NAME, CURSOR_KEY), "Cursor not saved at the deadline."
+
+        # check the pass resumes from the cursor, in delete requests within the S3 limit
+        cursor_key = stale_keys[NUM_OF_STALE_ENTRIES // 10]
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=CURSOR_KEY, Body=json.dumps({"START_AFTER": cursor_key}))
+        lambda_handler("dummy_event", FakeLambdaContext())
+        remaining_keys = s3_client.keys(BUCKET_NAME, "resource_pool/")
+        expected_keys = sorted(key for key in pool_keys if key <= cursor_key or key in kept_keys)
+        assert remaining_keys == expected_keys, f"Wrong entries deleted after the cursor: {len(remaining_keys)} left"
+        assert s3_client.api_calls["DeleteObjects"] >= 2, "Stale entries not deleted in chunks."
+        assert not s3_client.keys(BUCKET_NAME, CURSOR_KEY), "Cursor not removed at the end of the pass."
+
+        # check the next pass deletes the rest, by the threshold of each status, but keeps the builds in progress
+        lambda_handler("dummy_event", FakeLambdaContext())
+        remaining_keys = s3_client.keys(BUCKET_NAME, "resource_pool/")
+        assert remaining_keys == sorted(kept_keys), f"Stale entries left or fresh entries deleted: {remaining_keys}"
+    finally:
+        clients.set_client_provider(previous_provider)
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,7 @@
+# usage: ./deploy.sh <name of the dead letter queue compaction lambda function>
+# clients.py, constants.py, metrics.py, cold_start.py and s3_utils.py are shared with the scheduler and packaged from
+# lambdascript
+python ../lambdascript/profile_cold_start.py lambda_function.py
+zip lambda.zip lambda_function.py
+zip -j lambda.zip ../lambdascript/clients.py ../lambdascript/constants.py ../lambdascript/metrics.py ../lambdascript/cold_start.py ../lambdascript/s3_utils.py
+aws lambda update-function-code --function-name "${1:?name of the compaction lambda function required}" --zip-file fileb://lambda.zip
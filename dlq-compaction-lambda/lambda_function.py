@@ -0,0 +1,227 @@
+import gzip
+import hashlib
+import json
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+# imported first, so that cold-start profiling sees the imports below
+import cold_start
+import metrics
+
+from clients import get_client_provider
+from s3_utils import BatchDeleter, iter_objects
+
+BUCKET_NAME = "dlc-test-tickets"
+DEAD_LETTER_PREFIX = "dead_letter_queue/"
+ARCHIVE_PREFIX = "dead_letter_archive/"
+# Dead letter tickets that cannot be parsed are moved there, so that they do not hold up later runs
+QUARANTINE_PREFIX = "dead_letter_quarantine/"
+DEAD_LETTER_REASONS = ("maxRetries", "timeout")
+METRICS_NAMESPACE = "DLCTestScheduler"
+# Number of dead letter tickets per archive
+ARCHIVE_MAX_ENTRIES = 10000
+# Number of dead letter tickets downloaded concurrently
+DOWNLOAD_CONCURRENCY = 16
+# Tickets are read in chunks, and the deadline is checked between chunks
+CHUNK_SIZE = 1000
+# Time kept in reserve at the end of an invocation to upload the archives and delete their tickets
+DEADLINE_SAFETY_MARGIN_SECONDS = 120
+
+
+def parse_dead_letter_key(key):
+    """
+    Naming convention of dead letter tickets: dead_letter_queue/(request ticket name)-(reason).json
+
+    :param key: <string> key of the dead letter ticket
+    :return: <tuple> (request ticket name, reason), or None if the key is not a dead letter ticket
+    """
+    if not key.startswith(DEAD_LETTER_PREFIX) or not key.endswith(".json"):
+        return None
+    ticket_name, _, reason = key[len(DEAD_LETTER_PREFIX) : -len(".json")].rpartition("-")
+    if not ticket_name or reason not in DEAD_LETTER_REASONS:
+        return None
+    return ticket_name, reason
+
+
+def get_archive_prefix(reason, date):
+    """
+    Archives are partitioned by reason and by the date the tickets were moved to the dead letter queue
+
+    :param reason: <string> (maxRetries/timeout)
+    :param date: <string> date in YYYY-MM-DD format
+    :return: <string> key prefix of the archives of the partition
+    """
+    return f"{ARCHIVE_PREFIX}reason={reason}/date={date}/"
+
+
+def read_dead_letter(s3_client, entry):
+    """
+    :param s3_client: boto3 S3 client
+    :param entry: <dict> S3 object descriptor of a dead letter ticket, as listed
+    :return: <dict> archive record of the ticket: its body, with the reason, the time it was moved to the dead letter
+    queue, and the instance type and job type recorded by the scheduler if any
+    :raises ValueError: if the body of the ticket is not a JSON object
+    """
+    ticket_name, reason = parse_dead_letter_key(entry["Key"])
+    s3_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=entry["Key"])
+    metadata = s3_object.get("Metadata", {})
+    record = {
+        "TICKET_NAME": ticket_name,
+        "REASON": reason,
+        "DEAD_LETTERED_AT": entry["LastModified"].isoformat(),
+        "INSTANCE_TYPE": metadata.get("instance-type"),
+        "JOB_TYPE": metadata.get("job-type"),
+    }
+    content = json.loads(s3_object["Body"].read().decode("utf-8"))
+    if not isinstance(content, dict):
+        raise ValueError(f"{entry['Key']} does not hold a JSON object")
+    record.update(content)
+    return record
+
+
+def try_read_dead_letter(s3_client, entry):
+    """
+    :param s3_client: boto3 S3 client
+    :param entry: <dict> S3 object descriptor of a dead letter ticket, as listed
+    :return: <tuple> (archive record of the ticket, None), or (None, error) if the ticket could not be read or parsed
+    """
+    try:
+        return read_dead_letter(s3_client, entry), None
+    except (BotoCoreError, ClientError, ValueError) as e:
+        return None, e
+
+
+def quarantine_dead_letter(s3_client, key):
+    """
+    Copy a dead letter ticket that cannot be parsed out of the dead letter queue; the caller deletes the original
+
+    :param s3_client: boto3 S3 client
+    :param key: <string> key of the dead letter ticket
+    :return: <string> key of the quarantined copy
+    """
+    quarantine_key = QUARANTINE_PREFIX + key[len(DEAD_LETTER_PREFIX) :]
+    s3_client.copy_object(Bucket=BUCKET_NAME, Key=quarantine_key, CopySource={"Bucket": BUCKET_NAME, "Key": key})
+    return quarantine_key
+
+
+class ArchiveWriter:
+    """
+    Gzip-compressed NDJSON archive of one partition, written to a temporary file as records come in
+    """
+
+    def __init__(self, reason, date):
+        """
+        :param reason: <string> (maxRetries/timeout)
+        :param date: <string> date in YYYY-MM-DD format
+        """
+        self.reason = reason
+        self.date = date
+        self.source_keys = []
+        self._file = tempfile.TemporaryFile()
+        self._gzip_file = gzip.GzipFile(fileobj=self._file, mode="wb")
+
+    def add(self, source_key, record):
+        """
+        :param source_key: <string> key of the dead letter ticket the record was read from
+        :param record: <dict> archive record of the ticket
+        """
+        self._gzip_file.write(json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n")
+        self.source_keys.append(source_key)
+
+    def upload(self, s3_client):
+        """
+        Upload the archive. Its name is derived from the tickets it holds, so a run retried with the same tickets
+        overwrites their archive. Tickets left on the dead letter queue after their archive was uploaded, e.g. because
+        their delete failed, are archived again with other tickets under another name: query_dlq.query returns each
+        ticket once.
+
+        :param s3_client: boto3 S3 client
+        :return: <string> key of the archive
+        """
+        self._gzip_file.close()
+        self._file.seek(0)
+        digest = hashlib.sha1("\n".join(self.source_keys).encode("utf-8")).hexdigest()[:16]
+        key = f"{get_archive_prefix(self.reason, self.date)}part-{digest}.ndjson.gz"
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=key, Body=self._file, ContentType="application/x-ndjson")
+        self._file.close()
+        return key
+
+
+def compact_dead_letter_queue(s3_client, deadline_time, recorder):
+    """
+    Roll the dead letter tickets into archives, and delete each ticket once its archive is uploaded.
+    A ticket that cannot be read is skipped and retried by the next run, a ticket that cannot be parsed is quarantined.
+
+    :param s3_client: boto3 S3 client
+    :param deadline_time: <float> time.monotonic() after which no new chunk of tickets is read
+    :param recorder: <MetricsRecorder> metrics of the current invocation
+    """
+    # (reason, date) -> archive being written
+    writers = {}
+    deleter = BatchDeleter(s3_client, BUCKET_NAME)
+
+    def finish(writer):
+        archive_key = writer.upload(s3_client)
+        for source_key in writer.source_keys:
+            deleter.add(source_key)
+        recorder.increment("ArchivesWritten")
+        print(f"Archived {len(writer.source_keys)} dead letter tickets into {archive_key}")
+
+    listing = iter_objects(s3_client, BUCKET_NAME, DEAD_LETTER_PREFIX)
+    entries = (entry for entry in listing if parse_dead_letter_key(entry["Key"]))
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as executor:
+        try:
+            while time.monotonic() < deadline_time:
+                chunk = [entry for _, entry in zip(range(CHUNK_SIZE), entries)]
+                if not chunk:
+                    break
+                results = executor.map(lambda entry: try_read_dead_letter(s3_client, entry), chunk)
+                archived = 0
+                for entry, (record, error) in zip(chunk, results):
+                    if isinstance(error, ValueError):
+                        try:
+                            quarantine_key = quarantine_dead_letter(s3_client, entry["Key"])
+                        except (BotoCoreError, ClientError) as e:
+                            print(f"Could not quarantine {entry['Key']}, it is skipped: {e}")
+                            recorder.increment("DeadLettersSkipped")
+                            continue
+                        deleter.add(entry["Key"])
+                        recorder.increment("DeadLettersQuarantined")
+                        print(f"Dead letter ticket {entry['Key']} cannot be parsed, moved to {quarantine_key}: {error}")
+                        continue
+                    if error is not None:
+                        # e.g. deleted by an overlapping run, or a transient S3 error
+                        print(f"Could not read dead letter ticket {entry['Key']}, it is skipped: {error}")
+                        recorder.increment("DeadLettersSkipped")
+                        continue
+                    partition = (record["REASON"], entry["LastModified"].strftime("%Y-%m-%d"))
+                    if partition not in writers:
+                        writers[partition] = ArchiveWriter(*partition)
+                    writers[partition].add(entry["Key"], record)
+                    if len(writers[partition].source_keys) >= ARCHIVE_MAX_ENTRIES:
+                        finish(writers.pop(partition))
+                    archived += 1
+                recorder.increment("DeadLettersArchived", archived)
+        finally:
+            listing.close()
+            for writer in writers.values():
+                finish(writer)
+            deleter.flush()
+
+    recorder.increment("DeadLettersDeleted", len(deleter.deleted_keys))
+
+
+def lambda_handler(event, context):
+    recorder = metrics.start_invocation(METRICS_NAMESPACE, "dlq-compaction")
+    if cold_start.invocation_started():
+        recorder.increment("ColdStart")
+    deadline_time = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_SAFETY_MARGIN_SECONDS
+    try:
+        compact_dead_letter_queue(get_client_provider().client("s3"), deadline_time, recorder)
+    finally:
+        recorder.emit()
+        cold_start.report()
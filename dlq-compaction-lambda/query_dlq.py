@@ -0,0 +1,131 @@
+"""
+Query the dead letter archives written by the compaction lambda.
+Archives are streamed: each one is decompressed and parsed line by line while it downloads, so memory use does not
+depend on the size of the archives, only on the number of tickets. Partitions outside of the requested reason and dates
+are not downloaded at all. A ticket archived by two runs, e.g. because its delete failed after the first archive was
+uploaded, is only returned once.
+
+Usage, with the shared modules of lambdascript on the path:
+    export PYTHONPATH=../lambdascript
+    # how many timeouts for p3 last week, by job type
+    python query_dlq.py --reason timeout --since 2026-10-05 --until 2026-10-11 \
+        --where INSTANCE_TYPE=ml.p3.8xlarge --count-by JOB_TYPE
+    # the dead letter tickets of a PR context, as NDJSON
+    python query_dlq.py --where CONTEXT=PR --limit 20
+"""
+import argparse
+import gzip
+import io
+import json
+import sys
+
+from collections import Counter
+
+from clients import get_client_provider
+from lambda_function import ARCHIVE_PREFIX, BUCKET_NAME, DEAD_LETTER_REASONS
+from s3_utils import iter_keys
+
+
+def parse_partition(archive_key):
+    """
+    :param archive_key: <string> key of an archive, e.g. (prefix)reason=timeout/date=2026-10-05/part-(id).ndjson.gz
+    :return: <tuple> (reason, date) of the archive
+    """
+    partition = dict(part.split("=", 1) for part in archive_key[len(ARCHIVE_PREFIX) :].split("/") if "=" in part)
+    return partition.get("reason"), partition.get("date")
+
+
+def iter_archive_keys(s3_client, reason=None, since=None, until=None):
+    """
+    :param s3_client: boto3 S3 client
+    :param reason: <string> only archives of this reason (maxRetries/timeout)
+    :param since: <string> only archives of this date or later, YYYY-MM-DD
+    :param until: <string> only archives of this date or earlier, YYYY-MM-DD
+    :return: <generator> keys of the archives in the requested partitions
+    """
+    prefix = f"{ARCHIVE_PREFIX}reason={reason}/" if reason else ARCHIVE_PREFIX
+    for archive_key in iter_keys(s3_client, BUCKET_NAME, prefix, suffix=".ndjson.gz"):
+        _, date = parse_partition(archive_key)
+        # dates in YYYY-MM-DD format compare as strings
+        if (since and date < since) or (until and date > until):
+            continue
+        yield archive_key
+
+
+def iter_records(s3_client, archive_key):
+    """
+    :param s3_client: boto3 S3 client
+    :param archive_key: <string> key of the archive
+    :return: <generator> <dict> records of the archive, decompressed while downloading
+    """
+    body = s3_client.get_object(Bucket=BUCKET_NAME, Key=archive_key)["Body"]
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=body, mode="rb"), encoding="utf-8") as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def matches(record, conditions):
+    """
+    :param record: <dict> archive record
+    :param conditions: <list> (field, value) pairs the record must all match; values are compared as strings
+    :return: <bool>
+    """
+    return all(str(record.get(field)) == value for field, value in conditions)
+
+
+def query(s3_client, conditions=(), reason=None, since=None, until=None):
+    """
+    :param s3_client: boto3 S3 client
+    :param conditions: <list> (field, value) pairs the records must match
+    :param reason: <string> only records of this reason (maxRetries/timeout)
+    :param since: <string> only records archived in partitions of this date or later, YYYY-MM-DD
+    :param until: <string> only records archived in partitions of this date or earlier, YYYY-MM-DD
+    :return: <generator> <dict> matching records, one per dead letter ticket
+    """
+    # (ticket name, reason) of the records returned, a ticket may be in more than one archive
+    seen = set()
+    for archive_key in iter_archive_keys(s3_client, reason, since, until):
+        for record in iter_records(s3_client, archive_key):
+            ticket = (record["TICKET_NAME"], record["REASON"])
+            if ticket not in seen and matches(record, conditions):
+                seen.add(ticket)
+                yield record
+
+
+def parse_condition(condition):
+    field, separator, value = condition.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError(f"Condition {condition} is not of the form FIELD=VALUE")
+    return field, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter and aggregate the dead letter archives")
+    parser.add_argument("--reason", choices=DEAD_LETTER_REASONS, help="only tickets dead-lettered for this reason")
+    parser.add_argument("--since", help="first date of the tickets, YYYY-MM-DD")
+    parser.add_argument("--until", help="last date of the tickets, YYYY-MM-DD")
+    parser.add_argument(
+        "--where", type=parse_condition, action="append", default=[], help="FIELD=VALUE condition, may be repeated"
+    )
+    parser.add_argument("--count-by", help="count the matching tickets by the value of this field")
+    parser.add_argument("--limit", type=int, help="print at most this many matching tickets")
+    args = parser.parse_args()
+
+    records = query(get_client_provider().client("s3"), args.where, args.reason, args.since, args.until)
+
+    if args.count_by:
+        counts = Counter(str(record.get(args.count_by)) for record in records)
+        for value, count in counts.most_common():
+            print(f"{value}\t{count}")
+        print(f"TOTAL\t{sum(counts.values())}")
+        return
+
+    for number, record in enumerate(records):
+        if args.limit is not None and number >= args.limit:
+            break
+        sys.stdout.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
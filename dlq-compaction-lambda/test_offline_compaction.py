@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import sys
+
+from datetime import datetime, timedelta, timezone
+
+# the shared modules and the fakes live next to the scheduler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdascript"))
+
+import clients
+
+from fakes import FakeClientProvider, FakeLambdaContext, FakeS3Client
+from lambda_function import ARCHIVE_PREFIX, QUARANTINE_PREFIX, lambda_handler
+from query_dlq import query
+
+"""
+How tests are executed:
+- place dead letter tickets for both failure reasons in the in-memory fake of S3, moved to the dead letter queue on
+different dates, along with an object of the dead letter queue that is not a dead letter ticket, a dead letter ticket
+that cannot be parsed and one that is deleted between the listing and its download, and run the compaction lambda
+handler against the fake, with the delete of one archived ticket failing, then run it again. The desired behavior:
+    1. every dead letter ticket is archived in the partition of its reason and date, and removed from the dead
+    letter queue; other objects are left untouched.
+    2. the ticket that cannot be parsed is moved to the quarantine, and the deleted ticket is skipped, without
+    holding up the compaction.
+    3. querying the archives finds every ticket once, even the ticket archived twice, filtered by reason, date and
+    field values.
+
+Note: no AWS account is needed, the test runs against the fakes in lambdascript/fakes.py.
+"""
+
+# Test parameters
+DAYS = 3
+TICKETS_PER_DAY_AND_REASON = 4
+IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04-example"
+)
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+DEAD_LETTER_QUEUE_FOLDER = "dead_letter_queue"
+UNRELATED_KEY = f"{DEAD_LETTER_QUEUE_FOLDER}/README.txt"
+MALFORMED_KEY = f"{DEAD_LETTER_QUEUE_FOLDER}/malformed_2020-06-01-00-00-00-maxRetries.json"
+VANISHED_KEY = f"{DEAD_LETTER_QUEUE_FOLDER}/vanished_2020-06-01-00-00-00-timeout.json"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def place_dead_letters(s3_client):
+    """
+    Put dead letter tickets on the dead letter queue of the fake S3, as moved there by the scheduler
+
+    :return: <list> dates in YYYY-MM-DD format the tickets were moved on
+    """
+    dates = []
+    for day in range(DAYS):
+        dead_lettered_at = datetime.now(timezone.utc) - timedelta(days=day)
+        dates.append(dead_lettered_at.strftime("%Y-%m-%d"))
+        for reason in ("maxRetries", "timeout"):
+            for i in range(TICKETS_PER_DAY_AND_REASON):
+                ticket_name = f"testing-{day}-{i}_{dead_lettered_at.strftime('%Y-%m-%d-%H-%M-%S')}"
+                key = f"{DEAD_LETTER_QUEUE_FOLDER}/{ticket_name}-{reason}.json"
+                content = {"CONTEXT": "PR" if i % 2 else "MAINLINE", "ECR-URI": IMAGE_URI, "INSTANCES_NUM": 1}
+                metadata = {"reason": reason, "instance-type": "ml.p3.8xlarge", "job-type": "training"}
+                s3_client.put_object(Bucket=BUCKET_NAME, Key=key, Body=json.dumps(content), Metadata=metadata)
+                s3_client.set_last_modified(BUCKET_NAME, key, dead_lettered_at)
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=UNRELATED_KEY, Body=b"not a ticket")
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=MALFORMED_KEY, Body=b'{"CONTEXT": "PR", "ECR-URI"')
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=VANISHED_KEY, Body=json.dumps({"CONTEXT": "PR"}))
+    return dates
+
+
+def delete_before_download(s3_client, key):
+    """
+    Make the download of a dead letter ticket find it deleted, as if it was removed after the listing
+    """
+    get_object = s3_client._get_object
+
+    def _get_object(**kwargs):
+        if kwargs["Key"] == key:
+            s3_client.delete_object(Bucket=kwargs["Bucket"], Key=key)
+        return get_object(**kwargs)
+
+    s3_client._get_object = _get_object
+
+
+def test():
+    s3_client = FakeS3Client()
+    previous_provider = clients.set_client_provider(FakeClientProvider(s3=s3_client))
+    try:
+        dates = place_dead_letters(s3_client)
+        delete_before_download(s3_client, VANISHED_KEY)
+
+        # the delete of an archived ticket fails, the next run archives it again
+        s3_client.failed_deletes[f"{DEAD_LETTER_QUEUE_FOLDER}/testing-"] = 1
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(s3_client.keys(BUCKET_NAME, f"{DEAD_LETTER_QUEUE_FOLDER}/")) == 2, "Failed delete not kept."
+
+        # check the ticket that cannot be parsed is quarantined, and the deleted ticket did not stop the compaction
+        quarantine_keys = s3_client.keys(BUCKET_NAME, QUARANTINE_PREFIX)
+        assert quarantine_keys == [
+            QUARANTINE_PREFIX + MALFORMED_KEY.split("/")[-1]
+        ], f"Ticket that cannot be parsed not quarantined: {quarantine_keys}"
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        # check every dead letter ticket is archived and removed
+        assert s3_client.keys(BUCKET_NAME, f"{DEAD_LETTER_QUEUE_FOLDER}/") == [
+            UNRELATED_KEY
+        ], "Dead letter tickets not removed from the dead letter queue, or other objects removed."
+        archive_keys = s3_client.keys(BUCKET_NAME, ARCHIVE_PREFIX)
+        assert (
+            len(archive_keys) == DAYS * 2 + 1
+        ), f"Expected one archive per date and reason, and a retry: {archive_keys}"
+
+        # check the ticket archived twice is returned once
+        records = list(query(s3_client))
+        assert len(records) == DAYS * 2 * TICKETS_PER_DAY_AND_REASON, f"Wrong number of records: {len(records)}"
+
+        # check the archives are partitioned by reason and date
+        for date in dates:
+            records = list(query(s3_client, reason="timeout", since=date, until=date))
+            assert len(records) == TICKETS_PER_DAY_AND_REASON, f"Wrong number of timeouts on {date}: {len(records)}"
+            for record in records:
+                assert record["REASON"] == "timeout", f"Record of another reason in a timeout archive: {record}"
+                assert record["DEAD_LETTERED_AT"].startswith(
+                    date
+                ), f"Record of another date in the archive: {record}"
+
+        # check the records can be filtered on the fields of the ticket and its metadata
+        conditions = [("INSTANCE_TYPE", "ml.p3.8xlarge"), ("CONTEXT", "PR")]
+        records = list(query(s3_client, conditions))
+        assert len(records) == DAYS * 2 * (
+            TICKETS_PER_DAY_AND_REASON // 2
+        ), f"Wrong number of PR records: {len(records)}"
+    finally:
+        clients.set_client_provider(previous_provider)
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
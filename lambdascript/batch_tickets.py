@@ -0,0 +1,156 @@
+"""
+Batch request tickets: a single request_tickets/*.json object holding a JSON array of ticket bodies, for submitters
+of many test jobs at once. Each entry is scheduled as a ticket of its own, under the key
+request_tickets/(batch name)@(entry id).json, which exists in the ticket index only. Dispatched and dead-lettered
+entries are dropped from the batch object at the end of the run, so the batch stays a single object until its last
+entry leaves the queue.
+The id of an entry is its ENTRY_ID field, or its position in the array when the submitter did not set one; it is
+written into the entries kept by a rewrite, so the ids do not shift as the batch shrinks.
+"""
+import json
+import logging
+
+from collections import Counter
+
+from botocore.exceptions import ClientError
+
+import constants
+
+from run_control import CONDITIONAL_WRITE_CONFLICTS
+from s3_utils import read_json_object
+
+
+LOGGER = logging.getLogger(__name__)
+
+BATCH_ENTRY_SEPARATOR = "@"
+# metadata set on the batch tickets rewritten by the scheduler, to tell them apart from rewrites by their submitter
+REWRITTEN_BY_METADATA = "rewritten-by"
+
+
+def is_batch(ticket_body):
+    """
+    :param ticket_body: <dict/list> parsed content of a request ticket object
+    :return: <bool> True if the object is a batch ticket
+    """
+    return isinstance(ticket_body, list)
+
+
+def get_entry_key(batch_key, entry_id):
+    """
+    :param batch_key: <string> key of the batch ticket, e.g. request_tickets/(batch name).json
+    :param entry_id: <string> id of the entry within the batch
+    :return: <string> key the entry is scheduled under, request_tickets/(batch name)@(entry id).json
+    """
+    batch_path = batch_key[: -len(".json")] if batch_key.endswith(".json") else batch_key
+    return f"{batch_path}{BATCH_ENTRY_SEPARATOR}{entry_id}.json"
+
+
+def split_batch(batch_key, batch_body):
+    """
+    :param batch_key: <string> key of the batch ticket
+    :param batch_body: <list> parsed content of the batch ticket
+    :return: <list> (entry key, entry body) of each entry, the body holding the ENTRY_ID of the entry
+    """
+    entries = []
+    for position, entry_body in enumerate(batch_body):
+        entry_id = str(entry_body.get("ENTRY_ID", position))
+        entries.append((get_entry_key(batch_key, entry_id), dict(entry_body, ENTRY_ID=entry_id)))
+    return entries
+
+
+def get_duplicate_entry_ids(batch_entries):
+    """
+    :param batch_entries: <list> (entry key, entry body) of each entry, as returned by split_batch
+    :return: <list> ids shared by more than one entry of the batch, sorted
+    """
+    counts = Counter(entry_body["ENTRY_ID"] for _, entry_body in batch_entries)
+    return sorted(entry_id for entry_id, count in counts.items() if count > 1)
+
+
+def read_batch_entry(s3_client, bucket, batch_key, entry_key):
+    """
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param batch_key: <string> key of the batch ticket
+    :param entry_key: <string> key of the entry
+    :return: <dict> body of the entry, or None if the entry is no longer part of the batch
+    """
+    return dict(split_batch(batch_key, read_json_object(s3_client, bucket, batch_key))).get(entry_key)
+
+
+def get_remaining_entries(batch_key, batch_body, removed_keys, index):
+    """
+    :param batch_key: <string> key of the batch ticket
+    :param batch_body: <list> latest content of the batch ticket
+    :param removed_keys: <set> keys of the entries that left the queue
+    :param index: <TicketIndex> ticket index of the current run
+    :return: <list> bodies of the other entries, with the highest number of tries of the batch and of the index
+    """
+    remaining_entries = []
+    for entry_key, entry_body in split_batch(batch_key, batch_body):
+        if entry_key in removed_keys:
+            continue
+        if entry_key in index:
+            indexed_tries = index.get(entry_key)["SCHEDULING_TRIES"]
+            entry_body["SCHEDULING_TRIES"] = max(entry_body["SCHEDULING_TRIES"], indexed_tries)
+        remaining_entries.append(entry_body)
+    return remaining_entries
+
+
+def rewrite_batches(s3_client, bucket, index, deleter):
+    """
+    Drop the entries that left the queue during the run from their batch tickets, and write the retry state of the
+    remaining entries into the batch. Batches without any entry left are deleted, empty batch tickets included.
+    Batches are rewritten with conditional writes, and runs overlapping in time each drop their own entries from
+    the latest version of the batch. The entries are also dropped from a batch rewritten by its submitter since it
+    was indexed, so that they are not scheduled again, and the batch is indexed again by the next run.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param index: <TicketIndex> ticket index of the current run
+    :param deleter: <BatchDeleter> collects the deletion of the emptied batches
+    """
+    for batch_key in index.get_changed_batches():
+        removed_keys = index.get_removed_batch_entries(batch_key)
+        for attempt in range(1, constants.STATE_WRITE_ATTEMPTS + 1):
+            try:
+                batch_object = s3_client.get_object(Bucket=bucket, Key=batch_key)
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "NoSuchKey":
+                    raise
+                LOGGER.warning(f"Batch ticket {batch_key} no longer exists.")
+                index.remove(batch_key)
+                break
+            etag = batch_object["ETag"]
+            rewritten_by_scheduler = batch_object.get("Metadata", {}).get(REWRITTEN_BY_METADATA) == "scheduler"
+            rewritten_by_submitter = etag != index.get(batch_key)["ETAG"] and not rewritten_by_scheduler
+            if rewritten_by_submitter:
+                LOGGER.warning(f"Batch ticket {batch_key} was rewritten by its submitter, it will be indexed again.")
+
+            batch_body = json.loads(batch_object["Body"].read().decode("utf-8"))
+            remaining_entries = get_remaining_entries(batch_key, batch_body, removed_keys, index)
+            if not remaining_entries:
+                deleter.add(batch_key)
+                index.remove(batch_key)
+                break
+
+            try:
+                response = s3_client.put_object(
+                    Bucket=bucket,
+                    Key=batch_key,
+                    Body=json.dumps(remaining_entries).encode("UTF-8"),
+                    Metadata={REWRITTEN_BY_METADATA: "scheduler"},
+                    IfMatch=etag,
+                )
+            except ClientError as e:
+                conflict = e.response["Error"]["Code"] in CONDITIONAL_WRITE_CONFLICTS
+                if not conflict or attempt == constants.STATE_WRITE_ATTEMPTS:
+                    raise
+                LOGGER.info(f"Batch ticket {batch_key} written by a concurrent run, rewriting it again.")
+                continue
+            if rewritten_by_submitter:
+                index.remove(batch_key)
+            else:
+                index.batch_written(batch_key, response["ETag"])
+            LOGGER.info(f"Batch ticket {batch_key} rewritten with {len(remaining_entries)} remaining entries.")
+            break
@@ -0,0 +1,172 @@
+"""
+Offline benchmark of the Lambda scheduler.
+Each scenario generates a synthetic backlog of request tickets with mixed image URIs and a partly booked resource
+pool in the in-memory fakes of S3 and CodeBuild, then runs lambda_handler twice: once with an empty ticket index,
+as after a deployment, and once more over the remaining queue. Reported for each run:
+wall time, time spent in each phase, AWS API calls by operation, and peak memory allocated by Python.
+
+Usage:
+    python benchmark.py                       # 100, 1k and 10k tickets
+    python benchmark.py --tickets 1000 --json
+"""
+import argparse
+import io
+import json
+import logging
+import random
+import time
+import tracemalloc
+
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+import clients
+import constants
+import metrics
+
+from fakes import FakeClientProvider, FakeCodeBuildClient, FakeLambdaContext
+from lambda_function import lambda_handler
+
+
+DEFAULT_SCENARIOS = (100, 1000, 10000)
+IMAGE_REPOSITORIES = (
+    "pr-tensorflow-training",
+    "pr-tensorflow-inference",
+    "pr-pytorch-training",
+    "pr-pytorch-inference",
+    "pr-mxnet-training",
+)
+CONTEXTS = ("MAINLINE", "NIGHTLY", "PR", "PR", "PR", "DEV")
+
+
+def create_ticket_content(rng, request_time):
+    """
+    :param rng: <random.Random> source of randomness of the scenario
+    :param request_time: <datetime> time the request was made
+    :return: <dict> content of a synthetic request ticket
+    """
+    repository = rng.choice(IMAGE_REPOSITORIES)
+    processor = rng.choice(("gpu", "cpu"))
+    return {
+        "CONTEXT": rng.choice(CONTEXTS),
+        "TIMESTAMP": request_time.strftime(constants.TIMESTAMP_FORMAT),
+        "ECR-URI": f"123456789012.dkr.ecr.us-west-2.amazonaws.com/{repository}:1.0-{processor}-py37-benchmark",
+        "RETURN-SQS-URL": "DUMMY_SQS_URL",
+        "SCHEDULING_TRIES": rng.choice((0, 0, 0, 1, 2, constants.MAX_SCHEDULING_RETRIES)),
+        "INSTANCES_NUM": rng.choice((1, 1, 1, 2, 3)),
+        "TIMEOUT_LIMIT": rng.choice((14400, 14400, 14400, 600)),
+    }
+
+
+def populate_backlog(s3_client, num_tickets, seed):
+    """
+    Place a synthetic backlog and resource pool in the fake S3
+
+    :param s3_client: <FakeS3Client> fake S3 client
+    :param num_tickets: <int> number of request tickets to place on the queue
+    :param seed: <int> seed of the scenario
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+
+    for ticket_number in range(num_tickets):
+        request_time = now - timedelta(seconds=rng.randint(0, 4 * 3600))
+        ticket_name = f"benchmark-{ticket_number}_{request_time.strftime(constants.TIMESTAMP_FORMAT)}"
+        s3_client.put_object(
+            Bucket=constants.BUCKET_NAME,
+            Key=f"request_tickets/{ticket_name}.json",
+            Body=json.dumps(create_ticket_content(rng, request_time)).encode("UTF-8"),
+        )
+
+    # book part of the capacity of every instance type
+    for job_type, limits in (("training", constants.TRAINING_LIMIT), ("inference", constants.INFERENCE_LIMIT)):
+        for instance_type, limit in limits.items():
+            for pool_number in range(rng.randint(0, limit)):
+                status = rng.choice(("preparing", "running"))
+                s3_client.put_object(
+                    Bucket=constants.BUCKET_NAME,
+                    Key=f"resource_pool/{instance_type}-{job_type}/benchmark-pool-{pool_number}#1-{status}.json",
+                    Body=b"{}",
+                )
+
+
+def measure_run(provider, event):
+    """
+    Run lambda_handler once against the fakes
+
+    :param provider: <FakeClientProvider> provider of the fake clients
+    :param event: Lambda event passed to the handler
+    :return: <dict> wall time, phase durations, API calls by operation and peak memory of the run
+    """
+    provider.reset_api_calls()
+    tracemalloc.start()
+    start = time.perf_counter()
+    # the EMF metrics printed by the handler are read back from the recorder instead
+    with redirect_stdout(io.StringIO()):
+        lambda_handler(event, FakeLambdaContext())
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "WALL_TIME_SECONDS": round(wall_time, 3),
+        "PEAK_MEMORY_MB": round(peak_memory / 2 ** 20, 2),
+        "PHASE_SECONDS": {phase: round(seconds, 3) for phase, seconds in metrics.get_recorder().phase_seconds.items()},
+        "API_CALLS": dict(sorted(provider.api_calls().items())),
+    }
+
+
+def run_scenario(num_tickets, seed):
+    """
+    :param num_tickets: <int> number of request tickets in the backlog
+    :param seed: <int> seed of the scenario
+    :return: <dict> measurements of the first run and of the run after it
+    """
+    provider = FakeClientProvider(codebuild=FakeCodeBuildClient())
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        populate_backlog(provider.client("s3"), num_tickets, seed)
+        results = {"TICKETS": num_tickets}
+        results["FIRST_RUN"] = measure_run(provider, "benchmark_event")
+        results["NEXT_RUN"] = measure_run(provider, "benchmark_event")
+        results["TICKETS_LEFT"] = len(provider.client("s3").keys(constants.BUCKET_NAME, "request_tickets/"))
+        return results
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def format_results(results):
+    """
+    :param results: <dict> measurements of a scenario
+    :return: <string> human readable report of the scenario
+    """
+    lines = [f"{results['TICKETS']} tickets ({results['TICKETS_LEFT']} left on the queue)"]
+    for run_name in ("FIRST_RUN", "NEXT_RUN"):
+        run = results[run_name]
+        calls = ", ".join(f"{operation}={count}" for operation, count in run["API_CALLS"].items())
+        lines.append(
+            f"  {run_name.lower().replace('_', ' ')}: {run['WALL_TIME_SECONDS']}s, "
+            f"peak {run['PEAK_MEMORY_MB']} MB, {sum(run['API_CALLS'].values())} API calls ({calls})"
+        )
+        phases = ", ".join(f"{phase}={seconds}s" for phase, seconds in run["PHASE_SECONDS"].items())
+        lines.append(f"    phases: {phases}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Lambda scheduler against in-memory AWS fakes")
+    parser.add_argument("--tickets", type=int, nargs="+", default=DEFAULT_SCENARIOS, help="backlog sizes to run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic backlogs")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    # keep the per-ticket scheduler logging out of the report
+    logging.disable(logging.WARNING)
+
+    for num_tickets in args.tickets:
+        results = run_scenario(num_tickets, args.seed)
+        print(json.dumps(results) if args.json else format_results(results))
+
+
+if __name__ == "__main__":
+    main()
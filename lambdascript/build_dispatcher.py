@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+import constants
+
+from metrics import THROTTLING_ERROR_CODES
+
+
+LOGGER = logging.getLogger(__name__)
+
+# outcomes of the start_build request of a ticket
+BUILD_STARTED = "started"
+BUILD_FAILED = "failed"
+# not attempted, the deadline of the run was reached first
+BUILD_SKIPPED = "skipped"
+
+# error codes of server-side failures that may go through when retried, next to any 5xx status
+TRANSIENT_ERROR_CODES = {
+    "InternalError",
+    "InternalFailure",
+    "InternalServerError",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+    "RequestTimeout",
+    "RequestTimeoutException",
+}
+
+
+def is_transient_error(error):
+    """
+    :param error: <ClientError> error of an API call
+    :return: <bool> True if the call failed on the side of the service, and may go through when retried
+    """
+    status_code = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return status_code >= 500 or error.response["Error"]["Code"] in TRANSIENT_ERROR_CODES
+
+
+class AdaptiveRateLimiter:
+    """
+    Spaces out calls to a target rate shared by all threads. The rate is halved whenever a call is throttled
+    and recovers additively with every successful call, down to min_rate and up to max_rate.
+    """
+
+    def __init__(self, rate, min_rate, max_rate=None):
+        """
+        :param rate: <float> initial number of calls per second
+        :param min_rate: <float> lowest rate the limiter backs off to
+        :param max_rate: <float> highest rate the limiter recovers to, the initial rate by default
+        """
+        self.rate = rate
+        self._min_rate = min_rate
+        self._max_rate = max_rate or rate
+        self._next_call_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until the caller may make its call
+        """
+        with self._lock:
+            now = time.monotonic()
+            call_time = max(now, self._next_call_time)
+            self._next_call_time = call_time + 1 / self.rate
+        if call_time > now:
+            time.sleep(call_time - now)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self._max_rate, self.rate + self._min_rate)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self._min_rate, self.rate / 2)
+            # hold back every caller for one interval at the reduced rate
+            self._next_call_time = max(self._next_call_time, time.monotonic()) + 1 / self.rate
+
+
+class BuildDispatcher:
+    """
+    Starts the Job Executor builds of a run concurrently, at a rate that adapts to throttling.
+    Once CodeBuild reports that the account limit of concurrent builds is reached, no further build is
+    attempted for the rest of the run: the remaining tickets fail without an API call each.
+    """
+
+    def __init__(self, cb_client, deadline, max_concurrent_starts=None, starts_per_second=None, retries=None):
+        """
+        :param cb_client: boto3 CodeBuild client, making a single attempt per call: throttled and transiently failing
+        requests are retried by the dispatcher, with the same idempotency token
+        :param deadline: <Deadline> time budget of the current run
+        :param max_concurrent_starts: <int> max number of start_build requests in flight
+        :param starts_per_second: <float> initial rate of start_build requests
+        :param retries: <int> times a throttled or transiently failing start_build is retried before the ticket fails
+        """
+        self._cb_client = cb_client
+        self._deadline = deadline
+        self._max_concurrent_starts = max_concurrent_starts or constants.CODEBUILD_MAX_CONCURRENT_STARTS
+        self._retries = constants.CODEBUILD_START_RETRIES if retries is None else retries
+        starts_per_second = starts_per_second or constants.CODEBUILD_STARTS_PER_SECOND
+        self._rate_limiter = AdaptiveRateLimiter(starts_per_second, constants.CODEBUILD_MIN_STARTS_PER_SECOND)
+        self.account_limit_reached = threading.Event()
+
+    def _start_build(self, ticket_key, build):
+        """
+        :param ticket_key: <string> key of the request ticket
+        :param build: <dict> arguments of start_build
+        :return: <string> outcome of the request
+        """
+        exceptions = self._cb_client.exceptions
+        for attempt in range(self._retries + 1):
+            # the account limit may be reached by another request while waiting for the rate limiter
+            self._rate_limiter.acquire()
+            if self.account_limit_reached.is_set():
+                return BUILD_FAILED
+            if self._deadline.expired():
+                return BUILD_SKIPPED
+
+            try:
+                self._cb_client.start_build(**build)
+                self._rate_limiter.on_success()
+                return BUILD_STARTED
+
+            except exceptions.InvalidInputException as e:
+                LOGGER.warning(f"Invalid inputs when starting Job Executor: {e}")
+            except exceptions.ResourceNotFoundException as e:
+                LOGGER.warning(f"Job Executor CodeBuild project not found: {e}")
+            except exceptions.AccountLimitExceededException as e:
+                if not self.account_limit_reached.is_set():
+                    self.account_limit_reached.set()
+                    LOGGER.warning(f"CodeBuild account limit exceeded, no more builds are started in this run: {e}")
+            except ClientError as e:
+                if e.response["Error"]["Code"] in THROTTLING_ERROR_CODES:
+                    self._rate_limiter.on_throttle()
+                    LOGGER.info(f"start_build throttled for {ticket_key} (attempt {attempt + 1}), backing off.")
+                    continue
+                if is_transient_error(e):
+                    LOGGER.info(f"start_build failed for {ticket_key} (attempt {attempt + 1}), retrying: {e}")
+                    continue
+                LOGGER.warning(f"start_build failed for {ticket_key}: {e}")
+            except (ConnectionError, HTTPClientError) as e:
+                LOGGER.info(f"start_build got no response for {ticket_key} (attempt {attempt + 1}), retrying: {e}")
+                continue
+            return BUILD_FAILED
+
+        LOGGER.warning(f"start_build for {ticket_key} still throttled or failing after {self._retries} retries.")
+        return BUILD_FAILED
+
+    def dispatch(self, builds):
+        """
+        Start the builds concurrently; builds are picked up in order, results come in as the requests complete.
+        A build failing to start never stops the others: its ticket fails, and is requeued by the caller.
+
+        :param builds: <list> (ticket key, start_build arguments) of the tickets to dispatch
+        :return: <generator> (ticket key, outcome) of every ticket
+        """
+        if not builds:
+            return
+        with ThreadPoolExecutor(max_workers=min(self._max_concurrent_starts, len(builds))) as executor:
+            futures = {
+                executor.submit(self._start_build, ticket_key, build): ticket_key for ticket_key, build in builds
+            }
+            for future in as_completed(futures):
+                try:
+                    outcome = future.result()
+                except Exception:
+                    LOGGER.exception(f"Unexpected error starting the Job Executor for {futures[future]}.")
+                    outcome = BUILD_FAILED
+                yield futures[future], outcome
@@ -0,0 +1,195 @@
+import re
+
+import constants
+
+from s3_utils import iter_keys
+
+
+RESOURCE_POOL_FOLDER = "resource_pool"
+ACTIVE_STATUSES = ("preparing", "running")
+
+# resource_pool/(instance type)-(job type)/(request ticket name)#(num of instances)-(status).json
+POOL_KEY_PATTERN = re.compile(
+    r"^resource_pool/(?P<instance_type>.+)-(?P<job_type>training|inference)/"
+    r".*#(?P<num>\d+)-(?P<status>[a-zA-Z]+)\.json$"
+)
+
+
+def get_ticket_name(ticket_key):
+    """
+    :param ticket_key: <string> key of the request ticket
+    :return: <string> name of the ticket in the keys of its resource pool entries
+    """
+    return ticket_key.split("/")[-1].split(".")[0]
+
+
+def get_pool_key(ticket_key, instance_type, job_type, num_of_instances, status):
+    """
+    :param ticket_key: <string> key of the request ticket the instances are booked for
+    :param instance_type: <string> type of instance booked
+    :param job_type: <string> (training/inference)
+    :param num_of_instances: <int> number of instances booked
+    :param status: <string> status of the entry, e.g. preparing
+    :return: <string> key of the resource pool entry
+    """
+    ticket_name = get_ticket_name(ticket_key)
+    return f"{RESOURCE_POOL_FOLDER}/{instance_type}-{job_type}/{ticket_name}#{num_of_instances}-{status}.json"
+
+
+def parse_pool_key(key):
+    """
+    Parse a resource pool key into its instance type, job type, number of instances and status
+
+    :param key: <string> key of the resource pool entry
+    :return: <tuple> (instance_type, job_type, num_of_instances, status), or None if the key is not a pool entry
+    """
+    match = POOL_KEY_PATTERN.match(key)
+    if not match:
+        return None
+    return match.group("instance_type"), match.group("job_type"), int(match.group("num")), match.group("status")
+
+
+class CapacityLedger:
+    """
+    In-memory view of SageMaker capacity for a single scheduler invocation.
+    It is built from one listing of the resource pool and updated locally as instances are booked,
+    so capacity checks during the run do not go back to S3.
+    """
+
+    def __init__(self, training_limit=None, inference_limit=None, total_limits=None):
+        """
+        :param training_limit: <dict> instance type -> training instance limit, defaults to constants.TRAINING_LIMIT
+        :param inference_limit: <dict> instance type -> inference instance limit, defaults to constants.INFERENCE_LIMIT
+        :param total_limits: <dict> job type -> limit on the instances of all types, defaults to
+        constants.TOTAL_INSTANCE_TRAINING/TOTAL_INSTANCE_INFERENCE
+        """
+        training_limit = constants.TRAINING_LIMIT if training_limit is None else training_limit
+        inference_limit = constants.INFERENCE_LIMIT if inference_limit is None else inference_limit
+        if total_limits is None:
+            total_limits = {
+                "training": constants.TOTAL_INSTANCE_TRAINING,
+                "inference": constants.TOTAL_INSTANCE_INFERENCE,
+            }
+        self._total_limits = dict(total_limits)
+
+        self._limits = {}
+        for instance_type, limit in training_limit.items():
+            self._limits[(instance_type, "training")] = limit
+        for instance_type, limit in inference_limit.items():
+            self._limits[(instance_type, "inference")] = limit
+        self._in_use = {resource_class: 0 for resource_class in self._limits}
+
+    @classmethod
+    def from_resource_pool(cls, s3_client, bucket, **kwargs):
+        """
+        Build the ledger from the preparing/running entries currently in the resource pool
+
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :return: <CapacityLedger>
+        """
+        ledger = cls(**kwargs)
+        for key in iter_keys(s3_client, bucket, f"{RESOURCE_POOL_FOLDER}/", suffix=".json"):
+            ledger.add_pool_entry(key)
+        return ledger
+
+    def add_pool_entry(self, key):
+        """
+        Account for a resource pool entry; entries that do not hold capacity are ignored
+
+        :param key: <string> key of the resource pool entry
+        """
+        parsed = parse_pool_key(key)
+        if parsed is None:
+            return
+        instance_type, job_type, num_of_instances, status = parsed
+        if status in ACTIVE_STATUSES:
+            self._in_use[(instance_type, job_type)] = self._in_use.get((instance_type, job_type), 0) + num_of_instances
+
+    def in_use(self, instance_type, job_type):
+        """
+        :return: <int> number of instances of the type currently booked for the job type
+        """
+        return self._in_use.get((instance_type, job_type), 0)
+
+    def limit(self, instance_type, job_type):
+        """
+        :return: <int> instance limit of the type for the job type
+        """
+        return self._limits.get((instance_type, job_type), 0)
+
+    def total_in_use(self, job_type):
+        """
+        :return: <int> number of instances of all types currently booked for the job type
+        """
+        return sum(in_use for (_, class_job_type), in_use in self._in_use.items() if class_job_type == job_type)
+
+    def total_limit(self, job_type):
+        """
+        :return: <int> limit on the instances of all types for the job type
+        """
+        return self._total_limits.get(job_type, 0)
+
+    def resource_classes(self):
+        """
+        :return: <list> (instance_type, job_type) of every class with a limit or instances in use
+        """
+        return sorted(set(self._limits) | set(self._in_use))
+
+    def get_shard(self, instance_type, job_type):
+        """
+        Shard of the scheduler a resource class belongs to. Each resource class is a shard of its own, unless its job
+        type is in constants.SINGLE_SHARD_JOB_TYPES: bookings of any instance type then count against the same total
+        limit, and the whole job type is a single shard. The shards do not depend on the limits, which runs reloading
+        the scheduler config at different times may not agree on.
+
+        :return: <tuple> (instance type, job type) of the shard, with instance type "all" for a job type shard
+        """
+        if job_type in constants.SINGLE_SHARD_JOB_TYPES:
+            return "all", job_type
+        return instance_type, job_type
+
+    def fits(self, instance_type, job_type, num_of_instances):
+        """
+        Check that booking the instances stays within both the limit of the instance type and the total limit
+        of the job type
+
+        :return: <bool>
+        """
+        return (
+            self.in_use(instance_type, job_type) + num_of_instances <= self.limit(instance_type, job_type)
+            and self.total_in_use(job_type) + num_of_instances <= self.total_limit(job_type)
+        )
+
+    def remaining(self, instance_type, job_type):
+        """
+        :return: <int> number of instances of the type that can still be booked for the job type, within both
+        the limit of the instance type and the total limit of the job type
+        """
+        return max(
+            0,
+            min(
+                self.limit(instance_type, job_type) - self.in_use(instance_type, job_type),
+                self.total_limit(job_type) - self.total_in_use(job_type),
+            ),
+        )
+
+    def book(self, instance_type, job_type, num_of_instances):
+        """
+        Record that instances have been booked during this run
+
+        :param instance_type: <string> type of instance booked
+        :param job_type: <string> (training/inference)
+        :param num_of_instances: <int> number of instances booked
+        """
+        self._in_use[(instance_type, job_type)] = self.in_use(instance_type, job_type) + num_of_instances
+
+    def release(self, instance_type, job_type, num_of_instances):
+        """
+        Give back instances booked during this run that ended up unused
+
+        :param instance_type: <string> type of instance released
+        :param job_type: <string> (training/inference)
+        :param num_of_instances: <int> number of instances released
+        """
+        self._in_use[(instance_type, job_type)] = self.in_use(instance_type, job_type) - num_of_instances
@@ -0,0 +1,89 @@
+import threading
+
+import cold_start
+import constants
+import metrics
+
+
+class ClientProvider:
+    """
+    Creates boto3 clients once and hands out the same instances afterwards.
+    The module-level provider lives for the lifetime of the Lambda container, so warm invocations reuse
+    the clients together with their resolved endpoints and pooled connections.
+    boto3 is only imported when the first client is created, so code paths that make no AWS call never load it.
+    """
+
+    def __init__(self, max_pool_connections=None, max_attempts=None, retry_mode=None, region_name=None):
+        """
+        :param max_pool_connections: <int> size of the HTTP connection pool of each client
+        :param max_attempts: <int> max number of attempts per API call, including the first one
+        :param retry_mode: <string> botocore retry mode (legacy/standard/adaptive)
+        :param region_name: <string> AWS region, defaults to the region of the environment
+        """
+        self._max_pool_connections = max_pool_connections or constants.AWS_MAX_POOL_CONNECTIONS
+        # unlike max_attempts, total_max_attempts of botocore counts the first attempt
+        self._retries = {
+            "total_max_attempts": constants.AWS_MAX_ATTEMPTS if max_attempts is None else max_attempts,
+            "mode": retry_mode or constants.AWS_RETRY_MODE,
+        }
+        self._region_name = region_name
+        self._session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        # boto3 sessions are not thread safe; only ever called with self._lock held
+        if self._session is None:
+            import boto3
+
+            self._session = boto3.session.Session(region_name=self._region_name)
+        return self._session
+
+    def _create_client(self, service_name, max_attempts):
+        # only ever called with self._lock held
+        from botocore.config import Config
+
+        retries = self._retries
+        if max_attempts is not None:
+            retries = dict(self._retries, total_max_attempts=max_attempts)
+        config = Config(max_pool_connections=self._max_pool_connections, retries=retries)
+        with cold_start.first_call(f"client.{service_name}"):
+            client = self._get_session().client(service_name, config=config)
+        # latency, retries and throttles of every call are reported in the metrics of the invocation
+        return metrics.instrument_client(client)
+
+    def client(self, service_name, max_attempts=None):
+        """
+        :param service_name: <string> name of the AWS service, e.g. "s3"
+        :param max_attempts: <int> max number of attempts per API call, for callers retrying on their own; the
+        attempts of the provider by default
+        :return: shared boto3 client of the service, with the given retry settings
+        """
+        key = (service_name, max_attempts)
+        if key not in self._clients:
+            with self._lock:
+                if key not in self._clients:
+                    self._clients[key] = self._create_client(service_name, max_attempts)
+        return self._clients[key]
+
+
+_provider = ClientProvider()
+
+
+def get_client_provider():
+    """
+    :return: the client provider currently used by the scheduler
+    """
+    return _provider
+
+
+def set_client_provider(provider):
+    """
+    Replace the client provider, e.g. with one handing out local fakes in tests
+
+    :param provider: object exposing client(service_name)
+    :return: the provider that was replaced
+    """
+    global _provider
+    previous, _provider = _provider, provider
+    return previous
@@ -0,0 +1,131 @@
+"""
+Cold-start profiling of the lambdas.
+Setting the COLD_START_PROFILING environment variable to 1 on a function makes the first invocation of every
+container print a report of where its cold start went: time spent importing each module (inclusive of the modules
+it imports), time from the start of the container to the first invocation, and the cost of the first call of each
+kind, e.g. creating a boto3 client or the first request of an API operation, which pays for connection setup.
+Without the variable, only the first invocation of a container is flagged, at no measurable cost.
+
+This module has no dependency on the rest of the scheduler, so the cleanup lambda ships it as well.
+It must be imported before the modules it is meant to profile.
+"""
+import builtins
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+
+
+PROFILING_ENV_VARIABLE = "COLD_START_PROFILING"
+# number of modules listed in the report, slowest first
+REPORTED_IMPORTS = 15
+
+_container_start_time = time.perf_counter()
+_first_invocation_time = None
+# module name -> seconds spent importing it, inclusive of the modules it imports
+_import_seconds = {}
+# name of a first call, e.g. "client.s3" -> seconds
+_first_call_seconds = {}
+_reported = False
+_original_import = builtins.__import__
+
+
+def profiling_enabled():
+    """
+    :return: <bool> True if cold-start profiling is turned on for the function
+    """
+    return os.environ.get(PROFILING_ENV_VARIABLE, "") == "1"
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # relative imports and modules already loaded cost nothing worth reporting
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _import_seconds.setdefault(name, time.perf_counter() - start)
+
+
+def install_import_profiler():
+    """
+    Time every module imported from now on
+    """
+    builtins.__import__ = _timed_import
+
+
+def uninstall_import_profiler():
+    builtins.__import__ = _original_import
+
+
+def record_first_call(name, seconds):
+    """
+    :param name: <string> kind of call, e.g. "s3.GetObject"
+    :param seconds: <float> duration of the call; only the first one of each kind is kept
+    """
+    if profiling_enabled():
+        _first_call_seconds.setdefault(name, seconds)
+
+
+@contextmanager
+def first_call(name):
+    """
+    Time a block as the first call of its kind, e.g. creating a client
+
+    :param name: <string> kind of call
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_first_call(name, time.perf_counter() - start)
+
+
+def invocation_started():
+    """
+    Mark the start of an invocation of the handler
+
+    :return: <bool> True if this is the first invocation of the container, i.e. a cold start
+    """
+    global _first_invocation_time
+    if _first_invocation_time is not None:
+        return False
+    _first_invocation_time = time.perf_counter()
+    return True
+
+
+def get_report():
+    """
+    :return: <dict> cold-start costs measured so far, in seconds
+    """
+    slowest_imports = sorted(_import_seconds.items(), key=lambda item: item[1], reverse=True)[:REPORTED_IMPORTS]
+    report = {
+        "IMPORT_SECONDS": {name: round(seconds, 4) for name, seconds in slowest_imports},
+        "FIRST_CALL_SECONDS": {name: round(seconds, 4) for name, seconds in sorted(_first_call_seconds.items())},
+    }
+    if _first_invocation_time is not None:
+        report["INIT_SECONDS"] = round(_first_invocation_time - _container_start_time, 4)
+        report["FIRST_INVOCATION_SECONDS"] = round(time.perf_counter() - _first_invocation_time, 4)
+    return report
+
+
+def report(stream=None):
+    """
+    Print the cold-start report once per container, if profiling is enabled
+
+    :param stream: file object to write to, defaults to stdout
+    """
+    global _reported
+    if _reported or not profiling_enabled():
+        return
+    _reported = True
+    stream = stream or sys.stdout
+    stream.write(json.dumps({"COLD_START": get_report()}) + "\n")
+    stream.flush()
+
+
+if profiling_enabled():
+    install_import_profiler()
@@ -1,7 +1,47 @@
-# Timeout limit for this lambda program
+# Timeout limit for this lambda program, used when the Lambda context does not report the remaining time
 TIMEOUT_LIMIT_SECONDS = 780  # 13 mins
+# Time kept in reserve at the end of an invocation to finish the current ticket and save the scheduler state
+DEADLINE_SAFETY_MARGIN_SECONDS = 30
 BUCKET_NAME = "dlc-test-tickets"
 MAX_SCHEDULING_RETRIES = 5
+# Priority classes of the request tickets by CONTEXT, 0 is scheduled first
+CONTEXT_PRIORITY = {
+    "MAINLINE": 0,
+    "NIGHTLY": 1,
+    "PR": 2,
+    "DEV": 3,
+}
+DEFAULT_CONTEXT_PRIORITY = 3
+# Format of the TIMESTAMP of request tickets and of the times written by the scheduler; zero-padded, so timestamps
+# compare as strings
+TIMESTAMP_FORMAT = "%Y-%m-%d-%H-%M-%S"
+# Waiting time after which a ticket is promoted by one priority class
+PRIORITY_AGING_SECONDS = 3600  # 1 hour
+
+# Scheduling tries after which a blocked ticket reserves the capacity it waits on, stopping backfilling behind it
+BACKFILL_RESERVATION_TRIES = 3
+
+# Index of the queued request tickets, maintained by the scheduler
+TICKET_INDEX_KEY = "scheduler_state/ticket_index.json"
+# Tickets already handled by an unfinished pass over the queue
+RESUME_CURSOR_KEY = "scheduler_state/cursor.json"
+# Leases on the shards of the scheduler, one per resource class
+SHARD_LEASE_PREFIX = "scheduler_state/leases/"
+# Journals of the dispatches of the runs, until all of them went through
+DISPATCH_JOURNAL_PREFIX = "scheduler_state/dispatch/"
+# Traces of the scheduler runs, written when the SCHEDULER_TRACING environment variable is set to 1
+TRACE_PREFIX = "scheduler_traces/"
+# Max number of shards leased by a single run, so that overlapping runs split the shards between them; None for all
+MAX_SHARDS_PER_RUN = None
+# Job types scheduled as a single shard, needed when the sum of their instance limits is above their total limit.
+# The other job types are sharded per instance type. Every run has to agree on the shards, so unlike the limits this
+# cannot be changed by the scheduler config, which is rejected if it would make the total limit of a sharded job
+# type binding.
+SINGLE_SHARD_JOB_TYPES = ()
+# Attempts at writing the ticket index when concurrent runs keep changing it
+STATE_WRITE_ATTEMPTS = 5
+# Number of ticket bodies downloaded ahead of the ticket being scheduled
+TICKET_PREFETCH_DEPTH = 8
 
 # SageMaker inference (hosting) instance limits
 P3_8XLARGE_INFERENCE = 0
@@ -30,3 +70,49 @@ INFERENCE_LIMIT = {
     "ml.c4.8xlarge": C4_8XLARGE_INFERENCE,
     "ml.p3.8xlarge": P3_8XLARGE_INFERENCE,
 }
+
+# Rules assigning an instance type to each image: (regular expression searched in the ECR URI, instance type),
+# the first matching rule wins
+INSTANCE_TYPE_RULES = (
+    ("(?=.*tensorflow)(?=.*gpu)", "ml.p3.8xlarge"),
+    ("tensorflow", "ml.c4.4xlarge"),
+    ("gpu", "ml.p2.8xlarge"),
+    ("", "ml.c4.8xlarge"),
+)
+
+# Config object overriding the limits and instance type rules above at runtime, in the bucket the function is
+# deployed with, and the time a cached config is used before checking it for changes
+SCHEDULER_CONFIG_KEY = "scheduler_state/config.json"
+CONFIG_REFRESH_SECONDS = 60
+
+# Shared boto3 client settings, reused across warm invocations
+AWS_MAX_POOL_CONNECTIONS = 25
+# max number of attempts per API call, including the first one
+AWS_MAX_ATTEMPTS = 5
+AWS_RETRY_MODE = "standard"
+
+# CloudWatch namespace of the metrics the lambdas print in Embedded Metric Format
+METRICS_NAMESPACE = "DLCTestScheduler"
+
+# CodeBuild project running the test jobs
+JOB_EXECUTOR_PROJECT_NAME = "DLCTestJobExecutor"
+# Job Executor builds are started concurrently, rate-limited with adaptive backoff on throttling
+CODEBUILD_MAX_CONCURRENT_STARTS = 8
+CODEBUILD_STARTS_PER_SECOND = 10
+CODEBUILD_MIN_STARTS_PER_SECOND = 0.5
+# Times a throttled or transiently failing start_build is retried, botocore retries are off for StartBuild
+CODEBUILD_START_RETRIES = 3
+
+# Exponential backoff between the scheduling tries of a ticket that could not be scheduled
+RETRY_BACKOFF_BASE_SECONDS = 120  # 2 mins
+RETRY_BACKOFF_MAX_SECONDS = 1800  # 30 mins
+# Number of tickets copied to the dead letter queue concurrently
+DEAD_LETTER_COPY_CONCURRENCY = 8
+
+# Resource pool entries older than this are reclaimed when no SageMaker job or endpoint accounts for them
+POOL_RECONCILIATION_GRACE_SECONDS = 600  # 10 mins
+# Longest a Job Executor build can run, the longest build timeout CodeBuild allows; entries of builds still in
+# progress are never reclaimed, and only builds started since then can be
+JOB_EXECUTOR_MAX_BUILD_SECONDS = 129600  # 36 hours
+# Number of SageMaker jobs and endpoints described concurrently by the reconciliation of the resource pool
+SAGEMAKER_DESCRIBE_CONCURRENCY = 8
@@ -1,2 +1,3 @@
-zip lambda.zip lambda_function.py constants.py
+python profile_cold_start.py lambda_function.py
+zip lambda.zip lambda_function.py constants.py batch_tickets.py build_dispatcher.py capacity.py clients.py cold_start.py dispatch_journal.py planner.py pool_reconciler.py run_control.py run_trace.py s3_utils.py scheduler_config.py scheduling_queue.py ticket_events.py ticket_index.py metrics.py
 aws lambda update-function-code --function-name DLCTestScheduler --zip-file fileb://lambda.zip
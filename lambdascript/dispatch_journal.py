@@ -0,0 +1,175 @@
+"""
+Dispatch journal: the write-ahead record of the Job Executor builds a run is about to start.
+Dispatching a ticket takes three writes to three services: start_build, the resource pool entry and the deletion of
+the ticket. A run killed or failing in between leaves a build running with the ticket still queued, and possibly no
+pool entry booking its capacity. Before starting any build, a run records its dispatches in a journal object; the
+journal is deleted once all of them went through. A journal left behind is resolved by the next run: dispatches whose
+build exists are completed, the others are rolled back, and their tickets stay queued.
+Every build carries the dispatch token of its ticket, both as the idempotency token of start_build and as an
+environment variable, so that the builds of a journal can be found in CodeBuild.
+"""
+import json
+import logging
+import time
+import uuid
+
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+import constants
+
+from run_control import CONDITIONAL_WRITE_CONFLICTS
+from s3_utils import iter_keys, prefetch_json_objects
+
+
+LOGGER = logging.getLogger(__name__)
+
+# environment variable of the Job Executor build holding the dispatch token of its ticket
+DISPATCH_TOKEN_VARIABLE = "DISPATCH_TOKEN"
+# max number of ids accepted by batch_get_builds, and returned by a page of list_builds_for_project
+BUILDS_PER_PAGE = 100
+
+
+def get_dispatch_token(ticket_key, ticket_body):
+    """
+    :param ticket_key: <string> key of the ticket
+    :param ticket_body: <dict> content of the ticket
+    :return: <string> token identifying the dispatch of the ticket, the same for every run dispatching it
+    """
+    return uuid.uuid5(uuid.NAMESPACE_URL, f"{ticket_key}#{ticket_body['TIMESTAMP']}").hex
+
+
+class DispatchJournal:
+    """
+    Journal of the dispatches of the current run, expiring with the shard leases of the run: the tickets of a
+    journal are only dispatched again by the next holder of their shard, which resolves the journal first.
+    """
+
+    def __init__(self, s3_client, bucket, run_id, leases, prefix=constants.DISPATCH_JOURNAL_PREFIX):
+        """
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param run_id: <string> unique id of the current run
+        :param leases: <ShardLeases> leases of the current run
+        :param prefix: <string> key prefix of the journal objects
+        """
+        self._s3_client = s3_client
+        self._bucket = bucket
+        self._leases = leases
+        self.key = f"{prefix}{run_id}.json"
+        self.recorded = False
+        self._created = None
+        self._dispatches = []
+
+    def _write(self, journal):
+        self._s3_client.put_object(Bucket=self._bucket, Key=self.key, Body=json.dumps(journal).encode("UTF-8"))
+
+    def record(self, dispatches):
+        """
+        Record the dispatches of the run before any of their builds is started
+
+        :param dispatches: <list> dispatches of the run, each a dict of TICKET_KEY, OBJECT_KEY, DISPATCH_TOKEN,
+        INSTANCE_TYPE, JOB_TYPE and INSTANCES_NUM
+        """
+        self._created = time.time()
+        self._dispatches = list(dispatches)
+        self._write({"CREATED": self._created, "EXPIRES": self._leases.expires(), "DISPATCHES": self._dispatches})
+        self.recorded = True
+
+    def close(self, completed, failed_deletes=()):
+        """
+        :param completed: <bool> True if every dispatch of the run went through, the journal is deleted;
+        otherwise it expires right away, to be resolved by the next run
+        :param failed_deletes: <iterable> keys the run could not delete; a dispatched ticket left on the queue would
+        be indexed and dispatched again, so the journal is kept for the next run to complete the dispatch
+        """
+        if not self.recorded:
+            return
+        failed_deletes = set(failed_deletes)
+        if completed and any(dispatch["OBJECT_KEY"] in failed_deletes for dispatch in self._dispatches):
+            LOGGER.warning("Dispatched tickets could not be deleted from the queue.")
+            completed = False
+        if completed:
+            self._s3_client.delete_object(Bucket=self._bucket, Key=self.key)
+        else:
+            LOGGER.warning(f"Run ended half-way through its dispatches, {self.key} is left for recovery.")
+            self._write({"CREATED": self._created, "EXPIRES": 0, "DISPATCHES": self._dispatches})
+        self.recorded = False
+
+
+def load_expired_journals(s3_client, bucket, prefix=constants.DISPATCH_JOURNAL_PREFIX):
+    """
+    Journals deleted by a concurrent run between the listing and their download are skipped.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param prefix: <string> key prefix of the journal objects
+    :return: <dict> key -> (content, ETag) of the journals of runs that ended without completing their dispatches
+    """
+    journals = {}
+    journal_keys = iter_keys(s3_client, bucket, prefix, suffix=".json")
+    for key, journal, etag in prefetch_json_objects(
+        s3_client, bucket, journal_keys, constants.TICKET_PREFETCH_DEPTH, skip_missing=True, with_etag=True
+    ):
+        # journals of live runs are resolved by the runs themselves
+        if journal["EXPIRES"] <= time.time():
+            journals[key] = (journal, etag)
+    return journals
+
+
+def rewrite_journal(s3_client, bucket, key, journal, etag, dispatches):
+    """
+    Keep only the given dispatches in a journal resolved in part, those of shards the current run does not hold.
+    The journal is only rewritten if it is unchanged since it was read; otherwise a concurrent run resolved it in part
+    as well, and the dispatches resolved by the current run are resolved once more by the next holder of their shard,
+    which completes or rolls them back the same way.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param key: <string> key of the journal
+    :param journal: <dict> content of the journal, as read
+    :param etag: <string> ETag of the journal, as read
+    :param dispatches: <list> dispatches left to resolve
+    :return: <bool> True if the journal was rewritten
+    """
+    try:
+        s3_client.put_object(
+            Bucket=bucket, Key=key, Body=json.dumps(dict(journal, DISPATCHES=dispatches)).encode("UTF-8"), IfMatch=etag
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in CONDITIONAL_WRITE_CONFLICTS + ("NoSuchKey",):
+            raise
+        LOGGER.info(f"{key} was changed by a concurrent run, its dispatches are left to the next holders.")
+        return False
+    return True
+
+
+def find_builds(cb_client, dispatch_tokens, since):
+    """
+    Find the Job Executor builds started for the given dispatch tokens, going through the builds of the project
+    from the latest back to the given time
+
+    :param cb_client: boto3 CodeBuild client
+    :param dispatch_tokens: <set> dispatch tokens to look for
+    :param since: <float> epoch time before which no build of the tokens was started
+    :return: <dict> dispatch token -> description of its build
+    """
+    since = datetime.fromtimestamp(since, timezone.utc)
+    builds = {}
+    kwargs = {"projectName": constants.JOB_EXECUTOR_PROJECT_NAME, "sortOrder": "DESCENDING"}
+    while len(builds) < len(dispatch_tokens):
+        response = cb_client.list_builds_for_project(**kwargs)
+        if not response.get("ids"):
+            break
+        page = cb_client.batch_get_builds(ids=response["ids"][:BUILDS_PER_PAGE])["builds"]
+        for build in page:
+            environment = {
+                variable["name"]: variable["value"] for variable in build["environment"]["environmentVariables"]
+            }
+            if environment.get(DISPATCH_TOKEN_VARIABLE) in dispatch_tokens:
+                builds[environment[DISPATCH_TOKEN_VARIABLE]] = build
+        if not response.get("nextToken") or min(build["startTime"] for build in page) < since:
+            break
+        kwargs["nextToken"] = response["nextToken"]
+    return builds
@@ -0,0 +1,580 @@
+"""
+In-memory stand-ins for the AWS clients used by the scheduler, so it can be tested and benchmarked offline.
+They implement the subset of the S3, CodeBuild and SageMaker APIs the scheduler calls, with the same request and
+response shapes and the same error codes, count every API call by operation name, and emit the botocore call events
+metrics.instrument_client hooks into.
+
+Usage:
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    ...
+    clients.set_client_provider(previous_provider)
+
+place_tickets puts request tickets on the queue of a fake S3, as their submitters would.
+"""
+import hashlib
+import io
+import json
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+
+import constants
+import metrics
+
+
+# image tested by the request tickets of the offline tests, run on ml.p3.8xlarge training instances
+TEST_IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04-example"
+)
+REQUEST_TICKETS_FOLDER = "request_tickets"
+
+
+def _client_error(code, message, operation_name):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation_name)
+
+
+class FakeEventEmitter:
+    """
+    Minimal stand-in for the botocore event system: handlers registered for "after-call" or "after-call.s3"
+    receive "after-call.s3.GetObject", together with the event name
+    """
+
+    def __init__(self):
+        # unique id -> (event name, handler)
+        self._handlers = {}
+
+    def register(self, event_name, handler, unique_id=None, **kwargs):
+        self._handlers[unique_id or id(handler)] = (event_name, handler)
+
+    def emit(self, event_name, **kwargs):
+        responses = []
+        for registered_name, handler in list(self._handlers.values()):
+            if event_name == registered_name or event_name.startswith(f"{registered_name}."):
+                responses.append((handler, handler(event_name=event_name, **kwargs)))
+        return responses
+
+
+class _FakeClient:
+    """
+    Base of the fake clients: counts API calls and emits the botocore before-call/needs-retry/after-call events around
+    them; every call is a single attempt
+    """
+
+    service_name = None
+
+    def __init__(self):
+        self.meta = SimpleNamespace(events=FakeEventEmitter(), region_name="us-west-2")
+        self.api_calls = Counter()
+        self._lock = threading.RLock()
+
+    def _call(self, operation_name, implementation, **kwargs):
+        with self._lock:
+            self.api_calls[operation_name] += 1
+        event_suffix = f"{self.service_name}.{operation_name}"
+        context = {}
+        self.meta.events.emit(f"before-call.{event_suffix}", params=kwargs, context=context)
+        try:
+            response = implementation(**kwargs)
+        except ClientError as e:
+            self.meta.events.emit(f"needs-retry.{event_suffix}", response=(None, e.response), attempts=1)
+            self.meta.events.emit(f"after-call.{event_suffix}", parsed=e.response, context=context)
+            raise
+        response.setdefault("ResponseMetadata", {"HTTPStatusCode": 200, "RetryAttempts": 0})
+        self.meta.events.emit(f"needs-retry.{event_suffix}", response=(None, response), attempts=1)
+        self.meta.events.emit(f"after-call.{event_suffix}", parsed=response, context=context)
+        return response
+
+
+class FakeS3Client(_FakeClient):
+    """
+    Thread-safe in-memory S3, holding the objects of any number of buckets
+    """
+
+    service_name = "s3"
+
+    def __init__(self):
+        super().__init__()
+        # (bucket, key) -> (body, last modified, ETag)
+        self.objects = {}
+        # (bucket, key) -> user metadata of the object
+        self.metadata = {}
+        # key prefix -> number of the next put_object calls under the prefix rejected with an InternalError
+        self.failed_puts = Counter()
+        # key prefix -> number of the next keys under the prefix reported as errors by delete_objects, and kept
+        self.failed_deletes = Counter()
+
+    def _get(self, bucket, key, operation_name):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise _client_error("NoSuchKey", "The specified key does not exist.", operation_name)
+
+    def _store(self, bucket, key, body, metadata=None):
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self._lock:
+            self.objects[(bucket, key)] = (body, datetime.now(timezone.utc), etag)
+            self.metadata[(bucket, key)] = dict(metadata or {})
+        return etag
+
+    def set_last_modified(self, bucket, key, last_modified):
+        """
+        Backdate an object, e.g. to make a resource pool entry look stale
+
+        :param bucket: <string> bucket name
+        :param key: <string> key of the object
+        :param last_modified: <datetime> timezone-aware modification time
+        """
+        body, _, etag = self.objects[(bucket, key)]
+        self.objects[(bucket, key)] = (body, last_modified, etag)
+
+    def keys(self, bucket, prefix=""):
+        """
+        :return: <list> sorted keys of the bucket under the prefix; not counted as an API call
+        """
+        with self._lock:
+            object_ids = list(self.objects)
+        return sorted(key for object_bucket, key in object_ids if object_bucket == bucket and key.startswith(prefix))
+
+    def put_object(self, **kwargs):
+        return self._call("PutObject", self._put_object, **kwargs)
+
+    def _put_object(self, Bucket, Key, Body=b"", Metadata=None, IfMatch=None, IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif hasattr(Body, "read"):
+            Body = Body.read()
+        # conditional writes: the condition is checked atomically with the write
+        with self._lock:
+            for prefix in self.failed_puts:
+                if Key.startswith(prefix) and self.failed_puts[prefix] > 0:
+                    self.failed_puts[prefix] -= 1
+                    raise _client_error("InternalError", "We encountered an internal error.", "PutObject")
+            current = self.objects.get((Bucket, Key))
+            if IfNoneMatch == "*" and current is not None:
+                raise _client_error("PreconditionFailed", "At least one of the pre-conditions failed.", "PutObject")
+            if IfMatch is not None:
+                if current is None:
+                    raise _client_error("NoSuchKey", "The specified key does not exist.", "PutObject")
+                if current[2] != IfMatch:
+                    raise _client_error("PreconditionFailed", "At least one of the pre-conditions failed.", "PutObject")
+            return {"ETag": self._store(Bucket, Key, bytes(Body), Metadata)}
+
+    def get_object(self, **kwargs):
+        return self._call("GetObject", self._get_object, **kwargs)
+
+    def _get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        body, last_modified, etag = self._get(Bucket, Key, "GetObject")
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise _client_error("304", "Not Modified", "GetObject")
+        return {
+            "Body": io.BytesIO(body),
+            "ETag": etag,
+            "LastModified": last_modified,
+            "ContentLength": len(body),
+            "Metadata": dict(self.metadata.get((Bucket, Key), {})),
+        }
+
+    def copy_object(self, **kwargs):
+        return self._call("CopyObject", self._copy_object, **kwargs)
+
+    def _copy_object(self, Bucket, Key, CopySource, Metadata=None, MetadataDirective="COPY", **kwargs):
+        body, _, _ = self._get(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+        if MetadataDirective != "REPLACE":
+            Metadata = self.metadata.get((CopySource["Bucket"], CopySource["Key"]))
+        etag = self._store(Bucket, Key, body, Metadata)
+        return {"CopyObjectResult": {"ETag": etag, "LastModified": self.objects[(Bucket, Key)][1]}}
+
+    def delete_object(self, **kwargs):
+        return self._call("DeleteObject", self._delete_object, **kwargs)
+
+    def _delete_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        # conditional deletes: the condition is checked atomically with the delete
+        with self._lock:
+            if IfMatch is not None:
+                current = self.objects.get((Bucket, Key))
+                if current is None:
+                    raise _client_error("NoSuchKey", "The specified key does not exist.", "DeleteObject")
+                if current[2] != IfMatch:
+                    raise _client_error(
+                        "PreconditionFailed", "At least one of the pre-conditions failed.", "DeleteObject"
+                    )
+            self.objects.pop((Bucket, Key), None)
+            self.metadata.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, **kwargs):
+        return self._call("DeleteObjects", self._delete_objects, **kwargs)
+
+    def _delete_objects(self, Bucket, Delete, **kwargs):
+        if len(Delete["Objects"]) > 1000:
+            raise _client_error("MalformedXML", "More than 1000 keys in a delete request.", "DeleteObjects")
+        deleted, errors = [], []
+        with self._lock:
+            for entry in Delete["Objects"]:
+                prefix = next((p for p in self.failed_deletes if entry["Key"].startswith(p)), None)
+                if prefix is not None and self.failed_deletes[prefix] > 0:
+                    self.failed_deletes[prefix] -= 1
+                    errors.append({"Key": entry["Key"], "Code": "InternalError", "Message": "Internal error."})
+                    continue
+                self.objects.pop((Bucket, entry["Key"]), None)
+                self.metadata.pop((Bucket, entry["Key"]), None)
+                deleted.append({"Key": entry["Key"]})
+        response = {}
+        if errors:
+            response["Errors"] = errors
+        if not Delete.get("Quiet"):
+            response["Deleted"] = deleted
+        return response
+
+    def list_objects_v2(self, **kwargs):
+        return self._call("ListObjectsV2", self._list_objects_v2, **kwargs)
+
+    def _list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, StartAfter=None, **kwargs):
+        keys = self.keys(Bucket, Prefix)
+        start_after = ContinuationToken or StartAfter
+        if start_after:
+            keys = [key for key in keys if key > start_after]
+        page_keys = keys[: min(MaxKeys, 1000)]
+
+        response = {"KeyCount": len(page_keys), "IsTruncated": len(keys) > len(page_keys), "Prefix": Prefix}
+        if page_keys:
+            response["Contents"] = []
+            for key in page_keys:
+                body, last_modified, etag = self.objects[(Bucket, key)]
+                response["Contents"].append(
+                    {"Key": key, "LastModified": last_modified, "ETag": etag, "Size": len(body)}
+                )
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page_keys[-1]
+        return response
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "list_objects_v2", f"Paginator {operation_name} not supported"
+        return _FakeListObjectsV2Paginator(self)
+
+
+class _FakeListObjectsV2Paginator:
+    def __init__(self, s3_client):
+        self._s3_client = s3_client
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get("PageSize", 1000)
+        continuation_token = None
+        while True:
+            if continuation_token:
+                kwargs["ContinuationToken"] = continuation_token
+            page = self._s3_client.list_objects_v2(MaxKeys=page_size, **kwargs)
+            yield page
+            continuation_token = page.get("NextContinuationToken")
+            if not continuation_token:
+                return
+
+
+class _FakeCodeBuildExceptions:
+    """
+    Modeled exceptions of the CodeBuild client, raised as ClientError subclasses like botocore does
+    """
+
+    def __init__(self):
+        for name in ("AccountLimitExceededException", "InvalidInputException", "ResourceNotFoundException"):
+            setattr(self, name, type(name, (ClientError,), {}))
+        self.ClientError = ClientError
+
+
+class FakeCodeBuildClient(_FakeClient):
+    """
+    In-memory CodeBuild that accepts builds up to a limit of concurrently running builds
+    """
+
+    service_name = "codebuild"
+
+    def __init__(
+        self, max_running_builds=None, project_names=("DLCTestJobExecutor",), throttled_starts=0, failed_starts=0
+    ):
+        """
+        :param max_running_builds: <int> account limit on running builds, unlimited if None
+        :param project_names: <iterable> names of the existing projects
+        :param throttled_starts: <int> number of the next start_build calls rejected with a ThrottlingException
+        :param failed_starts: <int> number of the next start_build calls failing with an InternalFailure (HTTP 500)
+        """
+        super().__init__()
+        self.exceptions = _FakeCodeBuildExceptions()
+        self.max_running_builds = max_running_builds
+        self.project_names = set(project_names)
+        # build id -> start_build request
+        self.builds = {}
+        # build id -> start time of the build
+        self.start_times = {}
+        self.running_build_ids = set()
+        self.throttled_starts = throttled_starts
+        self.failed_starts = failed_starts
+
+    def start_build(self, **kwargs):
+        return self._call("StartBuild", self._start_build, **kwargs)
+
+    def _start_build(self, projectName, idempotencyToken=None, **kwargs):
+        with self._lock:
+            # a token is valid for 5 minutes, a repeated request returns the build started by the first one
+            for build_id, build in self.builds.items():
+                if idempotencyToken is not None and build.get("idempotencyToken") == idempotencyToken:
+                    if (datetime.now(timezone.utc) - self.start_times[build_id]).total_seconds() < 300:
+                        return {"build": self._describe_build(build_id)}
+            if self.throttled_starts > 0:
+                self.throttled_starts -= 1
+                raise _client_error("ThrottlingException", "Rate exceeded", "StartBuild")
+            if self.failed_starts > 0:
+                self.failed_starts -= 1
+                raise ClientError(
+                    {
+                        "Error": {"Code": "InternalFailure", "Message": "An internal error occurred."},
+                        "ResponseMetadata": {"HTTPStatusCode": 500},
+                    },
+                    "StartBuild",
+                )
+            if projectName not in self.project_names:
+                raise self.exceptions.ResourceNotFoundException(
+                    {"Error": {"Code": "ResourceNotFoundException", "Message": f"{projectName} not found"}},
+                    "StartBuild",
+                )
+            if self.max_running_builds is not None and len(self.running_build_ids) >= self.max_running_builds:
+                raise self.exceptions.AccountLimitExceededException(
+                    {"Error": {"Code": "AccountLimitExceededException", "Message": "Too many running builds"}},
+                    "StartBuild",
+                )
+            build_id = f"{projectName}:{len(self.builds) + 1:08d}"
+            self.builds[build_id] = dict(kwargs, projectName=projectName)
+            if idempotencyToken is not None:
+                self.builds[build_id]["idempotencyToken"] = idempotencyToken
+            self.start_times[build_id] = datetime.now(timezone.utc)
+            self.running_build_ids.add(build_id)
+            return {"build": self._describe_build(build_id)}
+
+    def _describe_build(self, build_id):
+        return {
+            "id": build_id,
+            "projectName": self.builds[build_id]["projectName"],
+            "buildStatus": "IN_PROGRESS" if build_id in self.running_build_ids else "SUCCEEDED",
+            "startTime": self.start_times[build_id],
+            "environment": {"environmentVariables": self.builds[build_id].get("environmentVariablesOverride", [])},
+        }
+
+    def list_builds_for_project(self, **kwargs):
+        return self._call("ListBuildsForProject", self._list_builds_for_project, **kwargs)
+
+    def _list_builds_for_project(self, projectName, sortOrder="DESCENDING", nextToken=None, **kwargs):
+        with self._lock:
+            build_ids = sorted(
+                (build_id for build_id, build in self.builds.items() if build["projectName"] == projectName),
+                reverse=sortOrder == "DESCENDING",
+            )
+        start = int(nextToken or 0)
+        response = {"ids": build_ids[start : start + 100]}
+        if start + 100 < len(build_ids):
+            response["nextToken"] = str(start + 100)
+        return response
+
+    def batch_get_builds(self, **kwargs):
+        return self._call("BatchGetBuilds", self._batch_get_builds, **kwargs)
+
+    def _batch_get_builds(self, ids, **kwargs):
+        with self._lock:
+            return {
+                "builds": [self._describe_build(build_id) for build_id in ids if build_id in self.builds],
+                "buildsNotFound": [build_id for build_id in ids if build_id not in self.builds],
+            }
+
+    def finish_build(self, build_id):
+        """
+        Mark a build as completed, freeing a slot of the account limit
+
+        :param build_id: <string> id of the build
+        """
+        with self._lock:
+            self.running_build_ids.discard(build_id)
+
+    def build_environment(self, build_id):
+        """
+        :return: <dict> name -> value of the environment variables overridden for the build
+        """
+        overrides = self.builds[build_id].get("environmentVariablesOverride", [])
+        return {variable["name"]: variable["value"] for variable in overrides}
+
+
+class FakeSageMakerClient(_FakeClient):
+    """
+    In-memory SageMaker holding training jobs and endpoints, for the reconciliation of the resource pool
+    """
+
+    service_name = "sagemaker"
+
+    def __init__(self, page_size=100):
+        """
+        :param page_size: <int> max number of results per page of the List* operations
+        """
+        super().__init__()
+        self.page_size = page_size
+        # name -> {"status", "instance_type", "instance_count"}
+        self.training_jobs = {}
+        self.endpoints = {}
+
+    def add_training_job(self, name, instance_type, instance_count=1, status="InProgress"):
+        self.training_jobs[name] = {"status": status, "instance_type": instance_type, "instance_count": instance_count}
+
+    def add_endpoint(self, name, instance_type, instance_count=1, status="InService"):
+        self.endpoints[name] = {"status": status, "instance_type": instance_type, "instance_count": instance_count}
+
+    def _page(self, results, result_key, NextToken=None):
+        start = int(NextToken or 0)
+        response = {result_key: results[start : start + self.page_size]}
+        if start + self.page_size < len(results):
+            response["NextToken"] = str(start + self.page_size)
+        return response
+
+    def list_training_jobs(self, **kwargs):
+        return self._call("ListTrainingJobs", self._list_training_jobs, **kwargs)
+
+    def _list_training_jobs(self, StatusEquals=None, NextToken=None, **kwargs):
+        summaries = [
+            {"TrainingJobName": name, "TrainingJobStatus": job["status"]}
+            for name, job in sorted(self.training_jobs.items())
+            if StatusEquals is None or job["status"] == StatusEquals
+        ]
+        return self._page(summaries, "TrainingJobSummaries", NextToken)
+
+    def describe_training_job(self, **kwargs):
+        return self._call("DescribeTrainingJob", self._describe_training_job, **kwargs)
+
+    def _describe_training_job(self, TrainingJobName, **kwargs):
+        if TrainingJobName not in self.training_jobs:
+            raise _client_error("ValidationException", "Requested resource not found.", "DescribeTrainingJob")
+        job = self.training_jobs[TrainingJobName]
+        return {
+            "TrainingJobName": TrainingJobName,
+            "TrainingJobStatus": job["status"],
+            "ResourceConfig": {"InstanceType": job["instance_type"], "InstanceCount": job["instance_count"]},
+        }
+
+    def list_endpoints(self, **kwargs):
+        return self._call("ListEndpoints", self._list_endpoints, **kwargs)
+
+    def _list_endpoints(self, NextToken=None, **kwargs):
+        summaries = [
+            {"EndpointName": name, "EndpointStatus": endpoint["status"]}
+            for name, endpoint in sorted(self.endpoints.items())
+        ]
+        return self._page(summaries, "Endpoints", NextToken)
+
+    def describe_endpoint(self, **kwargs):
+        return self._call("DescribeEndpoint", self._describe_endpoint, **kwargs)
+
+    def _describe_endpoint(self, EndpointName, **kwargs):
+        if EndpointName not in self.endpoints:
+            raise _client_error("ValidationException", f"Could not find endpoint {EndpointName}.", "DescribeEndpoint")
+        # each endpoint is served by an endpoint config of the same name
+        return {
+            "EndpointName": EndpointName,
+            "EndpointConfigName": EndpointName,
+            "EndpointStatus": self.endpoints[EndpointName]["status"],
+        }
+
+    def describe_endpoint_config(self, **kwargs):
+        return self._call("DescribeEndpointConfig", self._describe_endpoint_config, **kwargs)
+
+    def _describe_endpoint_config(self, EndpointConfigName, **kwargs):
+        if EndpointConfigName not in self.endpoints:
+            message = f"Could not find endpoint configuration {EndpointConfigName}."
+            raise _client_error("ValidationException", message, "DescribeEndpointConfig")
+        endpoint = self.endpoints[EndpointConfigName]
+        return {
+            "EndpointConfigName": EndpointConfigName,
+            "ProductionVariants": [
+                {
+                    "VariantName": "AllTraffic",
+                    "InstanceType": endpoint["instance_type"],
+                    "InitialInstanceCount": endpoint["instance_count"],
+                }
+            ],
+        }
+
+
+class FakeClientProvider:
+    """
+    Client provider handing out fake clients; a drop-in for clients.ClientProvider
+    """
+
+    def __init__(self, **fake_clients):
+        """
+        :param fake_clients: service name -> fake client; S3, CodeBuild and SageMaker fakes are created if not given
+        """
+        fake_clients.setdefault("s3", FakeS3Client())
+        fake_clients.setdefault("codebuild", FakeCodeBuildClient())
+        fake_clients.setdefault("sagemaker", FakeSageMakerClient())
+        for fake_client in fake_clients.values():
+            metrics.instrument_client(fake_client)
+        self.fake_clients = fake_clients
+
+    def client(self, service_name, max_attempts=None):
+        # every call of a fake client is a single attempt, retry settings do not apply
+        return self.fake_clients[service_name]
+
+    def api_calls(self):
+        """
+        :return: <Counter> "(service) (operation)" -> number of calls made so far
+        """
+        calls = Counter()
+        for service_name, fake_client in self.fake_clients.items():
+            for operation_name, count in fake_client.api_calls.items():
+                calls[f"{service_name} {operation_name}"] += count
+        return calls
+
+    def reset_api_calls(self):
+        for fake_client in self.fake_clients.values():
+            fake_client.api_calls.clear()
+
+
+class FakeLambdaContext:
+    """
+    Lambda context reporting the remaining time of an invocation with the given timeout
+    """
+
+    def __init__(self, timeout_seconds=900):
+        self._end_time = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self._end_time - time.monotonic()) * 1000)
+
+
+def place_tickets(s3_client, name, num_of_tickets, image_uri=TEST_IMAGE_URI, scheduling_tries=0):
+    """
+    Put request tickets for one instance each on the request queue of a fake S3
+
+    :param s3_client: <FakeS3Client> fake S3 holding the request queue
+    :param name: <string> name of the tickets, numbered from 0 in their keys
+    :param num_of_tickets: <int> number of tickets to place
+    :param image_uri: <string> ECR URI of the image the tickets test
+    :param scheduling_tries: <int> number of times the tickets have already been tried
+    :return: <dict> key -> body of the tickets placed, in the order they were placed
+    """
+    request_time = datetime.now().strftime(constants.TIMESTAMP_FORMAT)
+    tickets = {}
+    for i in range(num_of_tickets):
+        # naming convention of request tickets: {7 digit name}-{ticket name counter}_(datetime string)
+        ticket_key = f"{REQUEST_TICKETS_FOLDER}/{name}-{str(i)}_{request_time}.json"
+        content = {
+            "CONTEXT": "PR",
+            "TIMESTAMP": request_time,
+            "ECR-URI": image_uri,
+            "RETURN-SQS-URL": "DUMMY_SQS_URL",
+            "SCHEDULING_TRIES": scheduling_tries,
+            "INSTANCES_NUM": 1,
+            "TIMEOUT_LIMIT": 14400,
+        }
+        s3_client.put_object(Bucket=constants.BUCKET_NAME, Key=ticket_key, Body=json.dumps(content).encode("UTF-8"))
+        tickets[ticket_key] = content
+    return tickets
@@ -1,24 +1,52 @@
 import json
 import logging
 import os
-import re
+import random
 import sys
+import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import boto3
-import boto3.exceptions
-from functools import cmp_to_key
+from botocore.exceptions import ClientError
 
+# imported first, so that cold-start profiling sees the imports below
+import cold_start
 import constants
+import metrics
+import run_trace
+import scheduler_config
+
+from batch_tickets import get_duplicate_entry_ids, is_batch, read_batch_entry, rewrite_batches, split_batch
+from build_dispatcher import BUILD_FAILED, BUILD_STARTED, BuildDispatcher
+from capacity import ACTIVE_STATUSES, CapacityLedger, get_pool_key
+from clients import get_client_provider
+from dispatch_journal import (
+    DISPATCH_TOKEN_VARIABLE,
+    DispatchJournal,
+    find_builds,
+    get_dispatch_token,
+    load_expired_journals,
+    rewrite_journal,
+)
+from s3_utils import BatchDeleter, iter_keys, iter_objects, prefetch_json_objects, read_json_object
+from planner import get_next_eligible_time, is_eligible, plan_run
+from pool_reconciler import reconcile_resource_pool
+from run_control import Deadline, ResumeCursor, ShardLeases
+from scheduling_queue import SchedulingQueue
+from ticket_events import get_completed_builds, get_created_tickets
+from ticket_index import TicketIndex
 
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
 LOGGER.addHandler(logging.StreamHandler(sys.stdout))
 
+# fields of the index entry of a ticket holding its retry state, written into its dead letter ticket
+RETRY_STATE_FIELDS = ("SCHEDULING_TRIES", "NEXT_ELIGIBLE")
 
-def update_resource_pool(ticket_key, instance_type, num_of_instances, job_type):
+
+def update_resource_pool(ticket_key, instance_type, num_of_instances, job_type, ledger=None):
     """
     Update the S3 resource pool for usage of SageMaker resources; status = preparing.
     Naming convention of resource pool json: (request ticket name)#(num of instances)-preparing.json
@@ -27,9 +55,9 @@ def update_resource_pool(ticket_key, instance_type, num_of_instances, job_type):
     :param job_type: <string> (training/inference)
     :param instance_type: ml.p3.8xlarge/ml.c4.4xlarge/ml.p2.8xlarge/ml.c4.8xlarge
     :param num_of_instances: number of instances required
+    :param ledger: <CapacityLedger> capacity ledger of the current run, booked alongside the resource pool
     """
-    s3_client = boto3.client("s3")
-    s3_resource = boto3.resource("s3")
+    s3_client = get_client_provider().client("s3")
 
     # create the in-progress pool ticket content
     pool_ticket_content = {
@@ -41,79 +69,42 @@ def update_resource_pool(ticket_key, instance_type, num_of_instances, job_type):
 
     # create json file content and upload to S3
     # naming convention of resource-pool tickets: (request ticket name)#(num of instances)-(status).json
-    filename = f"{ticket_key.split('/')[-1].split('.')[0]}#{num_of_instances}-preparing.json"
-    s3_client.put_object(Bucket=constants.BUCKET_NAME, Key=f"resource_pool/{instance_type}-{job_type}/{filename}")
-    S3_ticket_object = s3_resource.Object(constants.BUCKET_NAME, f"resource_pool/{instance_type}-{job_type}/{filename}")
-    S3_ticket_object.put(Body=bytes(json.dumps(pool_ticket_content).encode("UTF-8")))
+    s3_client.put_object(
+        Bucket=constants.BUCKET_NAME,
+        Key=get_pool_key(ticket_key, instance_type, job_type, num_of_instances, "preparing"),
+        Body=json.dumps(pool_ticket_content).encode("UTF-8"),
+    )
+
+    if ledger is not None:
+        ledger.book(instance_type, job_type, num_of_instances)
 
 
 def assign_sagemaker_instance_type(image):
     """
-    Assign the instance type that the input image needs for testing
+    Assign the instance type that the input image needs for testing, from the instance type rules of the config
 
     :param image: <string> ECR URI
     :return: <string> type of instance used by the image
     """
-    if "tensorflow" in image:
-        return "ml.p3.8xlarge" if "gpu" in image else "ml.c4.4xlarge"
-    else:
-        return "ml.p2.8xlarge" if "gpu" in image else "ml.c4.8xlarge"
-
-
-def check_sagemaker_instance_limit(image):
-    """
-    Check the sagemaker instance limit that the input image uses
-
-    :param image: <string >ECR URI
-    :return: <int> limit on the sagemaker instance type required by testing of the input image
-    """
-    assert (
-        "training" in image or "inference" in image
-    ), "Image not valid. Image URI must contain 'training' or 'inference'."
-
-    instance_type = assign_sagemaker_instance_type(image)
-    if "training" in image:
-        return constants.TRAINING_LIMIT[instance_type]
-    else:
-        return constants.INFERENCE_LIMIT[instance_type]
-
-
-def get_num_instances_running(instance_type, job_type):
-    """
-    Query the number of a specific instance type currently running by SageMaker
-
-    :param instance_type: <string> type of instance required
-    :param job_type: <string> type of the job (training/inference)
-    :return: number of relevant instances currently in use
-    """
-    s3_client = boto3.client("s3")
-    objects = s3_client.list_objects(Bucket=constants.BUCKET_NAME, Prefix=f"resource_pool/{instance_type}-{job_type}/")
-    num_instances_running = 0
-    re_pattern = re.compile(".*\#(\d)-.*")
-
-    for entry in objects["Contents"]:
-        if entry["Key"].endswith("preparing.json") or entry["Key"].endswith("running.json"):
-            instances_required_by_entry = int(re_pattern.match(entry["Key"]).group(1))
-            num_instances_running += instances_required_by_entry
-
-    return num_instances_running
+    return scheduler_config.get_instance_type(image)
 
 
-def trigger_build(image_uri, context, return_sqs_url, ticket_key, num_of_instances):
+def get_build_request(
+    image_uri, context, return_sqs_url, ticket_key, num_of_instances, instance_type, job_type, dispatch_token=None
+):
     """
-    Trigger the Job Executor CodeBuild project with appropriate environment variables
-
     :param image_uri: ECR URI
     :param context: Build Context
     :param return_sqs_url: SQS return queue url
     :param ticket_key: Key of the request ticket
-    :param instance_type: Instance type requested by the test job
     :param num_of_instances: Number of instances required by the test job
-    :return: <Bool> True or False to indicate if triggering Job Executor Succeeded
+    :param instance_type: <string> instance type booked for the test job
+    :param job_type: <string> (training/inference)
+    :param dispatch_token: <string> dispatch token of the ticket, makes start_build idempotent
+    :return: <dict> start_build arguments running the Job Executor with appropriate environment variables
     """
-    cb_client = boto3.client("codebuild")
     build = {
-        "projectName": "DLCTestJobExecutor",
+        "projectName": constants.JOB_EXECUTOR_PROJECT_NAME,
         "environmentVariablesOverride": [
             {"name": "PYTHONBUFFERED", "value": "1", "type": "PLAINTEXT"},
             {"name": "REGION", "value": "us-west-2", "type": "PLAINTEXT"},
@@ -123,20 +114,17 @@ def trigger_build(image_uri, context, return_sqs_url, ticket_key, num_of_instanc
             {"name": "RETURN_SQS_URL", "value": return_sqs_url, "type": "PLAINTEXT"},
             {"name": "TICKET_KEY", "value": ticket_key, "type": "PLAINTEXT"},
             {"name": "NUM_INSTANCES", "value": str(num_of_instances), "type": "PLAINTEXT"},
+            # the resource pool entry is released from these once the build completes, whatever the rules by then
+            {"name": "INSTANCE_TYPE", "value": instance_type, "type": "PLAINTEXT"},
+            {"name": "JOB_TYPE", "value": job_type, "type": "PLAINTEXT"},
         ],
     }
-
-    try:
-        cb_client.start_build(**build)
-        return True
-
-    except cb_client.exceptions.InvalidInputException as e:
-        LOGGER.warning(f"Invalid inputs when starting Job Executor: {e}")
-    except cb_client.exceptions.ResourceNotFoundException as e:
-        LOGGER.warning(f"Job Executor CodeBuild project not found: {e}")
-    except cb_client.exceptions.AccountLimitExceededException as e:
-        LOGGER.warning(f"Job Executor CodeBuild project could not run, account limit exceeded: {e}")
-    return False
+    if dispatch_token is not None:
+        build["idempotencyToken"] = dispatch_token
+        build["environmentVariablesOverride"].append(
+            {"name": DISPATCH_TOKEN_VARIABLE, "value": dispatch_token, "type": "PLAINTEXT"}
+        )
+    return build
 
 
 def delete_ticket(bucket, key):
@@ -146,121 +134,844 @@ def delete_ticket(bucket, key):
     :param bucket: <string> bucket name
     :param key: <string> key to the target file
     """
-    s3_client = boto3.client("s3")
+    s3_client = get_client_provider().client("s3")
 
     s3_client.delete_object(Bucket=bucket, Key=key)
 
 
-def update_ticket(ticket_key, ticket_body):
+def copy_to_dead_letter_queue(ticket_key, reason, ticket_entry=None, ticket_body=None):
+    """
+    Write the request ticket to the dead letter queue, with the retry state of its index entry (SCHEDULING_TRIES and
+    NEXT_ELIGIBLE) merged into its body: the retry state is kept in the index, not in the ticket object.
+    The reason, and the instance type and job type when known, are attached as object metadata, for the
+    compaction of the dead letter queue.
+    Naming convention of dead letter tickets: (request ticket name)-(reason).json
+
+    :param ticket_key: <string> key of the ticket
+    :param reason: <string> reason of the scheduling failure (maxRetries/timeout)
+    :param ticket_entry: <dict> index entry or body of the ticket
+    :param ticket_body: <dict> body of the ticket, downloaded if not given; read from its batch for a batch entry
+    :return: <string> file name of the dead letter ticket
+    """
+    s3_client = get_client_provider().client("s3")
+
+    metadata = {"reason": reason}
+    if ticket_entry is not None and "INSTANCE_TYPE" in ticket_entry:
+        metadata.update({"instance-type": ticket_entry["INSTANCE_TYPE"], "job-type": ticket_entry["JOB_TYPE"]})
+
+    if ticket_body is None:
+        if ticket_entry is not None and "BATCH_KEY" in ticket_entry:
+            ticket_body = read_batch_entry(s3_client, constants.BUCKET_NAME, ticket_entry["BATCH_KEY"], ticket_key)
+        else:
+            ticket_body = read_json_object(s3_client, constants.BUCKET_NAME, ticket_key)
+    ticket_body = dict(ticket_body)
+    if ticket_entry is not None:
+        ticket_body.update({field: ticket_entry[field] for field in RETRY_STATE_FIELDS if field in ticket_entry})
+
+    dead_letter_filename = f"{ticket_key.split('/')[-1].split('.')[0]}-{reason}.json"
+    s3_client.put_object(
+        Bucket=constants.BUCKET_NAME,
+        Key=f"dead_letter_queue/{dead_letter_filename}",
+        Body=json.dumps(ticket_body).encode("UTF-8"),
+        Metadata=metadata,
+    )
+    return dead_letter_filename
+
+
+def move_to_dead_letter_queue(ticket_key, reason, deleter=None, ticket_entry=None):
+    """
+    Move the request ticket to the dead letter queue
+
+    :param ticket_key: <string> key of the ticket
+    :param reason: <string> reason of the scheduling failure (maxRetries/timeout)
+    :param deleter: <BatchDeleter> collects the deletion of the request ticket, deleted right away if not given
+    :param ticket_entry: <dict> index entry or body of the ticket
+    """
+    dead_letter_filename = copy_to_dead_letter_queue(ticket_key, reason, ticket_entry)
+    # entries of a batch ticket are dropped from their batch through the ticket index
+    if ticket_entry is None or "BATCH_KEY" not in ticket_entry:
+        if deleter is not None:
+            deleter.add(ticket_key)
+        else:
+            delete_ticket(constants.BUCKET_NAME, ticket_key)
+
+    metrics.get_recorder().increment("TicketsDeadLettered")
+    run_trace.get_trace().record_decision(ticket_key, run_trace.DEAD_LETTERED)
+    LOGGER.warning(f"Ticket {dead_letter_filename} is moved to the dead letter queue.")
+
+
+def get_dead_letter_reason(ticket_body, now=None):
+    """
+    :param ticket_body: <dict> body or index entry of the ticket, holding SCHEDULING_TRIES, TIMESTAMP and TIMEOUT_LIMIT
+    :param now: <datetime> current time, defaults to now
+    :return: <string> reason to move the ticket to the dead letter queue (maxRetries/timeout), or None
+    """
+    if ticket_body["SCHEDULING_TRIES"] >= constants.MAX_SCHEDULING_RETRIES:
+        return "maxRetries"
+    request_time = datetime.strptime(ticket_body["TIMESTAMP"], constants.TIMESTAMP_FORMAT)
+    if ((now or datetime.now()) - request_time).total_seconds() > ticket_body["TIMEOUT_LIMIT"]:
+        return "timeout"
+    return None
+
+
+def update_ticket(ticket_key, ticket_body, deleter=None, index=None):
     """
     Update the request ticket: if constants.MAX_SCHEDULING_RETRIES or timeout limit has been reached,
     move to dead letter queue.
     Otherwise add one to SCHEDULING_TRIES in the ticket.
+    When a ticket index is given, the retry state is recorded in the index and the ticket object is left untouched,
+    along with the time the ticket is next eligible for a scheduling try, backing off exponentially.
 
     :param ticket_key: <string> key of the ticket
-    :param ticket_body: <dict> body of the ticket
+    :param ticket_body: <dict> body or index entry of the ticket, holding SCHEDULING_TRIES, TIMESTAMP and TIMEOUT_LIMIT
+    :param deleter: <BatchDeleter> collects the deletion of tickets moved to the dead letter queue
+    :param index: <TicketIndex> ticket index of the current run
     """
-    s3_client = boto3.client("s3")
-    s3_resource = boto3.resource("s3")
+    s3_client = get_client_provider().client("s3")
 
     num_of_tries = ticket_body["SCHEDULING_TRIES"]
-    request_time = ticket_body["TIMESTAMP"]
-    timeout_limit = ticket_body["TIMEOUT_LIMIT"]
-
-    # move to the dead letter queue, max retries reached
-    if num_of_tries >= constants.MAX_SCHEDULING_RETRIES:
-        s3_client.delete_object(Bucket=constants.BUCKET_NAME, Key=ticket_key)
-        dead_letter_filename = f"{ticket_key.split('/')[-1].split('.')[0]}-maxRetries.json"
-        s3_client.put_object(Bucket=constants.BUCKET_NAME, Key=f"dead_letter_queue/{dead_letter_filename}")
-        S3_ticket_object = s3_resource.Object(constants.BUCKET_NAME, f"dead_letter_queue/{dead_letter_filename}")
-        S3_ticket_object.put(Body=bytes(json.dumps(ticket_body).encode("UTF-8")))
-
-        LOGGER.warning(f"Ticket {dead_letter_filename} is moved to the dead letter queue.")
-
-    # move to dead letter queue, timeout limit reached
-    elif (datetime.now() - datetime.strptime(request_time, "%Y-%m-%d-%H-%M-%S")).total_seconds() > timeout_limit:
-        s3_client.delete_object(Bucket=constants.BUCKET_NAME, Key=ticket_key)
-        dead_letter_filename = f"{ticket_key.split('/')[-1].split('.')[0]}-timeout.json"
-        s3_client.put_object(Bucket=constants.BUCKET_NAME, Key=f"dead_letter_queue/{dead_letter_filename}")
-        S3_ticket_object = s3_resource.Object(constants.BUCKET_NAME, f"dead_letter_queue/{dead_letter_filename}")
-        S3_ticket_object.put(Body=bytes(json.dumps(ticket_body).encode("UTF-8")))
-
-        LOGGER.warning(f"Ticket {dead_letter_filename} is moved to the dead letter queue.")
-
-    # update the number of retries
+    dead_letter_reason = get_dead_letter_reason(ticket_body)
+
+    # move to the dead letter queue, max retries or timeout limit reached
+    if dead_letter_reason is not None:
+        move_to_dead_letter_queue(ticket_key, dead_letter_reason, deleter=deleter, ticket_entry=ticket_body)
+        if index is not None:
+            index.remove(ticket_key)
+
+    # update the number of retries in the index
+    elif index is not None:
+        index.update(
+            ticket_key, SCHEDULING_TRIES=num_of_tries + 1, NEXT_ELIGIBLE=get_next_eligible_time(num_of_tries + 1)
+        )
+        metrics.get_recorder().increment("TicketsRequeued")
+
+    # update the number of retries in the ticket
     else:
+        metrics.get_recorder().increment("TicketsRequeued")
         ticket_body["SCHEDULING_TRIES"] = num_of_tries + 1
         filename = os.path.basename(ticket_key)
-        s3_client.put_object(Bucket=constants.BUCKET_NAME, Key=f"request_tickets/{filename}")
-        S3_ticket_object = s3_resource.Object(constants.BUCKET_NAME, f"request_tickets/{filename}")
-        S3_ticket_object.put(Body=bytes(json.dumps(ticket_body).encode("UTF-8")))
+        s3_client.put_object(
+            Bucket=constants.BUCKET_NAME,
+            Key=f"request_tickets/{filename}",
+            Body=json.dumps(ticket_body).encode("UTF-8"),
+        )
+
+
+def account_blocked_tickets(ticket_keys, index, deleter, deadline):
+    """
+    Retry accounting of all the tickets blocked in a run in one step, with the same outcome as update_ticket on
+    each of them: the retry state is updated in the index, and the dead letter copies are made concurrently.
+
+    :param ticket_keys: <list> keys of the blocked tickets
+    :param index: <TicketIndex> ticket index of the current run
+    :param deleter: <BatchDeleter> collects the deletion of tickets moved to the dead letter queue
+    :param deadline: <Deadline> time budget of the current run
+    :return: <list> keys of the tickets handled before the deadline
+    """
+    now = datetime.now()
+    # tickets with the same number of tries back off until the same time
+    next_eligible_times = {}
+    # key -> reason of the tickets moved to the dead letter queue
+    dead_letter_reasons = {}
+    handled_keys = []
+
+    for ticket_key in ticket_keys:
+        if deadline.expired():
+            break
+        ticket_entry = index.get(ticket_key)
+        dead_letter_reason = get_dead_letter_reason(ticket_entry, now)
+        if dead_letter_reason is not None:
+            dead_letter_reasons[ticket_key] = dead_letter_reason
+        else:
+            num_of_tries = ticket_entry["SCHEDULING_TRIES"] + 1
+            if num_of_tries not in next_eligible_times:
+                next_eligible_times[num_of_tries] = get_next_eligible_time(num_of_tries, now)
+            index.update(ticket_key, SCHEDULING_TRIES=num_of_tries, NEXT_ELIGIBLE=next_eligible_times[num_of_tries])
+            run_trace.get_trace().record_decision(ticket_key, run_trace.BLOCKED)
+        handled_keys.append(ticket_key)
+    metrics.get_recorder().increment("TicketsRequeued", len(handled_keys) - len(dead_letter_reasons))
+
+    if dead_letter_reasons:
+        # the bodies are downloaded ahead of the copies, each batch once for all of its entries
+        ticket_bodies = read_ticket_bodies(get_client_provider().client("s3"), index, list(dead_letter_reasons))
+        dead_letter_keys = []
+        for ticket_key in dead_letter_reasons:
+            if ticket_key in ticket_bodies:
+                dead_letter_keys.append(ticket_key)
+            # removed by its submitter since it was indexed
+            else:
+                LOGGER.warning(f"Ticket {ticket_key} no longer exists, skipping it.")
+                remove_ticket(ticket_key, index, deleter)
+        with ThreadPoolExecutor(max_workers=constants.DEAD_LETTER_COPY_CONCURRENCY) as executor:
+            dead_letter_filenames = list(
+                executor.map(
+                    copy_to_dead_letter_queue,
+                    dead_letter_keys,
+                    [dead_letter_reasons[ticket_key] for ticket_key in dead_letter_keys],
+                    [index.get(ticket_key) for ticket_key in dead_letter_keys],
+                    [ticket_bodies[ticket_key] for ticket_key in dead_letter_keys],
+                )
+            )
+        # the request tickets are only deleted once all of their copies went through
+        for ticket_key, dead_letter_filename in zip(dead_letter_keys, dead_letter_filenames):
+            remove_ticket(ticket_key, index, deleter)
+            run_trace.get_trace().record_decision(ticket_key, run_trace.DEAD_LETTERED)
+            LOGGER.warning(f"Ticket {dead_letter_filename} is moved to the dead letter queue.")
+        metrics.get_recorder().increment("TicketsDeadLettered", len(dead_letter_keys))
+
+    return handled_keys
+
+
+def remove_ticket(ticket_key, index, deleter):
+    """
+    Take a ticket that left the queue off the index, and delete its object.
+    Entries of a batch ticket have no object of their own, they are dropped from their batch by rewrite_batches.
+
+    :param ticket_key: <string> key of the ticket
+    :param index: <TicketIndex> ticket index of the current run
+    :param deleter: <BatchDeleter> collects the deletion of the ticket
+    """
+    if not index.is_batch_entry(ticket_key):
+        deleter.add(ticket_key)
+    index.remove(ticket_key)
+
 
+def read_ticket_bodies(s3_client, index, ticket_keys):
+    """
+    Download the bodies of indexed tickets; a batch ticket is downloaded once for all of its entries
+
+    :param s3_client: boto3 S3 client
+    :param index: <TicketIndex> ticket index of the current run
+    :param ticket_keys: <list> keys of the tickets
+    :return: <dict> key -> body of the tickets whose object still exists
+    """
+    object_keys = list(dict.fromkeys(index.get_object_key(ticket_key) for ticket_key in ticket_keys))
+    ticket_bodies = {}
+    for object_key, ticket_body in prefetch_json_objects(
+        s3_client, constants.BUCKET_NAME, object_keys, constants.TICKET_PREFETCH_DEPTH, skip_missing=True
+    ):
+        if is_batch(ticket_body):
+            ticket_bodies.update(split_batch(object_key, ticket_body))
+        else:
+            ticket_bodies[object_key] = ticket_body
+    return ticket_bodies
 
-def check_timeout(start_time):
+
+def get_job_type(image):
+    """
+    :param image: <string> ECR URI
+    :return: <string> type of the job testing the image (training/inference)
     """
-    Check if time since the start_time has exceeded TIMEOUT_LIMIT_SECONDS, if so exits the program
-    This is to ensure this program executes and exits properly with Lambda's 15 mins timeout limit
+    return "training" if "training" in image else "inference"
 
-    :param start_time: <datetime>
+
+def index_tickets(s3_client, bucket_name, index, tickets, deadline):
+    """
+    Download and index the tickets that are not indexed yet, or were rewritten since they were indexed.
+    Every entry of a batch ticket is indexed as a ticket of its own; a batch whose entries do not have unique ids is
+    rejected, and left on the queue for its submitter to fix.
+    Tickets that no longer exist are skipped, and indexing stops at the deadline.
+
+    :param s3_client: boto3 S3 client
+    :param bucket_name: <string> bucket name
+    :param index: <TicketIndex> ticket index of the current run
+    :param tickets: <dict> key -> ETag of the tickets to index; without ETag, a ticket already indexed is kept as is
+    :param deadline: <Deadline> time budget of the current run
+    :return: <dict> key -> body of the tickets downloaded while indexing, keyed by entry key for batch entries
     """
-    if (datetime.now() - start_time).total_seconds() >= constants.TIMEOUT_LIMIT_SECONDS:
-        sys.exit()
+    unindexed_keys = [
+        key for key, etag in tickets.items() if key not in index or (etag is not None and index.get(key, etag) is None)
+    ]
+
+    ticket_bodies = {}
+    for ticket_key, ticket_body, etag in prefetch_json_objects(
+        s3_client, bucket_name, unindexed_keys, constants.TICKET_PREFETCH_DEPTH, skip_missing=True, with_etag=True
+    ):
+        if deadline.expired():
+            break
+        if is_batch(ticket_body):
+            batch_entries = split_batch(ticket_key, ticket_body)
+            duplicate_entry_ids = get_duplicate_entry_ids(batch_entries)
+            if duplicate_entry_ids:
+                LOGGER.error(f"Batch ticket {ticket_key} not scheduled, its entries share ids {duplicate_entry_ids}.")
+                metrics.get_recorder().increment("BatchTicketsRejected")
+                continue
+            indexed_entries = []
+            rules_version = scheduler_config.get_instance_type_rules_version()
+            for entry_key, entry_body in batch_entries:
+                image_uri = entry_body["ECR-URI"]
+                indexed_entries.append(
+                    (entry_key, entry_body, assign_sagemaker_instance_type(image_uri), get_job_type(image_uri))
+                )
+                ticket_bodies[entry_key] = entry_body
+            index.add_batch(ticket_key, etag, indexed_entries, rules_version)
+            continue
+        image_uri = ticket_body["ECR-URI"]
+        index.add(
+            ticket_key,
+            ticket_body,
+            etag,
+            assign_sagemaker_instance_type(image_uri),
+            get_job_type(image_uri),
+            scheduler_config.get_instance_type_rules_version(),
+        )
+        ticket_bodies[ticket_key] = ticket_body
+
+    return ticket_bodies
 
 
-def ticket_timestamp_cmp_function(ticket1, ticket2):
+def reassign_instance_types(index):
     """
-    Compares the timestamp of the two request tickets
+    Assign the instance type of the tickets indexed under other instance type rules again, so that the rules reloaded
+    from the scheduler config apply to the tickets already queued
 
-    :param ticket1, ticket2: <dict> S3 object descriptors from s3_client.list_objects
-    :return: <bool>
+    :param index: <TicketIndex> ticket index of the current run
     """
-    ticket1_key, ticket2_key = ticket1["Key"], ticket2["Key"]
-    ticket1_timestamp, ticket2_timestamp = (
-        ticket1_key.split("/")[-1].split(".")[0].split("_")[-1],
-        ticket2_key.split("/")[-1].split(".")[0].split("_")[-1],
+    reassigned_keys = index.reassign_instance_types(
+        scheduler_config.get_instance_type_rules_version(), assign_sagemaker_instance_type
     )
-    return ticket1_timestamp > ticket2_timestamp
+    if reassigned_keys:
+        LOGGER.info(f"Instance type rules changed, {len(reassigned_keys)} queued tickets got a new instance type.")
+    metrics.get_recorder().increment("TicketsReassigned", len(reassigned_keys))
 
 
-def lambda_handler(event, context):
-    start_time = datetime.now()
-    bucket_name = constants.BUCKET_NAME
+def dispatch_tickets(ticket_keys, index, ledger, ticket_bodies, deleter, deadline, journal):
+    """
+    Start the Job Executor for tickets planned for dispatch, concurrently and rate-limited, until the deadline.
+    A ticket that could not be started gives its booked capacity back and goes through retry accounting.
+    The dispatches are recorded in the journal of the run before the first build is started.
+
+    :param ticket_keys: <list> keys of the tickets to dispatch, their capacity already booked in the ledger
+    :param index: <TicketIndex> ticket index of the current run
+    :param ledger: <CapacityLedger> capacity ledger of the current run
+    :param ticket_bodies: <dict> key -> body of the tickets already downloaded during the run
+    :param deleter: <BatchDeleter> collects the deletion of dispatched tickets
+    :param deadline: <Deadline> time budget of the current run
+    :param journal: <DispatchJournal> dispatch journal of the current run
+    :return: <list> keys of the tickets handled before the deadline
+    """
+    s3_client = get_client_provider().client("s3")
+    handled_keys = []
+    dispatches = []
+
+    # only the bodies of tickets being dispatched are downloaded, unless they were read while indexing
+    ticket_bodies = dict(ticket_bodies)
+    ticket_bodies.update(
+        read_ticket_bodies(
+            s3_client, index, [ticket_key for ticket_key in ticket_keys if ticket_key not in ticket_bodies]
+        )
+    )
+    builds = []
+    for ticket_key in ticket_keys:
+        ticket_entry = index.get(ticket_key)
+        ticket_body = ticket_bodies.get(ticket_key)
+        # removed by its submitter since it was indexed
+        if ticket_body is None:
+            LOGGER.warning(f"Ticket {ticket_key} no longer exists, skipping it.")
+            ledger.release(ticket_entry["INSTANCE_TYPE"], ticket_entry["JOB_TYPE"], ticket_entry["INSTANCES_NUM"])
+            index.remove(ticket_key)
+            handled_keys.append(ticket_key)
+            continue
+        dispatch_token = get_dispatch_token(ticket_key, ticket_body)
+        build = get_build_request(
+            ticket_body["ECR-URI"],
+            ticket_body["CONTEXT"],
+            ticket_body["RETURN-SQS-URL"],
+            ticket_key,
+            ticket_entry["INSTANCES_NUM"],
+            ticket_entry["INSTANCE_TYPE"],
+            ticket_entry["JOB_TYPE"],
+            dispatch_token=dispatch_token,
+        )
+        builds.append((ticket_key, build))
+        dispatches.append(
+            {
+                "TICKET_KEY": ticket_key,
+                "OBJECT_KEY": index.get_object_key(ticket_key),
+                "DISPATCH_TOKEN": dispatch_token,
+                "INSTANCE_TYPE": ticket_entry["INSTANCE_TYPE"],
+                "JOB_TYPE": ticket_entry["JOB_TYPE"],
+                "INSTANCES_NUM": ticket_entry["INSTANCES_NUM"],
+            }
+        )
+
+    # the CodeBuild client is only created by runs with something to dispatch
+    if not builds:
+        return handled_keys
+    journal.record(dispatches)
+    # throttled and transiently failing starts are retried by the dispatcher, at a rate shared by its threads,
+    # not by botocore
+    dispatcher = BuildDispatcher(get_client_provider().client("codebuild", max_attempts=1), deadline)
+    for ticket_key, outcome in dispatcher.dispatch(builds):
+        ticket_entry = index.get(ticket_key)
+        instance_type = ticket_entry["INSTANCE_TYPE"]
+        job_type = ticket_entry["JOB_TYPE"]
+        instances_required = ticket_entry["INSTANCES_NUM"]
+
+        # started Job Executor without errors
+        if outcome == BUILD_STARTED:
+            # capacity was already booked in the ledger when the ticket was selected
+            update_resource_pool(ticket_key, instance_type, instances_required, job_type)
+            remove_ticket(ticket_key, index, deleter)
+            metrics.get_recorder().increment("TicketsDispatched")
+            run_trace.get_trace().record_decision(ticket_key, run_trace.DISPATCHED)
+
+        # Errors occurred with start_build API call, or the account limit of running builds was reached
+        elif outcome == BUILD_FAILED:
+            ledger.release(instance_type, job_type, instances_required)
+            run_trace.get_trace().record_decision(ticket_key, run_trace.START_FAILED)
+            update_ticket(ticket_key, ticket_entry, deleter=deleter, index=index)
+
+        # tickets skipped at the deadline are left for the next run
+        else:
+            continue
+        handled_keys.append(ticket_key)
 
-    s3_client = boto3.client("s3")
-    response = s3_client.list_objects(Bucket=bucket_name, Prefix="request_tickets/")
-    tickets_list = [ticket for ticket in response["Contents"] if ticket["Key"].endswith(".json")]
-    tickets_list.sort(key=cmp_to_key(ticket_timestamp_cmp_function))
+    if dispatcher.account_limit_reached.is_set():
+        metrics.get_recorder().increment("AccountLimitReached")
+    return handled_keys
 
-    for ticket in tickets_list:
-        check_timeout(start_time)
-        ticket_key = ticket["Key"]
-        ticket_object = s3_client.get_object(Bucket=bucket_name, Key=ticket_key)
-        ticket_body = json.loads(ticket_object["Body"].read().decode("utf-8"))
 
-        image_uri = ticket_body["ECR-URI"]
-        build_context = ticket_body["CONTEXT"]
-        return_sqs_url = ticket_body["RETURN-SQS-URL"]
-        instances_required = ticket_body["INSTANCES_NUM"]
-        instance_type = assign_sagemaker_instance_type(image_uri)
-        job_type = "training" if "training" in image_uri else "inference"
-
-        instances_in_use = get_num_instances_running(instance_type, job_type)
-        instances_limit = check_sagemaker_instance_limit(image_uri)
-        assert (
-            instances_limit >= instances_in_use
-        ), f"Invalid State: Number of instances in use {instances_in_use} is larger than limit {instances_limit}"
-
-        # enough SageMaker resources for requested job
-        if (instances_in_use + instances_required) < instances_limit:
-            # started Job Executor without errors
-            if trigger_build(image_uri, build_context, return_sqs_url, ticket_key, instances_required):
-                update_resource_pool(ticket_key, instance_type, instances_required, job_type)
-                delete_ticket(bucket_name, ticket_key)
-
-            # Errors occurred with start_build API call
+def log_plan(plan):
+    """
+    :param plan: <SchedulingPlan> plan of the current run
+    """
+    LOGGER.info(
+        f"Planned {len(plan.dispatch)} dispatches ({plan.backfilled} backfilled), {len(plan.blocked)} tickets blocked, "
+        f"{len(plan.deferred)} deferred."
+    )
+    if plan.saturated_classes:
+        saturated_classes = sorted(f"{instance_type}-{job_type}" for instance_type, job_type in plan.saturated_classes)
+        LOGGER.info(f"No capacity left for {', '.join(saturated_classes)}.")
+    metrics.get_recorder().set_utilization(plan.utilization)
+    for resource_class, usage in plan.utilization.items():
+        LOGGER.info(f"Utilization of {resource_class}: {usage['IN_USE']}/{usage['LIMIT']} instances")
+
+
+def lease_shards(leases, ledger, ticket_entries, deadline):
+    """
+    Take the leases of the shards of the given tickets, up to constants.MAX_SHARDS_PER_RUN shards.
+    Shards are tried in random order, so that overlapping runs capped in shards start from different shards.
+
+    :param leases: <ShardLeases> leases of the current run
+    :param ledger: <CapacityLedger> capacity ledger, for the shard of each resource class
+    :param ticket_entries: <iterable> index entries of the tickets to schedule, or dispatches to resolve
+    :param deadline: <Deadline> time budget of the current run; leases expire when the invocation would be killed
+    :return: <set> shards held by the current run
+    """
+    shards = sorted(
+        {ledger.get_shard(ticket_entry["INSTANCE_TYPE"], ticket_entry["JOB_TYPE"]) for ticket_entry in ticket_entries}
+    )
+    random.shuffle(shards)
+    for shard in shards:
+        if constants.MAX_SHARDS_PER_RUN is not None and len(leases.held()) >= constants.MAX_SHARDS_PER_RUN:
+            break
+        leases.acquire(shard, deadline.remaining_seconds())
+    held_shards = leases.held()
+    metrics.get_recorder().increment("ShardsLeased", len(held_shards))
+    metrics.get_recorder().increment("ShardsBusy", len(shards) - len(held_shards))
+    return held_shards
+
+
+def recover_dispatches(s3_client, index, deleter, journals, held_shards, ledger):
+    """
+    Resolve the dispatch journals left behind by runs that ended half-way through their dispatches.
+    A dispatch whose build was started is completed: its resource pool entry is written if missing, unless the build
+    already finished, and its ticket leaves the queue. A dispatch without a build is rolled back, its ticket stays
+    queued and is scheduled again. Builds are only looked up in CodeBuild for dispatches without a pool entry.
+    Only the dispatches of shards held by the current run are resolved, the others are left to the runs holding them.
+
+    :param s3_client: boto3 S3 client
+    :param index: <TicketIndex> ticket index of the current run
+    :param deleter: <BatchDeleter> collects the deletion of the tickets of completed dispatches
+    :param journals: <dict> key -> (content, ETag) of the expired journals, see load_expired_journals
+    :param held_shards: <set> shards held by the current run
+    :param ledger: <CapacityLedger> capacity ledger, for the shard of each dispatch
+    :return: <dict> key of each journal resolved in whole or in part -> JOURNAL and ETAG as read, OBJECT_KEYS of the
+    tickets it deleted and DISPATCHES left to other runs, see delete_resolved_journals
+    """
+    bucket_name = constants.BUCKET_NAME
+    resolved_journals = {}
+    dispatches = []
+    for journal_key, (journal, etag) in journals.items():
+        held_dispatches, other_dispatches = [], []
+        for dispatch in journal["DISPATCHES"]:
+            if ledger.get_shard(dispatch["INSTANCE_TYPE"], dispatch["JOB_TYPE"]) in held_shards:
+                held_dispatches.append(dispatch)
             else:
-                update_ticket(ticket_key, ticket_body)
+                other_dispatches.append(dispatch)
+        if not held_dispatches:
+            continue
+        resolved_journals[journal_key] = {
+            "JOURNAL": journal,
+            "ETAG": etag,
+            "OBJECT_KEYS": set(),
+            "DISPATCHES": other_dispatches,
+        }
+        dispatches.extend((journal_key, dispatch) for dispatch in held_dispatches)
+    if not dispatches:
+        return resolved_journals
+
+    pool_keys = set(iter_keys(s3_client, bucket_name, "resource_pool/"))
+    unbooked_tokens = set()
+    for _, dispatch in dispatches:
+        ticket_key, instance_type, job_type = dispatch["TICKET_KEY"], dispatch["INSTANCE_TYPE"], dispatch["JOB_TYPE"]
+        if not any(
+            get_pool_key(ticket_key, instance_type, job_type, dispatch["INSTANCES_NUM"], status) in pool_keys
+            for status in ACTIVE_STATUSES
+        ):
+            unbooked_tokens.add(dispatch["DISPATCH_TOKEN"])
+    builds = {}
+    if unbooked_tokens:
+        since = min(resolution["JOURNAL"]["CREATED"] for resolution in resolved_journals.values())
+        builds = find_builds(get_client_provider().client("codebuild"), unbooked_tokens, since)
+
+    recorder = metrics.get_recorder()
+    for journal_key, dispatch in dispatches:
+        ticket_key = dispatch["TICKET_KEY"]
+        if dispatch["DISPATCH_TOKEN"] in unbooked_tokens:
+            build = builds.get(dispatch["DISPATCH_TOKEN"])
+            if build is None:
+                LOGGER.warning(f"Dispatch of {ticket_key} rolled back, no build was started.")
+                recorder.increment("DispatchesRolledBack")
+                continue
+            # the capacity of a build that already finished needs no booking
+            if build["buildStatus"] == "IN_PROGRESS":
+                instance_type, job_type = dispatch["INSTANCE_TYPE"], dispatch["JOB_TYPE"]
+                update_resource_pool(ticket_key, instance_type, dispatch["INSTANCES_NUM"], job_type)
+        LOGGER.warning(f"Dispatch of {ticket_key} completed, its build was started by an earlier run.")
+        recorder.increment("DispatchesRecovered")
+        if ticket_key in index:
+            remove_ticket(ticket_key, index, deleter)
+        # entries of a batch no longer indexed were already dropped from their batch
+        elif dispatch["OBJECT_KEY"] == ticket_key:
+            deleter.add(ticket_key)
+        resolved_journals[journal_key]["OBJECT_KEYS"].add(dispatch["OBJECT_KEY"])
+    return resolved_journals
+
+
+def delete_resolved_journals(s3_client, deleter, resolved_journals):
+    """
+    Delete the journals resolved by recover_dispatches, once the deletions of the run went through; a journal with
+    dispatches left to other runs is rewritten with just those.
+    A journal whose ticket could not be deleted is kept: the ticket is still queued and would be dispatched again,
+    the next run completes the dispatch instead.
+
+    :param s3_client: boto3 S3 client
+    :param deleter: <BatchDeleter> deleter of the run, flushed
+    :param resolved_journals: <dict> resolution of each journal, see recover_dispatches
+    """
+    failed_deletes = set(deleter.failed_keys)
+    for journal_key, resolution in resolved_journals.items():
+        if not failed_deletes.isdisjoint(resolution["OBJECT_KEYS"]):
+            LOGGER.warning(f"Tickets of {journal_key} could not be deleted from the queue, the journal is kept.")
+        elif resolution["DISPATCHES"]:
+            rewrite_journal(
+                s3_client,
+                constants.BUCKET_NAME,
+                journal_key,
+                resolution["JOURNAL"],
+                resolution["ETAG"],
+                resolution["DISPATCHES"],
+            )
+        else:
+            deleter.add(journal_key)
+    deleter.flush()
+
+
+def reconcile_queue(deadline, start_time, run_id):
+    """
+    Full pass over the request ticket queue: every queued ticket is considered, blocked tickets go through
+    retry accounting, and a pass cut short by the deadline is resumed by the next run.
+    Deferred tickets, still backing off from an earlier try, are left untouched: no GET, no PUT, no index update.
+    Resource pool entries left behind by SageMaker jobs that no longer exist are reclaimed before planning.
+    Only the tickets of the shards leased by the run are scheduled; the other shards are left to the runs holding
+    them, and capacity is read again from the resource pool once the leases are held. Shards with no capacity left
+    and all of their tickets backing off have nothing to do, and are not leased.
+    Dispatches left half-way by earlier runs are completed or rolled back once the leases of their shards are held;
+    the shards of such dispatches are leased even without a ticket to schedule.
+
+    :param deadline: <Deadline> time budget of the current run
+    :param start_time: <datetime> start of the current run
+    :param run_id: <string> unique id of the current run, owner of its leases
+    """
+    bucket_name = constants.BUCKET_NAME
+    s3_client = get_client_provider().client("s3")
+    recorder = metrics.get_recorder()
+
+    with recorder.phase("List"):
+        # only key and ETag are kept from the listing pages; ordering the queue needs every key up front
+        queued_tickets = {
+            entry["Key"]: entry["ETag"]
+            for entry in iter_objects(s3_client, bucket_name, "request_tickets/")
+            if entry["Key"].endswith(".json")
+        }
+    recorder.increment("TicketsScanned", len(queued_tickets))
+
+    with recorder.phase("Index"):
+        index = TicketIndex.load(s3_client, bucket_name)
+        index.prune(queued_tickets)
+        reassign_instance_types(index)
+        ticket_bodies = index_tickets(s3_client, bucket_name, index, queued_tickets, deadline)
+
+    # tickets handled by an earlier invocation of the current pass wait for the next pass
+    cursor = ResumeCursor.load(s3_client, bucket_name)
+    ticket_keys = [ticket_key for ticket_key in index.keys() if ticket_key not in cursor]
+    pass_completed = all(ticket_key in index for ticket_key in queued_tickets)
+    trace = run_trace.get_trace()
+    trace.record_tickets(index, ticket_keys)
+
+    with recorder.phase("List"):
+        pool_entries = list(iter_objects(s3_client, bucket_name, "resource_pool/"))
+
+    with recorder.phase("PoolReconciliation"):
+        reclaimed_keys = reconcile_resource_pool(
+            s3_client,
+            get_client_provider().client("sagemaker"),
+            get_client_provider().client("codebuild"),
+            bucket_name,
+            pool_entries,
+        )
+    recorder.increment("PoolEntriesReclaimed", len(reclaimed_keys))
+
+    ledger = CapacityLedger()
+    for entry in pool_entries:
+        if entry["Key"] not in reclaimed_keys:
+            ledger.add_pool_entry(entry["Key"])
+    # tickets backing off that do not fit the capacity left are deferred without planning
+    now = start_time.strftime(constants.TIMESTAMP_FORMAT)
+    active_keys = []
+    for ticket_key in ticket_keys:
+        ticket_entry = index.get(ticket_key)
+        if is_eligible(ticket_entry, now) or ledger.fits(
+            ticket_entry["INSTANCE_TYPE"], ticket_entry["JOB_TYPE"], ticket_entry["INSTANCES_NUM"]
+        ):
+            active_keys.append(ticket_key)
+        else:
+            trace.record_decision(ticket_key, run_trace.DEFERRED)
+    recorder.increment("TicketsDeferred", len(ticket_keys) - len(active_keys))
+
+    leases = ShardLeases(s3_client, bucket_name, run_id)
+    journal = DispatchJournal(s3_client, bucket_name, run_id, leases)
+    run_completed = False
+    resolved_journals = {}
+    # deletions of dispatched and dead-lettered tickets are sent in batches at the end of the run
+    deleter = BatchDeleter(s3_client, bucket_name)
+    try:
+        with recorder.phase("Recovery"):
+            journals = load_expired_journals(s3_client, bucket_name)
+        journal_dispatches = [dispatch for journal, _ in journals.values() for dispatch in journal["DISPATCHES"]]
+        with recorder.phase("Lease"):
+            held_shards = lease_shards(
+                leases, ledger, [index.get(ticket_key) for ticket_key in active_keys] + journal_dispatches, deadline
+            )
+
+        # the dispatches left half-way by earlier runs are resolved before their tickets can be dispatched again
+        with recorder.phase("Recovery"):
+            resolved_journals = recover_dispatches(s3_client, index, deleter, journals, held_shards, ledger)
+
+        # bookings made by the previous holders of the shards are only seen by a listing made after leasing;
+        # capacity is tracked locally from then on
+        if held_shards:
+            with recorder.phase("List"):
+                ledger = CapacityLedger.from_resource_pool(s3_client, bucket_name)
+
+        scheduling_queue = SchedulingQueue(now=start_time)
+        for ticket_key in active_keys:
+            ticket_entry = index.get(ticket_key)
+            # completed by the recovery
+            if ticket_entry is None:
+                continue
+            if ledger.get_shard(ticket_entry["INSTANCE_TYPE"], ticket_entry["JOB_TYPE"]) in held_shards:
+                scheduling_queue.push(ticket_key, ticket_entry)
+
+        # the whole run is planned from the index alone, before anything is dispatched
+        trace.record_capacity(ledger)
+        with recorder.phase("Plan"):
+            plan = plan_run(scheduling_queue.drain(), index, ledger, now=start_time)
+        log_plan(plan)
+        recorder.increment("TicketsDeferred", len(plan.deferred))
+        for ticket_key in plan.deferred:
+            trace.record_decision(ticket_key, run_trace.DEFERRED)
+
+        with recorder.phase("Dispatch"):
+            handled_keys = dispatch_tickets(plan.dispatch, index, ledger, ticket_bodies, deleter, deadline, journal)
 
         # insufficient SageMaker resources
+        with recorder.phase("RetryAccounting"):
+            handled_keys.extend(account_blocked_tickets(plan.blocked, index, deleter, deadline))
+
+        for ticket_key in handled_keys:
+            cursor.mark_handled(ticket_key)
+        if len(handled_keys) < len(plan.dispatch) + len(plan.blocked):
+            pass_completed = False
+            LOGGER.warning(
+                f"Deadline reached, stopping after {len(handled_keys)} tickets, the next run resumes the pass."
+            )
+        run_completed = True
+    finally:
+        with recorder.phase("Save"):
+            rewrite_batches(s3_client, bucket_name, index, deleter)
+            deleter.flush()
+            index.save(s3_client, bucket_name)
+            # the journals go before the leases, the next holder of a shard must see them resolved or expired
+            delete_resolved_journals(s3_client, deleter, resolved_journals)
+            journal.close(run_completed, deleter.failed_keys)
+            leases.release_all()
+
+    with recorder.phase("Save"):
+        if pass_completed:
+            cursor.clear(s3_client, bucket_name)
+        else:
+            # tickets that left the queue are dropped from the index, and need not be remembered by the cursor
+            cursor.save(s3_client, bucket_name, index)
+
+
+def schedule_created_tickets(created_tickets, deadline, start_time, run_id):
+    """
+    Incremental pass over the tickets announced by S3 ObjectCreated notifications.
+    A new ticket is dispatched right away if it fits the current capacity and no older ticket of the same
+    instance type and job type is still waiting; otherwise it is only indexed, and left to the reconciliation
+    pass without counting a scheduling try. New tickets of shards leased by another run are left to that run.
+    Dispatches left half-way by earlier runs are completed or rolled back before anything is dispatched.
+
+    :param created_tickets: <dict> key -> ETag of the created tickets
+    :param deadline: <Deadline> time budget of the current run
+    :param start_time: <datetime> start of the current run
+    :param run_id: <string> unique id of the current run, owner of its leases
+    """
+    bucket_name = constants.BUCKET_NAME
+    s3_client = get_client_provider().client("s3")
+    recorder = metrics.get_recorder()
+    recorder.increment("TicketsScanned", len(created_tickets))
+
+    with recorder.phase("Index"):
+        index = TicketIndex.load(s3_client, bucket_name)
+        reassign_instance_types(index)
+
+        # tickets indexed before this notification arrived are already waiting in the queue
+        waiting_classes = {
+            (index.get(ticket_key)["INSTANCE_TYPE"], index.get(ticket_key)["JOB_TYPE"])
+            for ticket_key in index.keys()
+            if index.get_object_key(ticket_key) not in created_tickets
+        }
+        ticket_bodies = index_tickets(s3_client, bucket_name, index, created_tickets, deadline)
+
+    ticket_keys = [
+        ticket_key
+        for ticket_key in ticket_bodies
+        if (index.get(ticket_key)["INSTANCE_TYPE"], index.get(ticket_key)["JOB_TYPE"]) not in waiting_classes
+    ]
+    run_trace.get_trace().record_tickets(index, ticket_bodies)
+
+    ledger = CapacityLedger()
+    leases = ShardLeases(s3_client, bucket_name, run_id)
+    journal = DispatchJournal(s3_client, bucket_name, run_id, leases)
+    run_completed = False
+    resolved_journals = {}
+    deleter = BatchDeleter(s3_client, bucket_name)
+    try:
+        with recorder.phase("Lease"):
+            held_shards = lease_shards(leases, ledger, [index.get(ticket_key) for ticket_key in ticket_keys], deadline)
+
+        # the resource pool is only read once the shards are held, and not at all without a ticket to dispatch
+        if held_shards:
+            with recorder.phase("Recovery"):
+                journals = load_expired_journals(s3_client, bucket_name)
+                resolved_journals = recover_dispatches(s3_client, index, deleter, journals, held_shards, ledger)
+            with recorder.phase("List"):
+                for key in iter_keys(s3_client, bucket_name, "resource_pool/", suffix=".json"):
+                    ledger.add_pool_entry(key)
+
+            scheduling_queue = SchedulingQueue(now=start_time)
+            for ticket_key in ticket_keys:
+                ticket_entry = index.get(ticket_key)
+                if ticket_entry is None:
+                    continue
+                if ledger.get_shard(ticket_entry["INSTANCE_TYPE"], ticket_entry["JOB_TYPE"]) in held_shards:
+                    scheduling_queue.push(ticket_key, ticket_entry)
+
+            run_trace.get_trace().record_capacity(ledger)
+            with recorder.phase("Plan"):
+                plan = plan_run(scheduling_queue.drain(), index, ledger, now=start_time)
+            log_plan(plan)
+            with recorder.phase("Dispatch"):
+                dispatch_tickets(plan.dispatch, index, ledger, ticket_bodies, deleter, deadline, journal)
+        run_completed = True
+    finally:
+        with recorder.phase("Save"):
+            rewrite_batches(s3_client, bucket_name, index, deleter)
+            deleter.flush()
+            index.save(s3_client, bucket_name)
+            delete_resolved_journals(s3_client, deleter, resolved_journals)
+            journal.close(run_completed, deleter.failed_keys)
+            leases.release_all()
+
+
+def release_completed_builds(completed_builds):
+    """
+    Delete the resource pool entries of the Job Executor builds that completed, so that their capacity is available
+    to the next run right away instead of after the cleanup of stale entries.
+    The entry is found from the environment of the build, with the instance type and job type booked at dispatch;
+    the entry may have moved from preparing to running, so the keys of every status holding capacity are deleted.
+
+    :param completed_builds: <list> environment variables (name -> value) of the completed builds
+    """
+    s3_client = get_client_provider().client("s3")
+    deleter = BatchDeleter(s3_client, constants.BUCKET_NAME)
+    for environment in completed_builds:
+        # builds started before the instance type and job type were passed to the build
+        instance_type = environment.get("INSTANCE_TYPE") or assign_sagemaker_instance_type(environment["DLC_IMAGE"])
+        job_type = environment.get("JOB_TYPE") or get_job_type(environment["DLC_IMAGE"])
+        for status in ACTIVE_STATUSES:
+            deleter.add(
+                get_pool_key(environment["TICKET_KEY"], instance_type, job_type, environment["NUM_INSTANCES"], status)
+            )
+        LOGGER.info(f"Job Executor build of {environment['TICKET_KEY']} completed, releasing its capacity.")
+        run_trace.get_trace().record_decision(environment["TICKET_KEY"], run_trace.RELEASED)
+    deleter.flush()
+    metrics.get_recorder().increment("PoolEntriesReleased", len(completed_builds))
+
+
+def lambda_handler(event, context):
+    start_time = datetime.now()
+    deadline = Deadline(context)
+    # owner of the shard leases taken by this run
+    run_id = getattr(context, "aws_request_id", None) or str(uuid.uuid4())
+    recorder = metrics.start_invocation(constants.METRICS_NAMESPACE, "scheduler")
+    if cold_start.invocation_started():
+        recorder.increment("ColdStart")
+
+    # S3 notifications schedule just the new tickets; any other event, e.g. the schedule, runs a full pass
+    completed_builds = get_completed_builds(event)
+    created_tickets = get_created_tickets(event)
+    if completed_builds is not None:
+        run_kind = "completion"
+    else:
+        run_kind = "reconcile" if created_tickets is None else "incremental"
+    trace = run_trace.start_run(run_id, run_kind, start_time)
+    try:
+        # limits and instance type rules may have changed since the last invocation of the container
+        if completed_builds is not None or created_tickets != {}:
+            scheduler_config.refresh(get_client_provider().client("s3"))
+
+        # CodeBuild state changes of the Job Executor release the capacity of finished builds
+        if completed_builds is not None:
+            release_completed_builds(completed_builds)
+        elif created_tickets is None:
+            reconcile_queue(deadline, start_time, run_id)
+        elif created_tickets:
+            LOGGER.info(f"Scheduling {len(created_tickets)} created tickets.")
+            schedule_created_tickets(created_tickets, deadline, start_time, run_id)
+        # notifications of other objects, e.g. the scheduler state, need no AWS call at all
         else:
-            update_ticket(ticket_key, ticket_body)
+            LOGGER.info("No request ticket created, nothing to schedule.")
+    finally:
+        if trace.enabled:
+            try:
+                trace.save(get_client_provider().client("s3"), constants.BUCKET_NAME, recorder.phase_seconds)
+            except ClientError as e:
+                LOGGER.warning(f"Trace of the run could not be written: {e}")
+        # metrics are printed to stdout in Embedded Metric Format, CloudWatch Logs extracts them
+        recorder.emit()
+        cold_start.report()
@@ -0,0 +1,258 @@
+"""
+Per-invocation metrics of the lambdas, emitted in CloudWatch Embedded Metric Format (EMF).
+Every botocore call of an instrumented client is recorded with its latency, retries and throttles, next to the
+counters, phase timings and capacity utilization reported by the handler. At the end of an invocation, emit()
+prints one EMF document per dimension set to stdout, where CloudWatch Logs turns them into metrics.
+
+This module has no dependency on the rest of the scheduler, so the cleanup lambda ships it as well.
+"""
+import json
+import sys
+import threading
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import cold_start
+
+
+# error codes AWS services use to signal throttling
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "TransactionInProgressException",
+    "RequestLimitExceeded",
+    "BandwidthLimitExceeded",
+    "LimitExceededException",
+    "RequestThrottled",
+    "SlowDown",
+    "PriorRequestNotComplete",
+    "EC2ThrottledException",
+}
+
+_START_TIME_CONTEXT_KEY = "metrics_start_time"
+
+
+def _error_code(parsed_response):
+    if not isinstance(parsed_response, dict):
+        return None
+    return parsed_response.get("Error", {}).get("Code")
+
+
+def _operation_from_event_name(event_name):
+    # event names look like after-call.s3.GetObject
+    _, service_name, operation_name = event_name.split(".", 2)
+    return f"{service_name}.{operation_name}"
+
+
+class MetricsRecorder:
+    """
+    Metrics of a single invocation
+    """
+
+    def __init__(self, namespace, function_name):
+        """
+        :param namespace: <string> CloudWatch namespace of the metrics
+        :param function_name: <string> value of the Function dimension
+        """
+        self.namespace = namespace
+        self.function_name = function_name
+        self.counters = Counter()
+        # phase -> seconds spent
+        self.phase_seconds = defaultdict(float)
+        # "(service).(operation)" -> Counter of Calls, LatencyMilliseconds, Retries, Throttles, Errors
+        self.api_calls = defaultdict(Counter)
+        # resource class -> {"IN_USE": <int>, "LIMIT": <int>}
+        self.utilization = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        """
+        :param name: <string> name of the counter, e.g. TicketsDispatched
+        :param value: <int> amount to add
+        """
+        with self._lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the invocation; phases entered several times add up
+
+        :param name: <string> name of the phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phase_seconds[name] += time.perf_counter() - start
+
+    def set_utilization(self, utilization):
+        """
+        :param utilization: <dict> resource class -> {"IN_USE": <int>, "LIMIT": <int>}
+        """
+        self.utilization = dict(utilization)
+
+    def record_api_call(self, operation, latency_seconds, retries, error_code):
+        """
+        :param operation: <string> "(service).(operation)"
+        :param latency_seconds: <float> time spent in the call, retries included
+        :param retries: <int> number of retries botocore made
+        :param error_code: <string> error code of the final response, None on success; a throttled final attempt was
+        already counted by record_throttled_attempt
+        """
+        with self._lock:
+            call = self.api_calls[operation]
+            call["Calls"] += 1
+            call["LatencyMilliseconds"] += latency_seconds * 1000
+            call["Retries"] += retries
+            if error_code is not None:
+                call["Errors"] += 1
+
+    def record_throttled_attempt(self, operation):
+        """
+        :param operation: <string> "(service).(operation)" of an attempt that was throttled, the final one included:
+        botocore reports every attempt to needs-retry, whether it is retried or not
+        """
+        with self._lock:
+            self.api_calls[operation]["Throttles"] += 1
+
+    def _document(self, dimensions, metrics, units):
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [sorted(dimensions)],
+                        "Metrics": [{"Name": name, "Unit": units[name]} for name in metrics],
+                    }
+                ],
+            }
+        }
+        document.update(dimensions)
+        document.update(metrics)
+        return document
+
+    def to_emf(self):
+        """
+        :return: <list> EMF documents of the invocation
+        """
+        function = {"Function": self.function_name}
+        documents = []
+
+        summary = dict(self.counters)
+        summary["ApiCalls"] = sum(call["Calls"] for call in self.api_calls.values())
+        documents.append(self._document(function, summary, defaultdict(lambda: "Count")))
+
+        for phase, seconds in sorted(self.phase_seconds.items()):
+            phase_metrics = {"PhaseDuration": round(seconds * 1000, 3)}
+            units = {"PhaseDuration": "Milliseconds"}
+            documents.append(self._document(dict(function, Phase=phase), phase_metrics, units))
+
+        for operation, call in sorted(self.api_calls.items()):
+            api_metrics = {
+                "Calls": call["Calls"],
+                "Latency": round(call["LatencyMilliseconds"] / call["Calls"], 3) if call["Calls"] else 0,
+                "Retries": call["Retries"],
+                "Throttles": call["Throttles"],
+                "Errors": call["Errors"],
+            }
+            units = defaultdict(lambda: "Count", Latency="Milliseconds")
+            documents.append(self._document(dict(function, Operation=operation), api_metrics, units))
+
+        for resource_class, usage in sorted(self.utilization.items()):
+            capacity_metrics = {
+                "InstancesInUse": usage["IN_USE"],
+                "InstanceLimit": usage["LIMIT"],
+                "Utilization": round(100 * usage["IN_USE"] / usage["LIMIT"], 2) if usage["LIMIT"] else 0,
+            }
+            units = defaultdict(lambda: "Count", Utilization="Percent")
+            documents.append(self._document(dict(function, ResourceClass=resource_class), capacity_metrics, units))
+
+        return documents
+
+    def emit(self, stream=None):
+        """
+        Print the EMF documents of the invocation, one JSON document per line
+
+        :param stream: file object to write to, defaults to stdout
+        """
+        stream = stream or sys.stdout
+        for document in self.to_emf():
+            stream.write(json.dumps(document) + "\n")
+        stream.flush()
+
+
+_recorder = MetricsRecorder("Default", "default")
+
+
+def start_invocation(namespace, function_name):
+    """
+    Start recording the metrics of a new invocation; instrumented clients report to it from now on
+
+    :param namespace: <string> CloudWatch namespace of the metrics
+    :param function_name: <string> value of the Function dimension
+    :return: <MetricsRecorder>
+    """
+    global _recorder
+    _recorder = MetricsRecorder(namespace, function_name)
+    return _recorder
+
+
+def get_recorder():
+    """
+    :return: <MetricsRecorder> recorder of the current invocation
+    """
+    return _recorder
+
+
+def _before_call(context=None, **kwargs):
+    if context is not None:
+        context[_START_TIME_CONTEXT_KEY] = time.perf_counter()
+
+
+def _after_call(event_name, parsed=None, context=None, **kwargs):
+    start_time = (context or {}).get(_START_TIME_CONTEXT_KEY)
+    latency = time.perf_counter() - start_time if start_time is not None else 0
+    retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    operation = _operation_from_event_name(event_name)
+    _recorder.record_api_call(operation, latency, retries, _error_code(parsed))
+    # the first call of an operation pays for connection setup
+    cold_start.record_first_call(operation, latency)
+
+
+def _after_call_error(event_name, exception=None, context=None, **kwargs):
+    start_time = (context or {}).get(_START_TIME_CONTEXT_KEY)
+    latency = time.perf_counter() - start_time if start_time is not None else 0
+    _recorder.record_api_call(_operation_from_event_name(event_name), latency, 0, type(exception).__name__)
+
+
+def _needs_retry(event_name, response=None, **kwargs):
+    # called after every attempt, the last one included, so throttles are only counted here
+    # response is (http response, parsed response) of the attempt, None if it failed to connect
+    if response is not None and _error_code(response[1]) in THROTTLING_ERROR_CODES:
+        _recorder.record_throttled_attempt(_operation_from_event_name(event_name))
+    # never take part in the retry decision
+    return None
+
+
+def instrument_client(client):
+    """
+    Hook the recorder into every call made by a boto3 client; instrumenting a client twice has no effect
+
+    :param client: boto3 client, or a fake exposing meta.events
+    :return: the client
+    """
+    events = client.meta.events
+    events.register("before-call", _before_call, unique_id="metrics-before-call")
+    events.register("after-call", _after_call, unique_id="metrics-after-call")
+    events.register("after-call-error", _after_call_error, unique_id="metrics-after-call-error")
+    events.register("needs-retry", _needs_retry, unique_id="metrics-needs-retry")
+    return client
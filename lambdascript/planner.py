@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta
+
+import constants
+
+
+class SchedulingPlan:
+    """
+    Outcome of planning a scheduler run: which tickets get dispatched, which stay on the queue,
+    and how much of each instance type is booked once the dispatches go through
+    """
+
+    def __init__(self):
+        # keys of the tickets to dispatch, in queue order
+        self.dispatch = []
+        # keys of the tickets that could not be fitted this run, in queue order
+        self.blocked = []
+        # keys of the tickets that could not be fitted, still backing off from an earlier try, in queue order
+        self.deferred = []
+        # number of dispatched tickets that were fitted around a blocked ticket ahead of them
+        self.backfilled = 0
+        # (instance_type, job_type) of the classes held for a long-blocked ticket
+        self.reserved_classes = set()
+        # job types whose total limit is held for a long-blocked ticket
+        self.reserved_job_types = set()
+        # (instance_type, job_type) of the classes with no capacity left; their tickets are no longer evaluated
+        self.saturated_classes = set()
+        # "(instance type)-(job type)" -> {"IN_USE": <int>, "LIMIT": <int>}
+        self.utilization = {}
+
+
+def get_next_eligible_time(scheduling_tries, now=None):
+    """
+    Exponential backoff of a ticket that could not be scheduled
+
+    :param scheduling_tries: <int> scheduling tries of the ticket, including the one that just failed
+    :param now: <datetime> time of the try, defaults to now
+    :return: <string> time, in TIMESTAMP format, before which the ticket does not count another scheduling try
+    """
+    backoff_seconds = min(
+        constants.RETRY_BACKOFF_BASE_SECONDS * 2 ** max(0, scheduling_tries - 1), constants.RETRY_BACKOFF_MAX_SECONDS
+    )
+    return ((now or datetime.now()) + timedelta(seconds=backoff_seconds)).strftime(constants.TIMESTAMP_FORMAT)
+
+
+def is_eligible(ticket_entry, now):
+    """
+    :param ticket_entry: <dict> index entry of the ticket
+    :param now: <string> current time in TIMESTAMP format
+    :return: <bool> True if the ticket is done backing off from its last scheduling try
+    """
+    return ticket_entry.get("NEXT_ELIGIBLE", "") <= now
+
+
+def get_utilization(ledger):
+    """
+    :param ledger: <CapacityLedger> capacity ledger of the current run
+    :return: <dict> "(instance type)-(job type)" or "total-(job type)" -> {"IN_USE": <int>, "LIMIT": <int>}
+    """
+    utilization = {}
+    for instance_type, job_type in ledger.resource_classes():
+        utilization[f"{instance_type}-{job_type}"] = {
+            "IN_USE": ledger.in_use(instance_type, job_type),
+            "LIMIT": ledger.limit(instance_type, job_type),
+        }
+    for job_type in ("training", "inference"):
+        utilization[f"total-{job_type}"] = {
+            "IN_USE": ledger.total_in_use(job_type),
+            "LIMIT": ledger.total_limit(job_type),
+        }
+    return utilization
+
+
+def plan_run(ticket_keys, index, ledger, reservation_tries=None, now=None):
+    """
+    Plan the whole run before anything is dispatched, booking the ledger for every ticket planned for dispatch.
+    Tickets are considered in queue order. A ticket fits if it stays within the limit of its instance type and
+    the total limit of its job type. When a ticket does not fit, smaller tickets behind it may still use the
+    remaining capacity (backfilling). To keep large tickets from starving, a ticket that has already been blocked
+    for reservation_tries runs reserves what it is waiting on, so nothing behind it takes capacity of its instance
+    type (or of its job type, if it is the total limit it is waiting on) and freed capacity accumulates for it.
+    Tickets still backing off from an earlier try are dispatched as soon as they fit; when they do not, they are
+    deferred instead of blocked, and do not count another scheduling try.
+    Once a class of tickets (instance type, job type) has no capacity left, which includes classes with a limit of 0,
+    the remaining tickets of the class are not fitted without being evaluated, since bookings only grow during
+    planning.
+
+    :param ticket_keys: <iterable> keys of the queued tickets, in queue order
+    :param index: <TicketIndex> ticket index of the current run
+    :param ledger: <CapacityLedger> capacity ledger of the current run
+    :param reservation_tries: <int> scheduling tries after which a blocked ticket reserves capacity
+    :param now: <datetime> start of the current run, defaults to now
+    :return: <SchedulingPlan>
+    """
+    reservation_tries = constants.BACKFILL_RESERVATION_TRIES if reservation_tries is None else reservation_tries
+    now = (now or datetime.now()).strftime(constants.TIMESTAMP_FORMAT)
+    plan = SchedulingPlan()
+    blocked_classes = set()
+    blocked_job_types = set()
+
+    for ticket_key in ticket_keys:
+        ticket_entry = index.get(ticket_key)
+        instance_type = ticket_entry["INSTANCE_TYPE"]
+        job_type = ticket_entry["JOB_TYPE"]
+        instances_required = ticket_entry["INSTANCES_NUM"]
+        resource_class = (instance_type, job_type)
+        not_fitted = plan.blocked if is_eligible(ticket_entry, now) else plan.deferred
+
+        if resource_class in plan.saturated_classes:
+            not_fitted.append(ticket_key)
+            continue
+        if ledger.remaining(instance_type, job_type) == 0:
+            plan.saturated_classes.add(resource_class)
+            not_fitted.append(ticket_key)
+            continue
+
+        instances_in_use = ledger.in_use(instance_type, job_type)
+        instances_limit = ledger.limit(instance_type, job_type)
+        assert (
+            instances_limit >= instances_in_use
+        ), f"Invalid State: Number of instances in use {instances_in_use} is larger than limit {instances_limit}"
+
+        if resource_class in plan.reserved_classes or job_type in plan.reserved_job_types:
+            not_fitted.append(ticket_key)
+            continue
+
+        # enough SageMaker resources for requested job
+        if ledger.fits(instance_type, job_type, instances_required):
+            ledger.book(instance_type, job_type, instances_required)
+            plan.dispatch.append(ticket_key)
+            if resource_class in blocked_classes or job_type in blocked_job_types:
+                plan.backfilled += 1
+            continue
+
+        # insufficient SageMaker resources
+        not_fitted.append(ticket_key)
+        class_exhausted = instances_in_use + instances_required > instances_limit
+        if class_exhausted:
+            blocked_classes.add(resource_class)
+        else:
+            blocked_job_types.add(job_type)
+
+        # tickets that can never fit within the limits would hold their reservation forever
+        can_ever_fit = instances_required <= min(instances_limit, ledger.total_limit(job_type))
+        if can_ever_fit and ticket_entry["SCHEDULING_TRIES"] >= reservation_tries:
+            if class_exhausted:
+                plan.reserved_classes.add(resource_class)
+            else:
+                plan.reserved_job_types.add(job_type)
+
+    plan.utilization = get_utilization(ledger)
+    return plan
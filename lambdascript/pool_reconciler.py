@@ -0,0 +1,161 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import constants
+
+from capacity import ACTIVE_STATUSES, get_ticket_name, parse_pool_key
+from s3_utils import BatchDeleter
+
+
+LOGGER = logging.getLogger(__name__)
+
+# statuses of training jobs and endpoints that hold instances
+ACTIVE_TRAINING_JOB_STATUSES = ("InProgress", "Stopping")
+ACTIVE_ENDPOINT_STATUSES = ("Creating", "Updating", "SystemUpdating", "RollingBack", "InService", "Deleting")
+
+
+def _iter_list_results(list_call, result_key, **kwargs):
+    """
+    :param list_call: SageMaker List* client method paginated with NextToken
+    :param result_key: <string> field of the response holding the results
+    :return: <generator> results of all pages
+    """
+    while True:
+        response = list_call(**kwargs)
+        for result in response.get(result_key, []):
+            yield result
+        if not response.get("NextToken"):
+            return
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def _get_training_job_usage(sagemaker_client, job_name):
+    resource_config = sagemaker_client.describe_training_job(TrainingJobName=job_name)["ResourceConfig"]
+    return [(resource_config["InstanceType"], "training", resource_config["InstanceCount"])]
+
+
+def _get_endpoint_usage(sagemaker_client, endpoint_name):
+    endpoint = sagemaker_client.describe_endpoint(EndpointName=endpoint_name)
+    endpoint_config = sagemaker_client.describe_endpoint_config(EndpointConfigName=endpoint["EndpointConfigName"])
+    return [
+        (variant["InstanceType"], "inference", variant["InitialInstanceCount"])
+        for variant in endpoint_config["ProductionVariants"]
+        if "InstanceType" in variant
+    ]
+
+
+def get_sagemaker_usage(sagemaker_client):
+    """
+    Count the instances held by the training jobs and endpoints that currently exist in SageMaker
+
+    :param sagemaker_client: boto3 SageMaker client
+    :return: <dict> (instance type, job type) -> number of instances in use
+    """
+    usage = {}
+    with ThreadPoolExecutor(max_workers=constants.SAGEMAKER_DESCRIBE_CONCURRENCY) as executor:
+        futures = []
+        for status in ACTIVE_TRAINING_JOB_STATUSES:
+            jobs = _iter_list_results(sagemaker_client.list_training_jobs, "TrainingJobSummaries", StatusEquals=status)
+            for job in jobs:
+                futures.append(executor.submit(_get_training_job_usage, sagemaker_client, job["TrainingJobName"]))
+        for endpoint in _iter_list_results(sagemaker_client.list_endpoints, "Endpoints"):
+            if endpoint["EndpointStatus"] in ACTIVE_ENDPOINT_STATUSES:
+                futures.append(executor.submit(_get_endpoint_usage, sagemaker_client, endpoint["EndpointName"]))
+        for future in futures:
+            for instance_type, job_type, num_of_instances in future.result():
+                usage[(instance_type, job_type)] = usage.get((instance_type, job_type), 0) + num_of_instances
+    return usage
+
+
+def get_in_progress_ticket_names(cb_client, now):
+    """
+    Go through the Job Executor builds from the latest back to the longest time a build can run, so that every build
+    still in progress is seen
+
+    :param cb_client: boto3 CodeBuild client
+    :param now: <datetime> timezone-aware current time
+    :return: <set> names of the tickets of the builds in progress
+    """
+    since = now - timedelta(seconds=constants.JOB_EXECUTOR_MAX_BUILD_SECONDS)
+    ticket_names = set()
+    kwargs = {"projectName": constants.JOB_EXECUTOR_PROJECT_NAME, "sortOrder": "DESCENDING"}
+    while True:
+        response = cb_client.list_builds_for_project(**kwargs)
+        if not response.get("ids"):
+            break
+        page = cb_client.batch_get_builds(ids=response["ids"])["builds"]
+        for build in page:
+            environment = {
+                variable["name"]: variable["value"] for variable in build["environment"]["environmentVariables"]
+            }
+            if build["buildStatus"] == "IN_PROGRESS" and "TICKET_KEY" in environment:
+                ticket_names.add(get_ticket_name(environment["TICKET_KEY"]))
+        if not response.get("nextToken") or not page or min(build["startTime"] for build in page) < since:
+            break
+        kwargs["nextToken"] = response["nextToken"]
+    return ticket_names
+
+
+def reconcile_resource_pool(s3_client, sagemaker_client, cb_client, bucket, pool_entries, now=None):
+    """
+    Reclaim the capacity held by resource pool entries whose SageMaker jobs no longer exist.
+    Pool entries do not name their SageMaker job, so the pool is reconciled by count: for each instance type and
+    job type, the instances booked by entries older than constants.POOL_RECONCILIATION_GRACE_SECONDS must be covered
+    by the instances SageMaker actually has in use, and the oldest entries in excess are deleted. Younger entries
+    are left alone, their job may not have been created yet. SageMaker is only queried when some entry is past
+    the grace period.
+    A Job Executor build may go without a SageMaker job for a while, before its first job or between two of its jobs,
+    so entries in excess are only deleted once the build of their ticket is no longer in progress.
+
+    :param s3_client: boto3 S3 client
+    :param sagemaker_client: boto3 SageMaker client
+    :param cb_client: boto3 CodeBuild client, only called when SageMaker does not account for some entries
+    :param bucket: <string> bucket name
+    :param pool_entries: <list> S3 object descriptors of the resource pool, as listed
+    :param now: <datetime> timezone-aware current time, defaults to now
+    :return: <set> keys of the pool entries deleted
+    """
+    now = now or datetime.now(timezone.utc)
+    # (instance type, job type) -> [(last modified, key, num of instances)] of the entries past the grace period
+    stale_entries = {}
+    for entry in pool_entries:
+        parsed = parse_pool_key(entry["Key"])
+        if parsed is None or parsed[3] not in ACTIVE_STATUSES:
+            continue
+        if (now - entry["LastModified"]).total_seconds() < constants.POOL_RECONCILIATION_GRACE_SECONDS:
+            continue
+        instance_type, job_type, num_of_instances, _ = parsed
+        stale_entries.setdefault((instance_type, job_type), []).append(
+            (entry["LastModified"], entry["Key"], num_of_instances)
+        )
+    if not stale_entries:
+        return set()
+
+    usage = get_sagemaker_usage(sagemaker_client)
+    excess_keys = []
+    for (instance_type, job_type), entries in stale_entries.items():
+        excess = sum(num_of_instances for _, _, num_of_instances in entries) - usage.get((instance_type, job_type), 0)
+        for _, key, num_of_instances in sorted(entries):
+            if excess <= 0:
+                break
+            # never reclaim more instances than are unaccounted for
+            if num_of_instances <= excess:
+                excess_keys.append(key)
+                excess -= num_of_instances
+    if not excess_keys:
+        return set()
+
+    in_progress_ticket_names = get_in_progress_ticket_names(cb_client, now)
+    deleter = BatchDeleter(s3_client, bucket)
+    for key in excess_keys:
+        if key.split("/")[-1].rpartition("#")[0] in in_progress_ticket_names:
+            LOGGER.info(f"Resource pool entry {key} has no SageMaker job, but its build is still in progress.")
+        else:
+            deleter.add(key)
+    deleter.flush()
+
+    for key in deleter.deleted_keys:
+        LOGGER.warning(f"Resource pool entry {key} has no SageMaker job left, its capacity is reclaimed.")
+    return set(deleter.deleted_keys)
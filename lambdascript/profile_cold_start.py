@@ -0,0 +1,68 @@
+"""
+Report the import-time cost of a lambda handler before deploying it, so cold-start regressions show up early.
+The handler module is imported in a fresh interpreter with cold-start profiling enabled, and the slowest imports
+are listed. With --max-import-ms, the script fails if importing the handler takes longer than the budget.
+
+Usage:
+    python profile_cold_start.py lambda_function.py
+    python profile_cold_start.py ../cleanup-lambda/lambda_function.py --max-import-ms 200
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# run in the fresh interpreter: cold_start is imported first, so it sees every import of the handler
+PROFILE_IMPORT_CODE = """
+import importlib, json, sys, time
+import cold_start
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+report = cold_start.get_report()
+report["HANDLER_IMPORT_SECONDS"] = round(time.perf_counter() - start, 4)
+print(json.dumps(report))
+"""
+
+
+def profile_handler_import(handler_path):
+    """
+    :param handler_path: <string> path to the handler module of a lambda
+    :return: <dict> cold-start report of importing the handler
+    """
+    handler_dir, handler_file = os.path.split(os.path.abspath(handler_path))
+    module_name = os.path.splitext(handler_file)[0]
+    # the handler directory comes first, the shared modules of lambdascript after it
+    python_path = os.pathsep.join([handler_dir, os.path.dirname(os.path.abspath(__file__))])
+    env = dict(os.environ, PYTHONPATH=python_path, COLD_START_PROFILING="1", PYTHONDONTWRITEBYTECODE="1")
+    output = subprocess.run(
+        [sys.executable, "-c", PROFILE_IMPORT_CODE, module_name],
+        cwd=handler_dir,
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the import-time cost of a lambda handler")
+    parser.add_argument("handler", help="path to the handler module, e.g. lambda_function.py")
+    parser.add_argument("--max-import-ms", type=float, help="fail if importing the handler takes longer")
+    args = parser.parse_args()
+
+    report = profile_handler_import(args.handler)
+    import_ms = report["HANDLER_IMPORT_SECONDS"] * 1000
+    print(f"Importing {args.handler} took {import_ms:.1f} ms, slowest imports (inclusive):")
+    for module_name, seconds in report["IMPORT_SECONDS"].items():
+        print(f"  {module_name}: {seconds * 1000:.1f} ms")
+
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print(f"Import time above the budget of {args.max_import_ms} ms.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""
+Offline replay of recorded scheduler traces, for capacity planning.
+The traces written by run_trace are turned into a workload: when each ticket was requested, what it asked for, and
+how long its build held its instances, from the time it was dispatched to the time its capacity was released.
+The workload is then scheduled again in simulated time, much faster than real time, by the planner of the scheduler
+with other instance limits, another cadence of the scheduler runs or another scheduling policy. Reported: queue wait
+percentiles of the dispatched tickets, utilization of each resource class, and the dead letter rate.
+Builds whose release was not recorded hold their instances for the median duration of their resource class.
+
+Usage:
+    python replay.py traces/                                    # replay with the current limits
+    python replay.py traces/ --limit ml.p3.8xlarge-training=8 --total training=60 --cadence 300 --policy fifo
+    python replay.py --bucket dlc-test-tickets --prefix scheduler_traces/2026-10- --json
+"""
+import argparse
+import glob
+import gzip
+import heapq
+import json
+import os
+import statistics
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+import constants
+import run_trace
+
+from capacity import CapacityLedger
+from clients import get_client_provider
+from lambda_function import get_dead_letter_reason
+from planner import get_next_eligible_time, plan_run
+from s3_utils import iter_keys
+from scheduling_queue import SchedulingQueue
+
+
+DEFAULT_CADENCE_SECONDS = 60
+# duration of the builds of resource classes with no release recorded at all
+DEFAULT_BUILD_SECONDS = 3600
+WAIT_PERCENTILES = (50, 90, 99)
+
+
+def _order_by_priority(ticket_keys, entries, now):
+    scheduling_queue = SchedulingQueue(now=now)
+    for ticket_key in ticket_keys:
+        scheduling_queue.push(ticket_key, entries[ticket_key])
+    return list(scheduling_queue.drain())
+
+
+def _order_by_request_time(ticket_keys, entries, now):
+    return sorted(ticket_keys, key=lambda ticket_key: (entries[ticket_key]["TIMESTAMP"], ticket_key))
+
+
+def _order_by_size(ticket_keys, entries, now):
+    return sorted(
+        ticket_keys,
+        key=lambda ticket_key: (entries[ticket_key]["INSTANCES_NUM"], entries[ticket_key]["TIMESTAMP"], ticket_key),
+    )
+
+
+# scheduling policy -> function ordering the queued tickets of a run
+POLICIES = {
+    "priority": _order_by_priority,
+    "fifo": _order_by_request_time,
+    "smallest-first": _order_by_size,
+}
+
+
+def load_traces(paths):
+    """
+    :param paths: <list> trace files, or directories searched recursively for .json.gz and .json traces
+    :return: <list> content of the traces
+    """
+    trace_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in ("*.json.gz", "*.json"):
+                trace_files.extend(glob.glob(os.path.join(path, "**", pattern), recursive=True))
+        else:
+            trace_files.append(path)
+    traces = []
+    for trace_file in sorted(set(trace_files)):
+        opener = gzip.open if trace_file.endswith(".gz") else open
+        with opener(trace_file, "rt") as trace:
+            traces.append(json.load(trace))
+    return traces
+
+
+def load_traces_from_s3(s3_client, bucket, prefix=constants.TRACE_PREFIX):
+    """
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param prefix: <string> key prefix of the traces to load, e.g. of a single day
+    :return: <list> content of the traces
+    """
+    traces = []
+    for key in iter_keys(s3_client, bucket, prefix, suffix=".json.gz"):
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        traces.append(json.loads(gzip.decompress(body).decode("utf-8")))
+    return traces
+
+
+def build_workload(traces):
+    """
+    Merge the traces into one workload: every ticket seen by any run, with the duration of its build when both its
+    dispatch and its release were recorded
+
+    :param traces: <list> content of the traces
+    :return: <dict> ticket key -> {CONTEXT, TIMESTAMP, INSTANCE_TYPE, JOB_TYPE, INSTANCES_NUM, TIMEOUT_LIMIT,
+    BUILD_SECONDS}
+    """
+    workload = {}
+    dispatch_times = {}
+    release_times = {}
+    for trace in sorted(traces, key=lambda trace: trace["START"]):
+        run_start = datetime.fromisoformat(trace["START"])
+        for ticket_key, fields in trace["TICKETS"].items():
+            if ticket_key not in workload:
+                ticket = dict(zip(run_trace.TICKET_FIELDS, fields))
+                # the workload starts every ticket over, as when it was submitted
+                del ticket["SCHEDULING_TRIES"]
+                workload[ticket_key] = ticket
+        for seconds, ticket_key, decision in trace["DECISIONS"]:
+            decision_time = run_start + timedelta(seconds=seconds)
+            if decision == run_trace.DISPATCHED:
+                dispatch_times.setdefault(ticket_key, decision_time)
+            elif decision == run_trace.RELEASED:
+                release_times.setdefault(ticket_key, decision_time)
+
+    # resource class -> recorded build durations
+    durations = {}
+    for ticket_key, ticket in workload.items():
+        if ticket_key in dispatch_times and ticket_key in release_times:
+            build_seconds = (release_times[ticket_key] - dispatch_times[ticket_key]).total_seconds()
+            ticket["BUILD_SECONDS"] = max(0.0, build_seconds)
+            durations.setdefault((ticket["INSTANCE_TYPE"], ticket["JOB_TYPE"]), []).append(ticket["BUILD_SECONDS"])
+    for ticket in workload.values():
+        if "BUILD_SECONDS" not in ticket:
+            class_durations = durations.get((ticket["INSTANCE_TYPE"], ticket["JOB_TYPE"]))
+            ticket["BUILD_SECONDS"] = statistics.median(class_durations) if class_durations else DEFAULT_BUILD_SECONDS
+    return workload
+
+
+def get_percentile(values, percentile):
+    """
+    :param values: <list> sorted values
+    :param percentile: <int> percentile, 0 to 100
+    :return: <float> nearest-rank percentile of the values, None if there are none
+    """
+    if not values:
+        return None
+    rank = max(0, -(-percentile * len(values) // 100) - 1)
+    return values[rank]
+
+
+class _UtilizationTracker:
+    """
+    Time-weighted use of the instances of each resource class over the simulation
+    """
+
+    def __init__(self, ledger, start):
+        self._ledger = ledger
+        # time up to which the use is accounted for
+        self.last_time = start
+        # resource class -> instance-seconds in use
+        self.instance_seconds = {resource_class: 0.0 for resource_class in ledger.resource_classes()}
+        self.peak = {resource_class: 0 for resource_class in ledger.resource_classes()}
+
+    def advance(self, now, in_use):
+        """
+        :param now: <datetime> time the usage changes
+        :param in_use: <dict> resource class -> instances in use since the last change
+        """
+        elapsed_seconds = (now - self.last_time).total_seconds()
+        for resource_class, instances in in_use.items():
+            self.instance_seconds[resource_class] = self.instance_seconds.get(resource_class, 0.0) + (
+                instances * elapsed_seconds
+            )
+            self.peak[resource_class] = max(self.peak.get(resource_class, 0), instances)
+        self.last_time = now
+
+    def report(self, total_seconds):
+        """
+        :param total_seconds: <float> simulated time
+        :return: <dict> "(instance type)-(job type)" -> {"AVERAGE_IN_USE", "PEAK_IN_USE", "LIMIT", "UTILIZATION"}
+        """
+        report = {}
+        for (instance_type, job_type), instance_seconds in sorted(self.instance_seconds.items()):
+            limit = self._ledger.limit(instance_type, job_type)
+            # classes that were never available nor used
+            if not limit and not self.peak.get((instance_type, job_type)):
+                continue
+            average = instance_seconds / total_seconds if total_seconds else 0.0
+            report[f"{instance_type}-{job_type}"] = {
+                "AVERAGE_IN_USE": round(average, 2),
+                "PEAK_IN_USE": self.peak.get((instance_type, job_type), 0),
+                "LIMIT": limit,
+                "UTILIZATION": round(100 * average / limit, 1) if limit else 0.0,
+            }
+        return report
+
+
+def simulate(workload, cadence_seconds=DEFAULT_CADENCE_SECONDS, policy="priority", reservation_tries=None, **limits):
+    """
+    Schedule the workload in simulated time: a scheduler run every cadence_seconds plans the queued tickets with the
+    planner of the scheduler, dispatched builds hold their instances for their recorded duration, and blocked tickets
+    go through the same retry accounting, backoff and dead letter rules as in production.
+    Time jumps straight to the next run with something to do, so idle periods cost nothing.
+
+    :param workload: <dict> ticket key -> ticket, as built by build_workload
+    :param cadence_seconds: <int> time between two scheduler runs
+    :param policy: <string> scheduling policy, a key of POLICIES
+    :param reservation_tries: <int> scheduling tries after which a blocked ticket reserves capacity
+    :param limits: training_limit, inference_limit and total_limits of the CapacityLedger, the current limits
+    by default
+    :return: <dict> report of the replay
+    """
+    order = POLICIES[policy]
+    # tickets by request time
+    arrivals = sorted(
+        (datetime.strptime(ticket["TIMESTAMP"], constants.TIMESTAMP_FORMAT), ticket_key)
+        for ticket_key, ticket in workload.items()
+    )
+    if not arrivals:
+        return {"TICKETS": 0}
+    start = arrivals[0][0]
+    now = start
+    utilization = _UtilizationTracker(CapacityLedger(**limits), start)
+    # ticket key -> index entry of the queued tickets
+    queued = {}
+    # (end time, ticket key) of the running builds
+    running = []
+    in_use = {}
+    waits = {}
+    dead_letter_reasons = {}
+    num_of_runs = 0
+    next_arrival = 0
+
+    while next_arrival < len(arrivals) or queued or running:
+        # nothing to plan until the next request or the next completed build: skip the runs in between
+        if not queued:
+            next_events = [end_time for end_time, _ in running[:1]]
+            if next_arrival < len(arrivals):
+                next_events.append(arrivals[next_arrival][0])
+            idle_runs = (min(next_events) - now).total_seconds() // cadence_seconds
+            now += timedelta(seconds=max(0, idle_runs) * cadence_seconds)
+
+        # builds completed since the last run give their capacity back
+        while running and running[0][0] <= now:
+            end_time, ticket_key = heapq.heappop(running)
+            utilization.advance(end_time, in_use)
+            resource_class = (workload[ticket_key]["INSTANCE_TYPE"], workload[ticket_key]["JOB_TYPE"])
+            in_use[resource_class] -= workload[ticket_key]["INSTANCES_NUM"]
+        utilization.advance(now, in_use)
+
+        while next_arrival < len(arrivals) and arrivals[next_arrival][0] <= now:
+            ticket_key = arrivals[next_arrival][1]
+            queued[ticket_key] = dict(workload[ticket_key], SCHEDULING_TRIES=0)
+            next_arrival += 1
+
+        if queued:
+            num_of_runs += 1
+            ledger = CapacityLedger(**limits)
+            for (instance_type, job_type), instances in in_use.items():
+                ledger.book(instance_type, job_type, instances)
+            plan = plan_run(order(list(queued), queued, now), queued, ledger, reservation_tries, now=now)
+            for ticket_key in plan.dispatch:
+                ticket = queued.pop(ticket_key)
+                resource_class = (ticket["INSTANCE_TYPE"], ticket["JOB_TYPE"])
+                in_use[resource_class] = in_use.get(resource_class, 0) + ticket["INSTANCES_NUM"]
+                heapq.heappush(running, (now + timedelta(seconds=ticket["BUILD_SECONDS"]), ticket_key))
+                request_time = datetime.strptime(ticket["TIMESTAMP"], constants.TIMESTAMP_FORMAT)
+                waits[ticket_key] = max(0.0, (now - request_time).total_seconds())
+            for ticket_key in plan.blocked:
+                ticket = queued[ticket_key]
+                dead_letter_reason = get_dead_letter_reason(ticket, now)
+                if dead_letter_reason is not None:
+                    dead_letter_reasons[ticket_key] = dead_letter_reason
+                    del queued[ticket_key]
+                    continue
+                ticket["SCHEDULING_TRIES"] += 1
+                ticket["NEXT_ELIGIBLE"] = get_next_eligible_time(ticket["SCHEDULING_TRIES"], now)
+        now += timedelta(seconds=cadence_seconds)
+
+    # the simulation ends once the last build completed
+    total_seconds = (utilization.last_time - start).total_seconds()
+    return format_report(workload, waits, dead_letter_reasons, utilization.report(total_seconds), num_of_runs)
+
+
+def format_report(workload, waits, dead_letter_reasons, utilization, num_of_runs):
+    """
+    :return: <dict> report of the replay
+    """
+    wait_seconds = sorted(waits.values())
+    # resource class -> sorted waits of its dispatched tickets
+    class_waits = {}
+    for ticket_key, wait in waits.items():
+        resource_class = f"{workload[ticket_key]['INSTANCE_TYPE']}-{workload[ticket_key]['JOB_TYPE']}"
+        class_waits.setdefault(resource_class, []).append(wait)
+    return {
+        "TICKETS": len(workload),
+        "DISPATCHED": len(waits),
+        "DEAD_LETTERED": len(dead_letter_reasons),
+        "DEAD_LETTER_RATE": round(100 * len(dead_letter_reasons) / len(workload), 2),
+        "DEAD_LETTER_REASONS": dict(sorted(Counter(dead_letter_reasons.values()).items())),
+        "SCHEDULER_RUNS": num_of_runs,
+        "WAIT_SECONDS": {f"P{percentile}": get_percentile(wait_seconds, percentile) for percentile in WAIT_PERCENTILES},
+        "CLASS_WAIT_SECONDS": {
+            resource_class: {
+                f"P{percentile}": get_percentile(sorted(waits_of_class), percentile) for percentile in WAIT_PERCENTILES
+            }
+            for resource_class, waits_of_class in sorted(class_waits.items())
+        },
+        "UTILIZATION": utilization,
+    }
+
+
+def parse_limits(limit_args, total_args):
+    """
+    :param limit_args: <list> "(instance type)-(job type)=(limit)" overrides of the current limits
+    :param total_args: <list> "(job type)=(limit)" overrides of the current total limits
+    :return: <dict> training_limit, inference_limit and total_limits arguments of the CapacityLedger
+    """
+    limits = {
+        "training_limit": dict(constants.TRAINING_LIMIT),
+        "inference_limit": dict(constants.INFERENCE_LIMIT),
+        "total_limits": {
+            "training": constants.TOTAL_INSTANCE_TRAINING,
+            "inference": constants.TOTAL_INSTANCE_INFERENCE,
+        },
+    }
+    for limit_arg in limit_args:
+        resource_class, limit = limit_arg.split("=")
+        instance_type, job_type = resource_class.rsplit("-", 1)
+        limits[f"{job_type}_limit"][instance_type] = int(limit)
+    for total_arg in total_args:
+        job_type, limit = total_arg.split("=")
+        limits["total_limits"][job_type] = int(limit)
+    return limits
+
+
+def format_results(report):
+    """
+    :param report: <dict> report of the replay
+    :return: <string> human readable report
+    """
+    if not report["TICKETS"]:
+        return "No ticket in the traces."
+    waits = ", ".join(f"{name}={seconds}s" for name, seconds in report["WAIT_SECONDS"].items())
+    lines = [
+        f"{report['TICKETS']} tickets over {report['SCHEDULER_RUNS']} scheduler runs: "
+        f"{report['DISPATCHED']} dispatched, {report['DEAD_LETTERED']} dead-lettered ({report['DEAD_LETTER_RATE']}%)",
+        f"  queue wait: {waits}",
+    ]
+    for resource_class, class_waits in report["CLASS_WAIT_SECONDS"].items():
+        waits = ", ".join(f"{name}={seconds}s" for name, seconds in class_waits.items())
+        lines.append(f"    {resource_class}: {waits}")
+    lines.append("  utilization:")
+    for resource_class, usage in report["UTILIZATION"].items():
+        lines.append(
+            f"    {resource_class}: {usage['UTILIZATION']}% of {usage['LIMIT']} instances "
+            f"(average {usage['AVERAGE_IN_USE']}, peak {usage['PEAK_IN_USE']})"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded scheduler traces with other limits or policies")
+    parser.add_argument("paths", nargs="*", help="trace files or directories of traces")
+    parser.add_argument("--bucket", help="load the traces from this bucket instead of local paths")
+    parser.add_argument("--prefix", default=constants.TRACE_PREFIX, help="key prefix of the traces in the bucket")
+    parser.add_argument(
+        "--limit", action="append", default=[], help="limit of a resource class, e.g. ml.p3.8xlarge-training=8"
+    )
+    parser.add_argument("--total", action="append", default=[], help="total limit of a job type, e.g. training=60")
+    parser.add_argument("--cadence", type=int, default=DEFAULT_CADENCE_SECONDS, help="seconds between scheduler runs")
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="priority", help="scheduling policy")
+    parser.add_argument("--reservation-tries", type=int, help="tries after which a blocked ticket reserves capacity")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.bucket:
+        traces = load_traces_from_s3(get_client_provider().client("s3"), args.bucket, args.prefix)
+    else:
+        traces = load_traces(args.paths)
+    report = simulate(
+        build_workload(traces),
+        cadence_seconds=args.cadence,
+        policy=args.policy,
+        reservation_tries=args.reservation_tries,
+        **parse_limits(args.limit, args.total),
+    )
+    print(json.dumps(report) if args.json else format_results(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import json
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+import constants
+
+
+LOGGER = logging.getLogger(__name__)
+
+# error codes of a conditional write that lost against a concurrent write
+CONDITIONAL_WRITE_CONFLICTS = ("PreconditionFailed", "ConditionalRequestConflict")
+
+
+class Deadline:
+    """
+    Time budget of a single invocation, driven by the Lambda context.
+    The run stops taking on new tickets once less than the safety margin is left, so a ticket is never
+    cut off half-way through its transition.
+    """
+
+    def __init__(self, context=None, safety_margin_seconds=None):
+        """
+        :param context: Lambda context object; without get_remaining_time_in_millis the budget falls back
+        to constants.TIMEOUT_LIMIT_SECONDS from now
+        :param safety_margin_seconds: <int> time kept in reserve to finish the current ticket and save state
+        """
+        self._safety_margin_seconds = (
+            constants.DEADLINE_SAFETY_MARGIN_SECONDS if safety_margin_seconds is None else safety_margin_seconds
+        )
+        if hasattr(context, "get_remaining_time_in_millis"):
+            self._get_remaining_millis = context.get_remaining_time_in_millis
+        else:
+            end_time = time.monotonic() + constants.TIMEOUT_LIMIT_SECONDS
+            self._get_remaining_millis = lambda: int((end_time - time.monotonic()) * 1000)
+
+    def remaining_seconds(self):
+        """
+        :return: <float> seconds left before the invocation is killed
+        """
+        return self._get_remaining_millis() / 1000
+
+    def expired(self):
+        """
+        :return: <bool> True if no new ticket should be started anymore
+        """
+        return self.remaining_seconds() <= self._safety_margin_seconds
+
+
+class ResumeCursor:
+    """
+    Records which tickets of the current pass over the queue have already been handled.
+    A run that stops at its deadline saves the cursor, and the next invocation skips those tickets and carries on
+    with the rest of the queue; the cursor is cleared once a pass gets through the whole queue.
+    Runs overlapping in time write the cursor with conditional writes: a run that lost against a concurrent save
+    merges the tickets handled by the other run, and a run never clears a cursor saved since it loaded it.
+    """
+
+    def __init__(self, handled_keys=None, etag=None):
+        """
+        :param handled_keys: <iterable> keys of the tickets handled earlier in the current pass
+        :param etag: <string> ETag of the cursor object the keys were read from, None if there is no cursor
+        """
+        self.handled_keys = set(handled_keys or [])
+        self.etag = etag
+
+    @classmethod
+    def load(cls, s3_client, bucket, key=constants.RESUME_CURSOR_KEY):
+        """
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param key: <string> key of the cursor object
+        :return: <ResumeCursor> the saved cursor, empty if the last pass completed
+        """
+        try:
+            cursor_object = s3_client.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return cls()
+        cursor = json.loads(cursor_object["Body"].read().decode("utf-8"))
+        LOGGER.info(f"Resuming the previous pass, {len(cursor['HANDLED_KEYS'])} tickets already handled.")
+        return cls(cursor["HANDLED_KEYS"], etag=cursor_object["ETag"])
+
+    def __contains__(self, ticket_key):
+        return ticket_key in self.handled_keys
+
+    def mark_handled(self, ticket_key):
+        """
+        :param ticket_key: <string> key of a ticket handled in this run
+        """
+        self.handled_keys.add(ticket_key)
+
+    def save(self, s3_client, bucket, queued_keys, key=constants.RESUME_CURSOR_KEY):
+        """
+        Save the cursor of an unfinished pass
+
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param queued_keys: <container> keys of the tickets still queued; handled tickets that left the queue are
+        not worth remembering
+        :param key: <string> key of the cursor object
+        """
+        for attempt in range(1, constants.STATE_WRITE_ATTEMPTS + 1):
+            handled_keys = sorted(ticket_key for ticket_key in self.handled_keys if ticket_key in queued_keys)
+            conditions = {"IfMatch": self.etag} if self.etag is not None else {"IfNoneMatch": "*"}
+            try:
+                response = s3_client.put_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Body=json.dumps({"HANDLED_KEYS": handled_keys}).encode("UTF-8"),
+                    **conditions,
+                )
+            except ClientError as e:
+                # the cursor was saved or cleared by a concurrent run since it was loaded
+                conflict = e.response["Error"]["Code"] in CONDITIONAL_WRITE_CONFLICTS + ("NoSuchKey",)
+                if not conflict or attempt == constants.STATE_WRITE_ATTEMPTS:
+                    raise
+                LOGGER.info("Resume cursor written by a concurrent run, merging the tickets it handled.")
+                latest = ResumeCursor.load(s3_client, bucket, key)
+                self.handled_keys.update(latest.handled_keys)
+                self.etag = latest.etag
+                continue
+            self.etag = response["ETag"]
+            return
+
+    def clear(self, s3_client, bucket, key=constants.RESUME_CURSOR_KEY):
+        """
+        Remove the cursor once a pass went through the whole queue
+
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param key: <string> key of the cursor object
+        """
+        if self.etag is None:
+            return
+        try:
+            s3_client.delete_object(Bucket=bucket, Key=key, IfMatch=self.etag)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in CONDITIONAL_WRITE_CONFLICTS + ("NoSuchKey",):
+                raise
+            LOGGER.info("Resume cursor saved by a concurrent run since it was loaded, keeping it.")
+        self.etag = None
+
+
+def get_shard_name(shard):
+    """
+    :param shard: <tuple> (instance type, job type) of the shard
+    :return: <string> name of the shard, e.g. ml.p3.8xlarge-training
+    """
+    return "-".join(shard)
+
+
+class ShardLeases:
+    """
+    Leases on the shards of the scheduler, one shard per resource class, so that scheduler runs overlapping in time
+    never book the same capacity: a run only schedules the tickets of the shards it holds the lease of, and other
+    runs work on the other shards in parallel.
+    A lease is an S3 object taken over with conditional writes, so of two runs racing for a shard only one wins.
+    It expires when the invocation holding it would be killed, so the shards of a crashed run are free again
+    after at most one Lambda timeout.
+    """
+
+    def __init__(self, s3_client, bucket, owner, prefix=constants.SHARD_LEASE_PREFIX):
+        """
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param owner: <string> unique id of the current run, e.g. the Lambda request id
+        :param prefix: <string> key prefix of the lease objects
+        """
+        self._s3_client = s3_client
+        self._bucket = bucket
+        self._owner = owner
+        self._prefix = prefix
+        # shard -> ETag of the lease object written by this run
+        self._held = {}
+        # shard -> epoch time the lease held by this run expires
+        self._expires = {}
+
+    def _write(self, shard, expires, **conditions):
+        response = self._s3_client.put_object(
+            Bucket=self._bucket,
+            Key=f"{self._prefix}{get_shard_name(shard)}.json",
+            Body=json.dumps({"OWNER": self._owner, "EXPIRES": expires}).encode("UTF-8"),
+            **conditions,
+        )
+        return response["ETag"]
+
+    def acquire(self, shard, duration_seconds):
+        """
+        Take the lease of a shard, unless another run holds it
+
+        :param shard: <tuple> (instance type, job type) of the shard
+        :param duration_seconds: <float> time until the lease expires
+        :return: <bool> True if the current run holds the lease
+        """
+        if shard in self._held:
+            return True
+        try:
+            lease_object = self._s3_client.get_object(
+                Bucket=self._bucket, Key=f"{self._prefix}{get_shard_name(shard)}.json"
+            )
+            conditions = {"IfMatch": lease_object["ETag"]}
+            lease = json.loads(lease_object["Body"].read().decode("utf-8"))
+            if lease["OWNER"] != self._owner and lease["EXPIRES"] > time.time():
+                return False
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            conditions = {"IfNoneMatch": "*"}
+
+        expires = time.time() + duration_seconds
+        try:
+            self._held[shard] = self._write(shard, expires, **conditions)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in CONDITIONAL_WRITE_CONFLICTS + ("NoSuchKey",):
+                raise
+            LOGGER.info(f"Lease of shard {get_shard_name(shard)} taken by a concurrent run.")
+            return False
+        self._expires[shard] = expires
+        return True
+
+    def held(self):
+        """
+        :return: <set> shards the current run holds the lease of
+        """
+        return set(self._held)
+
+    def expires(self):
+        """
+        :return: <float> epoch time the first lease held by the current run expires, None if no lease is held
+        """
+        return min(self._expires.values(), default=None)
+
+    def release_all(self):
+        """
+        Give back all leases held by the current run, by marking them expired
+        """
+        for shard, etag in self._held.items():
+            try:
+                self._write(shard, 0, IfMatch=etag)
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in CONDITIONAL_WRITE_CONFLICTS + ("NoSuchKey",):
+                    raise
+                LOGGER.warning(f"Lease of shard {get_shard_name(shard)} expired and was taken over before release.")
+        self._held = {}
+        self._expires = {}
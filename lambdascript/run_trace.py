@@ -0,0 +1,167 @@
+"""
+Traces of the scheduler runs, for capacity planning.
+Setting the SCHEDULER_TRACING environment variable to 1 on the function makes every run write a compact trace of
+what it saw and did: the tickets it considered, the capacity of each resource class before planning, every decision
+it made on a ticket with its time into the run, and the time spent in each phase. replay.py reruns the traces
+offline with other limits, cadences or scheduling policies.
+Without the variable, the trace of a run records nothing and is never written.
+
+Traces are gzipped JSON, under (prefix)(date)/(run start)-(run id).json.gz:
+    {"RUN_ID", "KIND", "START" (ISO 8601), "TICKETS": {key: [CONTEXT, TIMESTAMP, INSTANCE_TYPE, JOB_TYPE, INSTANCES_NUM,
+    SCHEDULING_TRIES, TIMEOUT_LIMIT]}, "CAPACITY": {resource class: [IN_USE, LIMIT]},
+    "DECISIONS": [[seconds into the run, key, decision]], "PHASE_SECONDS": {phase: seconds}}
+"""
+import gzip
+import json
+import os
+import threading
+import time
+
+import constants
+
+from planner import get_utilization
+
+
+TRACING_ENV_VARIABLE = "SCHEDULER_TRACING"
+# fields of the index entries kept in a trace, in the order of the TICKETS lists
+TICKET_FIELDS = (
+    "CONTEXT",
+    "TIMESTAMP",
+    "INSTANCE_TYPE",
+    "JOB_TYPE",
+    "INSTANCES_NUM",
+    "SCHEDULING_TRIES",
+    "TIMEOUT_LIMIT",
+)
+
+# decisions made on a ticket
+DISPATCHED = "dispatched"
+START_FAILED = "start_failed"
+BLOCKED = "blocked"
+DEFERRED = "deferred"
+DEAD_LETTERED = "dead_lettered"
+# the build of the ticket completed and its capacity was released
+RELEASED = "released"
+
+
+def tracing_enabled():
+    """
+    :return: <bool> True if trace recording is turned on for the function
+    """
+    return os.environ.get(TRACING_ENV_VARIABLE, "") == "1"
+
+
+class RunTrace:
+    """
+    Trace of a single run; all record methods are no-ops unless the trace is enabled
+    """
+
+    def __init__(self, run_id, kind, start_time, enabled=False):
+        """
+        :param run_id: <string> unique id of the run
+        :param kind: <string> kind of run, e.g. reconcile, incremental or completion
+        :param start_time: <datetime> start of the run
+        :param enabled: <bool> True to record the run
+        """
+        self.enabled = enabled
+        self.run_id = run_id
+        self.kind = kind
+        self.start_time = start_time
+        self.tickets = {}
+        self.capacity = {}
+        self.decisions = []
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record_tickets(self, index, ticket_keys):
+        """
+        :param index: <TicketIndex> ticket index of the run
+        :param ticket_keys: <iterable> keys of the tickets considered by the run
+        """
+        if not self.enabled:
+            return
+        for ticket_key in ticket_keys:
+            ticket_entry = index.get(ticket_key)
+            if ticket_entry is not None:
+                self.tickets[ticket_key] = [ticket_entry.get(field) for field in TICKET_FIELDS]
+
+    def record_capacity(self, ledger):
+        """
+        :param ledger: <CapacityLedger> capacity ledger of the run, before planning
+        """
+        if not self.enabled:
+            return
+        utilization = get_utilization(ledger)
+        self.capacity = {
+            resource_class: [usage["IN_USE"], usage["LIMIT"]] for resource_class, usage in utilization.items()
+        }
+
+    def record_decision(self, ticket_key, decision):
+        """
+        :param ticket_key: <string> key of the ticket
+        :param decision: <string> decision made on the ticket, e.g. DISPATCHED
+        """
+        if not self.enabled:
+            return
+        # dispatch outcomes come in from several threads
+        with self._lock:
+            self.decisions.append([round(time.monotonic() - self._start, 3), ticket_key, decision])
+
+    def to_document(self, phase_seconds=None):
+        """
+        :param phase_seconds: <dict> phase -> seconds spent in the run
+        :return: <dict> content of the trace
+        """
+        return {
+            "RUN_ID": self.run_id,
+            "KIND": self.kind,
+            "START": self.start_time.isoformat(),
+            "TICKETS": self.tickets,
+            "CAPACITY": self.capacity,
+            "DECISIONS": self.decisions,
+            "PHASE_SECONDS": {phase: round(seconds, 3) for phase, seconds in (phase_seconds or {}).items()},
+        }
+
+    def save(self, s3_client, bucket, phase_seconds=None, prefix=constants.TRACE_PREFIX):
+        """
+        Write the trace of the run, if it is enabled
+
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param phase_seconds: <dict> phase -> seconds spent in the run
+        :param prefix: <string> key prefix of the traces
+        :return: <string> key of the trace, None if the trace is not enabled
+        """
+        if not self.enabled:
+            return None
+        key = (
+            f"{prefix}{self.start_time.strftime('%Y-%m-%d')}/"
+            f"{self.start_time.strftime(constants.TIMESTAMP_FORMAT)}-{self.run_id}.json.gz"
+        )
+        body = gzip.compress(json.dumps(self.to_document(phase_seconds), separators=(",", ":")).encode("UTF-8"))
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body, ContentEncoding="gzip")
+        return key
+
+
+_trace = RunTrace(None, None, None)
+
+
+def start_run(run_id, kind, start_time):
+    """
+    Start the trace of a new run, recording only if tracing is turned on for the function
+
+    :param run_id: <string> unique id of the run
+    :param kind: <string> kind of run, e.g. reconcile, incremental or completion
+    :param start_time: <datetime> start of the run
+    :return: <RunTrace>
+    """
+    global _trace
+    _trace = RunTrace(run_id, kind, start_time, enabled=tracing_enabled())
+    return _trace
+
+
+def get_trace():
+    """
+    :return: <RunTrace> trace of the current run
+    """
+    return _trace
@@ -0,0 +1,234 @@
+import json
+import logging
+import queue
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+
+LOGGER = logging.getLogger(__name__)
+
+# delete_objects accepts at most 1000 keys per request
+MAX_KEYS_PER_DELETE = 1000
+
+# sentinel placed on the page queue once the listing is exhausted
+_END_OF_LISTING = object()
+
+
+def _put_until_stopped(page_queue, item, stop_event):
+    """
+    :param page_queue: <queue.Queue> bounded queue shared with the consumer
+    :param item: item to hand over to the consumer
+    :param stop_event: <threading.Event> set by the consumer when it stops iterating early
+    :return: <bool> True if the item was queued, False if the consumer stopped first
+    """
+    while not stop_event.is_set():
+        try:
+            page_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _fetch_pages(s3_client, bucket, prefix, page_size, start_after, page_queue, stop_event):
+    """
+    Walk the list_objects_v2 pagination of a prefix and hand each page's objects over to the consumer
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param prefix: <string> key prefix to list
+    :param page_size: <int> max number of keys requested per page
+    :param start_after: <string> only keys after this one are listed, None to list the whole prefix
+    :param page_queue: <queue.Queue> bounded queue shared with the consumer
+    :param stop_event: <threading.Event> set by the consumer when it stops iterating early
+    """
+    try:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        start = {"StartAfter": start_after} if start_after else {}
+        pages = paginator.paginate(
+            Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": page_size}, **start
+        )
+        for page in pages:
+            # an empty prefix returns a page without the "Contents" field
+            if not _put_until_stopped(page_queue, page.get("Contents", []), stop_event):
+                return
+        _put_until_stopped(page_queue, _END_OF_LISTING, stop_event)
+    except Exception as e:
+        _put_until_stopped(page_queue, e, stop_event)
+
+
+def iter_objects(s3_client, bucket, prefix, page_size=1000, prefetch_pages=1, start_after=None):
+    """
+    Yield the object descriptors under a prefix, one page at a time.
+    The next pages are listed on a background thread while the current page is consumed, and at most
+    prefetch_pages pages are held in memory at once, so backlogs of any size can be streamed.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param prefix: <string> key prefix to list
+    :param page_size: <int> max number of keys requested per page (S3 caps this at 1000)
+    :param prefetch_pages: <int> number of pages that may be listed ahead of the consumer
+    :param start_after: <string> only keys after this one are listed, e.g. to resume an earlier listing
+    :return: <generator> S3 object descriptors as returned in the "Contents" of list_objects_v2
+    """
+    page_queue = queue.Queue(maxsize=max(1, prefetch_pages))
+    stop_event = threading.Event()
+    fetcher = threading.Thread(
+        target=_fetch_pages,
+        args=(s3_client, bucket, prefix, page_size, start_after, page_queue, stop_event),
+        daemon=True,
+    )
+    fetcher.start()
+
+    try:
+        while True:
+            contents = page_queue.get()
+            if contents is _END_OF_LISTING:
+                return
+            if isinstance(contents, Exception):
+                raise contents
+            for entry in contents:
+                yield entry
+    finally:
+        stop_event.set()
+
+
+def iter_keys(s3_client, bucket, prefix, suffix="", **kwargs):
+    """
+    Yield the keys under a prefix that end with the given suffix
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param prefix: <string> key prefix to list
+    :param suffix: <string> only keys ending with this suffix are yielded
+    :return: <generator> <string> object keys
+    """
+    for entry in iter_objects(s3_client, bucket, prefix, **kwargs):
+        if entry["Key"].endswith(suffix):
+            yield entry["Key"]
+
+
+def read_json_object(s3_client, bucket, key, with_etag=False):
+    """
+    Download and parse a JSON object
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param key: <string> key of the object
+    :param with_etag: <bool> also return the ETag of the object
+    :return: <dict> parsed content of the object, or (parsed content, ETag) if with_etag
+    """
+    s3_object = s3_client.get_object(Bucket=bucket, Key=key)
+    content = json.loads(s3_object["Body"].read().decode("utf-8"))
+    return (content, s3_object["ETag"]) if with_etag else content
+
+
+def prefetch_json_objects(s3_client, bucket, keys, depth, skip_missing=False, with_etag=False):
+    """
+    Yield the parsed JSON objects of the given keys in order, while the next objects are downloaded
+    on a bounded thread pool. At most depth downloads are in flight or waiting to be consumed at any time.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket name
+    :param keys: <iterable> keys of the objects, in the order they should be yielded
+    :param depth: <int> number of objects downloaded ahead of the consumer
+    :param skip_missing: <bool> skip objects that no longer exist instead of raising
+    :param with_etag: <bool> also yield the ETag of each object
+    :return: <generator> (key, parsed content) tuples, or (key, parsed content, ETag) if with_etag
+    """
+    depth = max(1, depth)
+    keys = iter(keys)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=depth)
+
+    def submit_next():
+        key = next(keys, None)
+        if key is not None:
+            pending.append((key, executor.submit(read_json_object, s3_client, bucket, key, with_etag)))
+
+    try:
+        for _ in range(depth):
+            submit_next()
+        while pending:
+            key, future = pending.popleft()
+            submit_next()
+            try:
+                result = future.result()
+            except ClientError as e:
+                if not skip_missing or e.response["Error"]["Code"] != "NoSuchKey":
+                    raise
+                LOGGER.warning(f"{key} no longer exists, skipping it.")
+                continue
+            yield (key, *result) if with_etag else (key, result)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BatchDeleter:
+    """
+    Collects keys to delete during a run and removes them with delete_objects, up to 1000 keys per request.
+    Given an executor, full batches are deleted on it while the next keys are collected.
+    """
+
+    def __init__(self, s3_client, bucket, batch_size=MAX_KEYS_PER_DELETE, executor=None):
+        """
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param batch_size: <int> number of keys sent per delete_objects request
+        :param executor: <concurrent.futures.Executor> executor sending the delete requests, None to send them from
+        the calling thread
+        """
+        self._s3_client = s3_client
+        self._bucket = bucket
+        self._batch_size = min(batch_size, MAX_KEYS_PER_DELETE)
+        self._executor = executor
+        self._keys = []
+        # delete requests in flight on the executor
+        self._pending = []
+        self._lock = threading.Lock()
+        self.deleted_keys = []
+        self.failed_keys = []
+
+    def add(self, key):
+        """
+        Schedule a key for deletion; a full batch is sent right away
+
+        :param key: <string> key of the object to delete
+        """
+        self._keys.append(key)
+        if len(self._keys) >= self._batch_size:
+            self._send_batch()
+
+    def flush(self):
+        """
+        Delete all collected keys, and wait for the delete requests in flight
+        """
+        while self._keys:
+            self._send_batch()
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def _send_batch(self):
+        batch, self._keys = self._keys[: self._batch_size], self._keys[self._batch_size :]
+        if self._executor is None:
+            self._delete(batch)
+        else:
+            self._pending.append(self._executor.submit(self._delete, batch))
+
+    def _delete(self, batch):
+        response = self._s3_client.delete_objects(
+            Bucket=self._bucket, Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+        )
+        # in quiet mode only the keys that could not be deleted are reported
+        errors = response.get("Errors", [])
+        failed = {error["Key"] for error in errors}
+        for error in errors:
+            LOGGER.warning(f"Could not delete {error['Key']}: {error.get('Code')} {error.get('Message')}")
+        with self._lock:
+            self.failed_keys.extend(key for key in batch if key in failed)
+            self.deleted_keys.extend(key for key in batch if key not in failed)
@@ -0,0 +1,249 @@
+"""
+Runtime config of the scheduler, reloaded from S3 without a redeployment.
+The instance limits, the max number of scheduling tries, the bucket of the request tickets and the rules assigning an
+instance type to each image can be overridden by a JSON config object, so that new quota is used right away.
+The config is cached in memory across the warm invocations of a container, and checked for changes once
+constants.CONFIG_REFRESH_SECONDS have passed with a GET conditional on its ETag: an unchanged config costs a
+304 response and no download. The settings are applied onto the constants module, which the scheduler reads at call
+time; settings missing from the config keep the values of constants.py. A config that cannot be read or is invalid
+leaves the last good one in place, and is not downloaded again until it changes.
+The instance type rules carry a version, so that the tickets indexed under other rules get their instance type
+assigned again by the next run, rules reloaded from the config included.
+
+Config object, every field optional:
+    {
+        "TRAINING_LIMIT": {"ml.p3.8xlarge": 8},
+        "INFERENCE_LIMIT": {"ml.c4.4xlarge": 1},
+        "TOTAL_INSTANCE_TRAINING": 60,
+        "TOTAL_INSTANCE_INFERENCE": 2,
+        "MAX_SCHEDULING_RETRIES": 5,
+        "BUCKET_NAME": "dlc-test-tickets",
+        "INSTANCE_TYPE_RULES": [["(?=.*pytorch)(?=.*gpu)", "ml.p3.16xlarge"]]
+    }
+Limits are merged per instance type with those of constants.py; instance type rules are tried before the built-in
+ones, which still assign an instance type to any image.
+"""
+import copy
+import functools
+import hashlib
+import json
+import logging
+import re
+import time
+
+from botocore.exceptions import ClientError
+
+import constants
+
+
+LOGGER = logging.getLogger(__name__)
+
+# settings of the constants module the config can override
+CONFIGURABLE_SETTINGS = (
+    "TRAINING_LIMIT",
+    "INFERENCE_LIMIT",
+    "TOTAL_INSTANCE_TRAINING",
+    "TOTAL_INSTANCE_INFERENCE",
+    "MAX_SCHEDULING_RETRIES",
+    "BUCKET_NAME",
+    "INSTANCE_TYPE_RULES",
+)
+# error codes of a conditional GET whose object did not change
+NOT_MODIFIED_CODES = ("304", "NotModified")
+# number of images whose instance type is memoized by a matcher
+MATCHER_CACHE_SIZE = 1024
+# numbered backreference, renumbered once the rules are combined into one regular expression
+NUMBERED_BACKREFERENCE = re.compile(r"(?<!\\)(?:\\\\)*\\[1-9]")
+
+# values of constants.py, restored for the settings a config no longer overrides
+_DEFAULTS = {name: copy.deepcopy(getattr(constants, name)) for name in CONFIGURABLE_SETTINGS}
+
+
+class InstanceTypeMatcher:
+    """
+    Instance type rules compiled into a single regular expression. Each rule is a lookahead anchored at the start of
+    the image, so the alternation tries the rules in order and the first rule whose pattern is found wins, in one call
+    into the regex engine. Results are memoized, the images of a run repeat a lot.
+    The version of the matcher is a digest of its rules, the same rules always have the same version.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: <list> (regular expression searched in the ECR URI, instance type), the last one matching any
+        image
+        """
+        self._instance_types = [instance_type for _, instance_type in rules]
+        self.version = hashlib.sha1(json.dumps([list(rule) for rule in rules]).encode("utf-8")).hexdigest()[:12]
+        self._pattern = re.compile(
+            "|".join(f"(?P<rule{position}>(?=.*?(?:{pattern})))" for position, (pattern, _) in enumerate(rules)),
+            re.DOTALL,
+        )
+        self.match = functools.lru_cache(maxsize=MATCHER_CACHE_SIZE)(self._match)
+
+    def _match(self, image):
+        """
+        :param image: <string> ECR URI
+        :return: <string> instance type of the first rule matching the image
+        """
+        match = self._pattern.match(image)
+        if match is None:
+            raise ValueError(f"No instance type rule matches image {image}")
+        return self._instance_types[int(match.lastgroup[len("rule") :])]
+
+
+def _get_int(config, name, minimum):
+    value = config[name]
+    if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+        raise ValueError(f"{name} must be an integer of at least {minimum}, got {value!r}")
+    return value
+
+
+def _get_limits(config, name):
+    if not isinstance(config[name], dict):
+        raise ValueError(f"{name} must map instance types to limits, got {config[name]!r}")
+    limits = dict(_DEFAULTS[name])
+    for instance_type, limit in config[name].items():
+        limits[instance_type] = _get_int(config[name], instance_type, 0)
+    return limits
+
+
+def parse_config(config):
+    """
+    :param config: <dict> content of the config object
+    :return: <tuple> (setting name -> value of every configurable setting, InstanceTypeMatcher of the rules)
+    :raises ValueError: if a setting is invalid
+    """
+    if not isinstance(config, dict):
+        raise ValueError("The config must be a JSON object")
+    unknown_settings = set(config) - set(CONFIGURABLE_SETTINGS)
+    if unknown_settings:
+        raise ValueError(f"Unknown settings {sorted(unknown_settings)}")
+
+    settings = copy.deepcopy(_DEFAULTS)
+    for name in ("TRAINING_LIMIT", "INFERENCE_LIMIT"):
+        if name in config:
+            settings[name] = _get_limits(config, name)
+    for name in ("TOTAL_INSTANCE_TRAINING", "TOTAL_INSTANCE_INFERENCE"):
+        if name in config:
+            settings[name] = _get_int(config, name, 0)
+    if "MAX_SCHEDULING_RETRIES" in config:
+        settings["MAX_SCHEDULING_RETRIES"] = _get_int(config, "MAX_SCHEDULING_RETRIES", 1)
+    if "BUCKET_NAME" in config:
+        if not isinstance(config["BUCKET_NAME"], str) or not config["BUCKET_NAME"]:
+            raise ValueError(f"BUCKET_NAME must be a bucket name, got {config['BUCKET_NAME']!r}")
+        settings["BUCKET_NAME"] = config["BUCKET_NAME"]
+    if "INSTANCE_TYPE_RULES" in config:
+        rules = []
+        for rule in config["INSTANCE_TYPE_RULES"]:
+            if not isinstance(rule, list) or len(rule) != 2 or not all(isinstance(field, str) for field in rule):
+                raise ValueError(f"Instance type rules are [pattern, instance type] pairs, got {rule!r}")
+            try:
+                re.compile(rule[0])
+            except re.error as e:
+                raise ValueError(f"Invalid pattern {rule[0]!r} of an instance type rule: {e}")
+            if NUMBERED_BACKREFERENCE.search(rule[0]):
+                raise ValueError(f"Pattern {rule[0]!r} of an instance type rule uses a numbered backreference")
+            rules.append(tuple(rule))
+        settings["INSTANCE_TYPE_RULES"] = tuple(rules) + _DEFAULTS["INSTANCE_TYPE_RULES"]
+    # job types sharded per instance type rely on their total limit never being reached
+    for job_type in ("training", "inference"):
+        total_limit = settings[f"TOTAL_INSTANCE_{job_type.upper()}"]
+        limits_sum = sum(settings[f"{job_type.upper()}_LIMIT"].values())
+        if job_type not in constants.SINGLE_SHARD_JOB_TYPES and limits_sum > total_limit:
+            raise ValueError(
+                f"The {job_type} limits add up to {limits_sum}, above the total of {total_limit}; the job type must be "
+                f"in constants.SINGLE_SHARD_JOB_TYPES for its shards to share the total"
+            )
+    # a pattern valid on its own may not be once combined with the others, e.g. with inline global flags
+    try:
+        matcher = InstanceTypeMatcher(settings["INSTANCE_TYPE_RULES"])
+    except re.error as e:
+        raise ValueError(f"Instance type rules cannot be combined: {e}")
+    return settings, matcher
+
+
+_matcher = InstanceTypeMatcher(_DEFAULTS["INSTANCE_TYPE_RULES"])
+# ETag of the config applied, None while the defaults are in use
+_etag = None
+# ETag of the last config object downloaded, applied or rejected
+_downloaded_etag = None
+# monotonic time of the last check for changes
+_checked_at = None
+
+
+def _apply(settings, matcher, etag):
+    global _matcher, _etag
+    for name, value in settings.items():
+        setattr(constants, name, value)
+    _matcher = matcher
+    _etag = etag
+
+
+def refresh(s3_client, bucket=None, key=constants.SCHEDULER_CONFIG_KEY):
+    """
+    Check the config object for changes, unless the cached config is younger than constants.CONFIG_REFRESH_SECONDS
+
+    :param s3_client: boto3 S3 client
+    :param bucket: <string> bucket of the config, the bucket the function is deployed with by default
+    :param key: <string> key of the config object
+    :return: <bool> True if a changed config was applied
+    """
+    global _checked_at, _downloaded_etag
+    now = time.monotonic()
+    if _checked_at is not None and now - _checked_at < constants.CONFIG_REFRESH_SECONDS:
+        return False
+    _checked_at = now
+    bucket = bucket or _DEFAULTS["BUCKET_NAME"]
+
+    # a rejected config is not downloaded again until it changes
+    conditions = {"IfNoneMatch": _downloaded_etag} if _downloaded_etag is not None else {}
+    try:
+        config_object = s3_client.get_object(Bucket=bucket, Key=key, **conditions)
+    except ClientError as e:
+        error_code = e.response["Error"]["Code"]
+        if error_code in NOT_MODIFIED_CODES:
+            return False
+        if error_code != "NoSuchKey":
+            LOGGER.warning(f"Scheduler config {key} could not be read, keeping the current one: {e}")
+            return False
+        _downloaded_etag = None
+        if _etag is None:
+            return False
+        LOGGER.info(f"Scheduler config {key} was removed, back to the built-in settings.")
+        _apply(copy.deepcopy(_DEFAULTS), InstanceTypeMatcher(_DEFAULTS["INSTANCE_TYPE_RULES"]), None)
+        return True
+
+    _downloaded_etag = config_object["ETag"]
+    try:
+        settings, matcher = parse_config(json.loads(config_object["Body"].read().decode("utf-8")))
+    except ValueError as e:
+        LOGGER.warning(f"Scheduler config {key} is invalid, keeping the current one: {e}")
+        return False
+    _apply(settings, matcher, config_object["ETag"])
+    LOGGER.info(f"Scheduler config {key} applied: {json.dumps(settings, default=list)}")
+    return True
+
+
+def reset():
+    """
+    Restore the built-in settings and forget the cached config, e.g. between tests
+    """
+    global _checked_at, _downloaded_etag
+    _apply(copy.deepcopy(_DEFAULTS), InstanceTypeMatcher(_DEFAULTS["INSTANCE_TYPE_RULES"]), None)
+    _checked_at = None
+    _downloaded_etag = None
+
+
+def get_instance_type(image):
+    """
+    :param image: <string> ECR URI
+    :return: <string> instance type testing the image, from the first instance type rule matching it
+    """
+    return _matcher.match(image)
+
+
+def get_instance_type_rules_version():
+    """
+    :return: <string> version of the instance type rules in use
+    """
+    return _matcher.version
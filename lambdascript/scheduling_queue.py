@@ -0,0 +1,68 @@
+import heapq
+
+from datetime import datetime
+
+import constants
+
+
+def get_context_priority(build_context):
+    """
+    :param build_context: <string> CONTEXT of the request ticket, e.g. MAINLINE or PR
+    :return: <int> priority class of the context, 0 being the most urgent
+    """
+    return constants.CONTEXT_PRIORITY.get(build_context, constants.DEFAULT_CONTEXT_PRIORITY)
+
+
+class SchedulingQueue:
+    """
+    Priority queue of request tickets, backed by a binary heap.
+    Tickets are ordered by priority class, then by request time. The priority class of a ticket comes from its
+    CONTEXT and improves by one class for every aging_seconds the ticket has been waiting, so old low-priority
+    tickets are not starved by a steady stream of urgent ones.
+    The sort key of each ticket is computed once when it is pushed.
+    """
+
+    def __init__(self, now=None, aging_seconds=None):
+        """
+        :param now: <datetime> time the waiting time of the tickets is measured against, defaults to now
+        :param aging_seconds: <int> waiting time that promotes a ticket by one priority class
+        """
+        self._now = now or datetime.now()
+        self._aging_seconds = aging_seconds or constants.PRIORITY_AGING_SECONDS
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def sort_key(self, ticket_key, ticket_entry):
+        """
+        :param ticket_key: <string> key of the ticket
+        :param ticket_entry: <dict> index entry of the ticket, holding CONTEXT and TIMESTAMP
+        :return: <tuple> (effective priority class, request time, ticket key)
+        """
+        request_time = ticket_entry["TIMESTAMP"]
+        waiting_seconds = (self._now - datetime.strptime(request_time, constants.TIMESTAMP_FORMAT)).total_seconds()
+        priority = get_context_priority(ticket_entry.get("CONTEXT"))
+        effective_priority = max(0, priority - int(max(0, waiting_seconds) // self._aging_seconds))
+        # the timestamp format sorts chronologically as a string
+        return effective_priority, request_time, ticket_key
+
+    def push(self, ticket_key, ticket_entry):
+        """
+        :param ticket_key: <string> key of the ticket
+        :param ticket_entry: <dict> index entry of the ticket
+        """
+        heapq.heappush(self._heap, self.sort_key(ticket_key, ticket_entry))
+
+    def pop(self):
+        """
+        :return: <string> key of the most urgent ticket, removed from the queue
+        """
+        return heapq.heappop(self._heap)[-1]
+
+    def drain(self):
+        """
+        :return: <generator> keys of all tickets in scheduling order, removed from the queue as they are yielded
+        """
+        while self._heap:
+            yield self.pop()
@@ -0,0 +1,207 @@
+import json
+import logging
+import sys
+
+from datetime import datetime
+
+import clients
+import lambda_function
+
+from fakes import FakeClientProvider, FakeCodeBuildClient, FakeLambdaContext
+from lambda_function import lambda_handler
+
+"""
+How tests are executed:
+- place a single batch request ticket holding more test jobs than the limit of their instance type, and run the
+lambda handler against the fakes of S3 and CodeBuild. The desired behavior:
+    1. one Job Executor build is started and one pool entry created for each entry of the batch that fits.
+    2. the batch stays a single object on the queue, rewritten with the remaining entries only, their number of
+    tries add one.
+- place a second batch whose entries reached the max number of scheduling tries, with no capacity left, and run the
+lambda handler again. The desired behavior:
+    1. every entry of the second batch is moved to the dead letter queue with its own body, and the emptied batch is
+    removed from the queue.
+    2. the remaining entries of the first batch keep their retry state.
+- free the capacity and run the lambda handler again. The desired behavior:
+    1. the remaining entries are scheduled and the first batch is removed from the queue.
+- place an empty batch and a batch whose entries share an ENTRY_ID, and run the lambda handler again. The desired
+behavior:
+    1. the empty batch is removed from the queue.
+    2. the batch with duplicate ids is not indexed nor scheduled, and is left on the queue for its submitter.
+- place a batch with more entries than the capacity left, have its submitter append an entry to it after it is
+indexed and before it is rewritten, and run the lambda handler again. The desired behavior:
+    1. the dispatched entries are dropped from the version of the submitter, which keeps the appended entry.
+    2. once the capacity is freed, the remaining entries are scheduled, and the dispatched entries are not scheduled
+    again.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge-training"
+INSTANCES_LIMIT = 4
+IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04-example"
+)
+SQS_RETURN_QUEUE = "DUMMY_SQS_URL"
+TIMEOUT_LIMIT = 14400
+MAX_SCHEDULING_TRIES = 5
+BATCH_SIZE = 6
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+IN_PROGRESS_POOL_FOLDER = "resource_pool"
+DEAD_LETTER_QUEUE_FOLDER = "dead_letter_queue"
+TICKET_INDEX_KEY = "scheduler_state/ticket_index.json"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def place_batch(s3_client, name, num_of_entries, scheduling_tries=0, entry_id=None):
+    """
+    Put a batch request ticket on the request queue of the fake S3, one instance per entry
+
+    :param entry_id: <string> ENTRY_ID given to every entry, the entries are left without one if None
+    :return: <string> key of the batch ticket
+    """
+    request_time = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    batch_key = f"{REQUEST_TICKETS_FOLDER}/{name}_{request_time}.json"
+    content = [
+        {
+            "CONTEXT": "PR",
+            "TIMESTAMP": request_time,
+            "ECR-URI": IMAGE_URI,
+            "RETURN-SQS-URL": SQS_RETURN_QUEUE,
+            "SCHEDULING_TRIES": scheduling_tries,
+            "INSTANCES_NUM": 1,
+            "TIMEOUT_LIMIT": TIMEOUT_LIMIT,
+        }
+        for _ in range(num_of_entries)
+    ]
+    if entry_id is not None:
+        content = [dict(entry, ENTRY_ID=entry_id) for entry in content]
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=batch_key, Body=json.dumps(content).encode("UTF-8"))
+    return batch_key
+
+
+def read_json(s3_client, key):
+    return json.loads(s3_client.get_object(Bucket=BUCKET_NAME, Key=key)["Body"].read().decode("utf-8"))
+
+
+def get_dispatched_ticket_keys(cb_client):
+    """
+    :return: <list> TICKET_KEY of each build started, in order
+    """
+    ticket_keys = []
+    for build in cb_client.builds.values():
+        environment = {variable["name"]: variable["value"] for variable in build["environmentVariablesOverride"]}
+        ticket_keys.append(environment["TICKET_KEY"])
+    return ticket_keys
+
+
+def run_with_submitter_rewrite(s3_client, batch_key):
+    """
+    Run the lambda handler, the submitter appending an entry to the batch before the run rewrites it
+    """
+    rewrite_batches = lambda_function.rewrite_batches
+
+    def rewrite_batches_after_submitter(*args, **kwargs):
+        batch_body = read_json(s3_client, batch_key)
+        batch_body.append(dict(batch_body[-1]))
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=batch_key, Body=json.dumps(batch_body).encode("UTF-8"))
+        return rewrite_batches(*args, **kwargs)
+
+    lambda_function.rewrite_batches = rewrite_batches_after_submitter
+    try:
+        lambda_handler("dummy_event", FakeLambdaContext())
+    finally:
+        lambda_function.rewrite_batches = rewrite_batches
+
+
+def test():
+    cb_client = FakeCodeBuildClient()
+    provider = FakeClientProvider(codebuild=cb_client)
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        batch_key = place_batch(s3_client, "batch", BATCH_SIZE)
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        scheduled_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{INSTANCE_TYPE}/")
+        assert len(scheduled_keys) == len(cb_client.builds) == INSTANCES_LIMIT, f"Unexpected pool: {scheduled_keys}"
+        assert len(set(scheduled_keys)) == INSTANCES_LIMIT, "Entries of the batch share a pool entry."
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == [batch_key], "Batch not kept as one object."
+        remaining_entries = read_json(s3_client, batch_key)
+        assert len(remaining_entries) == BATCH_SIZE - INSTANCES_LIMIT, f"Batch not rewritten: {remaining_entries}"
+        for entry in remaining_entries:
+            assert entry["SCHEDULING_TRIES"] == 1, f"Scheduling tries not updated for entry {entry['ENTRY_ID']}"
+
+        # no capacity left, the entries of the second batch reached the max number of tries
+        dead_batch_key = place_batch(s3_client, "dead", 2, scheduling_tries=MAX_SCHEDULING_TRIES)
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == [batch_key], "Emptied batch not removed."
+        dead_letter_keys = s3_client.keys(BUCKET_NAME, f"{DEAD_LETTER_QUEUE_FOLDER}/")
+        assert len(dead_letter_keys) == 2, f"Entries not moved to the dead letter queue: {dead_letter_keys}"
+        for dead_letter_key in dead_letter_keys:
+            assert dead_letter_key.endswith("-maxRetries.json"), f"Wrong reason for {dead_letter_key}"
+            assert read_json(s3_client, dead_letter_key)["ECR-URI"] == IMAGE_URI, "Entry body not dead-lettered."
+        ticket_index = read_json(s3_client, TICKET_INDEX_KEY)
+        assert dead_batch_key not in ticket_index, "Emptied batch left in the ticket index."
+        for entry_key in ticket_index[batch_key]["BATCH_ENTRIES"]:
+            assert ticket_index[entry_key]["SCHEDULING_TRIES"] == 1, f"Retry state of {entry_key} lost."
+
+        # free the capacity
+        for scheduled_key in scheduled_keys:
+            s3_client.delete_object(Bucket=BUCKET_NAME, Key=scheduled_key)
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        assert len(cb_client.builds) == BATCH_SIZE, f"Remaining entries not scheduled: {len(cb_client.builds)} builds"
+        assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Dispatched batch left on the queue."
+
+        # an empty batch, and a batch whose entries share an id
+        place_batch(s3_client, "empty", 0)
+        duplicate_batch_key = place_batch(s3_client, "duplicate", 2, entry_id="job")
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == [
+            duplicate_batch_key
+        ], "Empty batch not removed, or batch with duplicate ids removed."
+        assert len(cb_client.builds) == BATCH_SIZE, "Batch with duplicate ids scheduled."
+        ticket_index = read_json(s3_client, TICKET_INDEX_KEY)
+        assert not ticket_index, f"Empty batch or batch with duplicate ids left in the ticket index: {ticket_index}"
+
+        # the submitter rewrites a batch between the index and the rewrite of the run
+        scheduled_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{INSTANCE_TYPE}/")
+        free_instances = INSTANCES_LIMIT - len(scheduled_keys)
+        rewritten_batch_key = place_batch(s3_client, "rewritten", free_instances + 1)
+        run_with_submitter_rewrite(s3_client, rewritten_batch_key)
+
+        dispatched_keys = get_dispatched_ticket_keys(cb_client)[BATCH_SIZE:]
+        assert len(dispatched_keys) == free_instances, f"Unexpected dispatches: {dispatched_keys}"
+        remaining_ids = [entry.get("ENTRY_ID") for entry in read_json(s3_client, rewritten_batch_key)]
+        expected_ids = [str(free_instances), str(free_instances + 1)]
+        assert remaining_ids == expected_ids, f"Dispatched entries left in the submitter version: {remaining_ids}"
+
+        for scheduled_key in s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{INSTANCE_TYPE}/"):
+            s3_client.delete_object(Bucket=BUCKET_NAME, Key=scheduled_key)
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        dispatched_keys = get_dispatched_ticket_keys(cb_client)[BATCH_SIZE:]
+        assert len(dispatched_keys) == len(set(dispatched_keys)), f"Entries scheduled twice: {dispatched_keys}"
+        assert len(dispatched_keys) == free_instances + 2, f"Remaining entries not scheduled: {dispatched_keys}"
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == [
+            duplicate_batch_key
+        ], "Dispatched batch left on the queue."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,118 @@
+import json
+import logging
+import sys
+
+import clients
+import constants
+import scheduler_config
+
+from fakes import FakeClientProvider, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+
+"""
+How tests are executed:
+- place as many request tickets as the limit of their instance type and run the lambda handler, then place more
+tickets and run it again, against the fakes of S3 and CodeBuild. The desired behavior:
+    1. the resource pool is full, and the new tickets stay on the queue.
+- send the CodeBuild state change events of a build still in progress, and of a succeeded and a failed build, to the
+lambda handler. The desired behavior:
+    1. the pool entries of the completed builds are deleted, the entries of the other builds are kept, even with the
+    instance type rules changed since the builds were started.
+- send the state change event of a Job Executor build started by hand. The desired behavior:
+    1. the event is ignored, no pool entry is deleted.
+- run the lambda handler again. The desired behavior:
+    1. the released capacity is used by the waiting tickets.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge-training"
+INSTANCES_LIMIT = 4
+IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04-example"
+)
+COMPLETED_BUILDS = 2
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+IN_PROGRESS_POOL_FOLDER = "resource_pool"
+CONFIG_KEY = "scheduler_state/config.json"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def create_state_change_event(cb_client, build_id, build_status):
+    """
+    :return: <dict> CodeBuild build state change event of the build, as delivered by EventBridge
+    """
+    environment_variables = [
+        {"name": name, "value": value, "type": "PLAINTEXT"}
+        for name, value in cb_client.build_environment(build_id).items()
+    ]
+    return {
+        "source": "aws.codebuild",
+        "detail-type": "CodeBuild Build State Change",
+        "detail": {
+            "build-status": build_status,
+            "project-name": "DLCTestJobExecutor",
+            "build-id": build_id,
+            "additional-information": {"environment": {"environment-variables": environment_variables}},
+        },
+    }
+
+
+def test():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    refresh_seconds = constants.CONFIG_REFRESH_SECONDS
+    constants.CONFIG_REFRESH_SECONDS = 0
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        place_tickets(s3_client, "completion", INSTANCES_LIMIT)
+        lambda_handler("dummy_event", FakeLambdaContext())
+        place_tickets(s3_client, "waiting", COMPLETED_BUILDS)
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        pool_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{INSTANCE_TYPE}/")
+        assert len(pool_keys) == len(cb_client.builds) == INSTANCES_LIMIT, f"Resource pool not full: {pool_keys}"
+
+        build_ids = sorted(cb_client.builds)
+        lambda_handler(create_state_change_event(cb_client, build_ids[0], "IN_PROGRESS"), FakeLambdaContext())
+        lambda_handler(create_state_change_event(cb_client, build_ids[0], "SUCCEEDED"), FakeLambdaContext())
+        # the image of the builds now gets another instance type
+        rules = {"INSTANCE_TYPE_RULES": [["example$", "ml.c4.4xlarge"]]}
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=CONFIG_KEY, Body=json.dumps(rules).encode("UTF-8"))
+        lambda_handler(create_state_change_event(cb_client, build_ids[1], "FAILED"), FakeLambdaContext())
+        s3_client.delete_object(Bucket=BUCKET_NAME, Key=CONFIG_KEY)
+
+        manual_build = create_state_change_event(cb_client, build_ids[2], "SUCCEEDED")
+        manual_build["detail"]["additional-information"]["environment"]["environment-variables"] = [
+            {"name": "DLC_IMAGE", "value": IMAGE_URI, "type": "PLAINTEXT"}
+        ]
+        lambda_handler(manual_build, FakeLambdaContext())
+
+        remaining_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{INSTANCE_TYPE}/")
+        assert len(remaining_keys) == INSTANCES_LIMIT - COMPLETED_BUILDS, f"Capacity not released: {remaining_keys}"
+        for build_id in build_ids[COMPLETED_BUILDS:]:
+            ticket_name = cb_client.build_environment(build_id)["TICKET_KEY"].split("/")[-1].split(".")[0]
+            assert any(ticket_name in key for key in remaining_keys), f"Entry of running build {build_id} released."
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(cb_client.builds) == INSTANCES_LIMIT + COMPLETED_BUILDS, "Released capacity not used."
+        assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Waiting tickets left on the queue."
+    finally:
+        constants.CONFIG_REFRESH_SECONDS = refresh_seconds
+        scheduler_config.reset()
+        clients.set_client_provider(previous_provider)
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
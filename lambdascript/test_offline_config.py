@@ -0,0 +1,172 @@
+import json
+import logging
+import sys
+
+import clients
+import constants
+import scheduler_config
+
+from fakes import FakeClientProvider, FakeLambdaContext, place_tickets
+from lambda_function import assign_sagemaker_instance_type, lambda_handler
+
+"""
+How tests are executed:
+- place more request tickets than the limit of their instance type and run the lambda handler against the fakes of S3
+and CodeBuild, without a config object. The desired behavior:
+    1. the limits of constants.py apply, only as many tickets as the limit are dispatched.
+- write a config object raising the limit of the instance type and run the lambda handler again. The desired behavior:
+    1. the new limit applies without a redeployment, and the remaining tickets are dispatched.
+- check the config again without changing it, then write an invalid config. The desired behavior:
+    1. an unchanged config is not downloaded again.
+    2. an invalid config is ignored, the last good one stays in place, including rules that only fail once combined
+    into one regular expression, and limits above the total of a job type sharded per instance type.
+    3. an invalid config is not downloaded again until it changes.
+- write a config with an instance type rule, then remove the config. The desired behavior:
+    1. the rule of the config wins over the built-in rules, which still cover the images it does not match.
+    2. once the config is removed, the built-in settings are back.
+- queue a ticket with no capacity left for its instance type, then write a config with an instance type rule matching
+its image, and run the lambda handler again. The desired behavior:
+    1. the ticket already queued gets the instance type of the new rule, and is dispatched on that instance type.
+- check the config again before its refresh period is over. The desired behavior:
+    1. the cached config is used, S3 is not called.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge"
+RULE_INSTANCE_TYPE = "ml.c4.4xlarge"
+NUM_OF_TICKETS = 6
+IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04-example"
+)
+OTHER_IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04"
+)
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+CONFIG_KEY = "scheduler_state/config.json"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def put_config(s3_client, config):
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=CONFIG_KEY, Body=json.dumps(config).encode("UTF-8"))
+
+
+def check_limits_reloaded(s3_client, cb_client):
+    default_limit = constants.TRAINING_LIMIT[INSTANCE_TYPE]
+    place_tickets(s3_client, "config", NUM_OF_TICKETS)
+    lambda_handler("dummy_event", FakeLambdaContext())
+    assert len(cb_client.builds) == default_limit, f"Default limit not applied: {len(cb_client.builds)} builds"
+
+    put_config(s3_client, {"TRAINING_LIMIT": {INSTANCE_TYPE: NUM_OF_TICKETS}})
+    lambda_handler("dummy_event", FakeLambdaContext())
+    assert constants.TRAINING_LIMIT[INSTANCE_TYPE] == NUM_OF_TICKETS, "Limit of the config not applied."
+    assert constants.TRAINING_LIMIT["ml.c4.8xlarge"] == 4, "Limits missing from the config not kept."
+    assert len(cb_client.builds) == NUM_OF_TICKETS, f"Raised limit not used: {len(cb_client.builds)} builds"
+
+
+def check_unchanged_and_invalid_config(s3_client):
+    get_calls = s3_client.api_calls["GetObject"]
+    assert not scheduler_config.refresh(s3_client), "Unchanged config applied again."
+    assert s3_client.api_calls["GetObject"] == get_calls + 1, "Config not checked for changes."
+
+    put_config(s3_client, {"TRAINING_LIMIT": {INSTANCE_TYPE: -1}})
+    assert not scheduler_config.refresh(s3_client), "Invalid config applied."
+    assert constants.TRAINING_LIMIT[INSTANCE_TYPE] == NUM_OF_TICKETS, "Last good config not kept."
+    parse_config = scheduler_config.parse_config
+    parsed_configs = []
+    scheduler_config.parse_config = lambda config: parsed_configs.append(config) or parse_config(config)
+    try:
+        assert not scheduler_config.refresh(s3_client), "Invalid config applied."
+    finally:
+        scheduler_config.parse_config = parse_config
+    assert not parsed_configs, "Unchanged invalid config downloaded again."
+
+    # the training shards are per instance type, their limits must fit in the total
+    put_config(s3_client, {"TRAINING_LIMIT": {INSTANCE_TYPE: constants.TOTAL_INSTANCE_TRAINING}})
+    assert not scheduler_config.refresh(s3_client), "Config with a binding total limit of a sharded job type applied."
+    assert constants.TRAINING_LIMIT[INSTANCE_TYPE] == NUM_OF_TICKETS, "Last good config not kept."
+
+    # patterns valid on their own, but not once the rules are combined
+    for pattern in ("(?i)pytorch", r"(a)\1"):
+        put_config(s3_client, {"INSTANCE_TYPE_RULES": [[pattern, RULE_INSTANCE_TYPE]]})
+        assert not scheduler_config.refresh(s3_client), f"Config with the pattern {pattern} applied."
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert assign_sagemaker_instance_type(IMAGE_URI) == INSTANCE_TYPE, "Last good rules not kept."
+
+
+def check_instance_type_rules(s3_client):
+    put_config(s3_client, {"INSTANCE_TYPE_RULES": [["example$", RULE_INSTANCE_TYPE]]})
+    assert scheduler_config.refresh(s3_client), "Config with an instance type rule not applied."
+    assert constants.TRAINING_LIMIT[INSTANCE_TYPE] == 4, "Limit of the previous config kept."
+    instance_type = assign_sagemaker_instance_type(IMAGE_URI)
+    assert instance_type == RULE_INSTANCE_TYPE, f"Rule of the config not applied: {instance_type}"
+    instance_type = assign_sagemaker_instance_type(OTHER_IMAGE_URI)
+    assert instance_type == INSTANCE_TYPE, f"Built-in rules not applied: {instance_type}"
+
+    s3_client.delete_object(Bucket=BUCKET_NAME, Key=CONFIG_KEY)
+    assert scheduler_config.refresh(s3_client), "Removed config not noticed."
+    instance_type = assign_sagemaker_instance_type(IMAGE_URI)
+    assert instance_type == INSTANCE_TYPE, f"Built-in rules not restored: {instance_type}"
+
+
+def check_queued_tickets_reassigned(s3_client, cb_client):
+    # no capacity left for the instance type of the built-in rules
+    put_config(s3_client, {"TRAINING_LIMIT": {INSTANCE_TYPE: 0}})
+    (ticket_key,) = place_tickets(s3_client, "reassigned", 1)
+    num_of_builds = len(cb_client.builds)
+    lambda_handler("dummy_event", FakeLambdaContext())
+    assert len(cb_client.builds) == num_of_builds, "Ticket dispatched without capacity left."
+    assert s3_client.keys(BUCKET_NAME, ticket_key) == [ticket_key], "Ticket not left on the queue."
+
+    rules = [["example$", RULE_INSTANCE_TYPE]]
+    put_config(s3_client, {"TRAINING_LIMIT": {INSTANCE_TYPE: 0}, "INSTANCE_TYPE_RULES": rules})
+    lambda_handler("dummy_event", FakeLambdaContext())
+    assert len(cb_client.builds) == num_of_builds + 1, "Queued ticket not dispatched with the new rule."
+    build = list(cb_client.builds.values())[-1]
+    environment = {variable["name"]: variable["value"] for variable in build["environmentVariablesOverride"]}
+    assert environment["TICKET_KEY"] == ticket_key, f"Wrong ticket dispatched: {environment['TICKET_KEY']}"
+    assert environment["INSTANCE_TYPE"] == RULE_INSTANCE_TYPE, f"Instance type not reassigned: {environment}"
+
+    s3_client.delete_object(Bucket=BUCKET_NAME, Key=CONFIG_KEY)
+    assert scheduler_config.refresh(s3_client), "Removed config not noticed."
+
+
+def check_cached_config(s3_client):
+    constants.CONFIG_REFRESH_SECONDS = 3600
+    scheduler_config.refresh(s3_client)
+    get_calls = s3_client.api_calls["GetObject"]
+    assert not scheduler_config.refresh(s3_client), "Cached config applied again."
+    assert s3_client.api_calls["GetObject"] == get_calls, "Config read before its refresh period was over."
+
+
+def test():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    refresh_seconds = constants.CONFIG_REFRESH_SECONDS
+    # check the config on every call, the test does not wait out the refresh period
+    constants.CONFIG_REFRESH_SECONDS = 0
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        check_limits_reloaded(s3_client, cb_client)
+        check_unchanged_and_invalid_config(s3_client)
+        check_instance_type_rules(s3_client)
+        check_queued_tickets_reassigned(s3_client, cb_client)
+        check_cached_config(s3_client)
+    finally:
+        constants.CONFIG_REFRESH_SECONDS = refresh_seconds
+        scheduler_config.reset()
+        clients.set_client_provider(previous_provider)
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
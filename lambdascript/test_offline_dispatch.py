@@ -0,0 +1,127 @@
+import json
+import logging
+import sys
+
+import clients
+import constants
+import metrics
+
+from fakes import FakeClientProvider, FakeCodeBuildClient, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+
+"""
+How tests are executed:
+- place as many request tickets on the queue as the limit of their instance type, with CodeBuild allowing a single
+running build, and run the lambda handler against the fakes of S3 and CodeBuild. The desired behavior:
+    1. one build is started and its ticket scheduled; once the account limit is reported, no start_build call is
+    made for each of the remaining tickets.
+    2. the remaining tickets stay on the queue, with number of tries add one in the ticket index.
+- place the same tickets with CodeBuild throttling the first start_build calls, and run the lambda handler again.
+The desired behavior:
+    1. the throttled calls are retried after backing off, and every ticket is scheduled.
+    2. each throttled call is counted once in the metrics of the run.
+- place the same tickets with CodeBuild failing the first start_build calls with an internal error, and run the lambda
+handler again. The desired behavior:
+    1. the failed calls are retried, and every ticket is scheduled.
+- place the same tickets with CodeBuild failing every start_build call, and run the lambda handler again. The desired
+behavior:
+    1. the run ends without raising, every ticket stays on the queue with number of tries add one in the ticket index.
+    2. no dispatch journal is left for recovery.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge-training"
+INSTANCES_LIMIT = 4
+THROTTLED_STARTS = 2
+FAILED_STARTS = 2
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+IN_PROGRESS_POOL_FOLDER = "resource_pool"
+TICKET_INDEX_KEY = "scheduler_state/ticket_index.json"
+DISPATCH_JOURNAL_FOLDER = "scheduler_state/dispatch"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def run_scheduler(cb_client, num_of_tickets):
+    """
+    Run the lambda handler once over a fresh queue
+
+    :return: <tuple> the fake S3 client and the keys of the tickets placed
+    """
+    provider = FakeClientProvider(codebuild=cb_client)
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        ticket_keys = list(place_tickets(s3_client, "dispatch", num_of_tickets))
+        lambda_handler("dummy_event", FakeLambdaContext())
+    finally:
+        clients.set_client_provider(previous_provider)
+    return s3_client, ticket_keys
+
+
+def test():
+    # the account allows a single running build
+    cb_client = FakeCodeBuildClient(max_running_builds=1)
+    s3_client, ticket_keys = run_scheduler(cb_client, INSTANCES_LIMIT)
+
+    scheduled_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{INSTANCE_TYPE}/")
+    assert len(scheduled_keys) == len(cb_client.builds) == 1, f"Exactly one build should start: {scheduled_keys}"
+    assert cb_client.api_calls["StartBuild"] < len(
+        ticket_keys
+    ), f"start_build called for every ticket despite the account limit: {cb_client.api_calls['StartBuild']} calls"
+
+    unscheduled_keys = s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/")
+    index_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=TICKET_INDEX_KEY)
+    ticket_index = json.loads(index_object["Body"].read().decode("utf-8"))
+    assert len(unscheduled_keys) == len(ticket_keys) - 1, "Tickets not started should stay on the queue."
+    for unscheduled_key in unscheduled_keys:
+        assert (
+            ticket_index[unscheduled_key]["SCHEDULING_TRIES"] == 1
+        ), f"Scheduling tries not updated for ticket {unscheduled_key}"
+
+    # CodeBuild throttles the first calls
+    cb_client = FakeCodeBuildClient(throttled_starts=THROTTLED_STARTS)
+    s3_client, ticket_keys = run_scheduler(cb_client, INSTANCES_LIMIT)
+
+    scheduled_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{INSTANCE_TYPE}/")
+    assert len(scheduled_keys) == len(cb_client.builds) == len(ticket_keys), "Throttled builds were not retried."
+    assert (
+        cb_client.api_calls["StartBuild"] == len(ticket_keys) + THROTTLED_STARTS
+    ), f"Unexpected number of start_build calls: {cb_client.api_calls['StartBuild']}"
+    assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Scheduled tickets left on the queue."
+    throttles = metrics.get_recorder().api_calls["codebuild.StartBuild"]["Throttles"]
+    assert throttles == THROTTLED_STARTS, f"Unexpected number of throttles recorded: {throttles}"
+
+    # CodeBuild fails the first calls with an internal error
+    cb_client = FakeCodeBuildClient(failed_starts=FAILED_STARTS)
+    s3_client, ticket_keys = run_scheduler(cb_client, INSTANCES_LIMIT)
+
+    assert len(cb_client.builds) == len(ticket_keys), "Builds failing transiently were not retried."
+    assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Scheduled tickets left on the queue."
+
+    # CodeBuild fails every call
+    cb_client = FakeCodeBuildClient(failed_starts=len(ticket_keys) * (constants.CODEBUILD_START_RETRIES + 1))
+    s3_client, ticket_keys = run_scheduler(cb_client, INSTANCES_LIMIT)
+
+    assert not cb_client.builds, f"Unexpected builds started: {list(cb_client.builds)}"
+    assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == sorted(ticket_keys), "Tickets left the queue."
+    index_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=TICKET_INDEX_KEY)
+    ticket_index = json.loads(index_object["Body"].read().decode("utf-8"))
+    for ticket_key in ticket_keys:
+        assert ticket_index[ticket_key]["SCHEDULING_TRIES"] == 1, f"Scheduling tries not updated for {ticket_key}"
+    journal_keys = s3_client.keys(BUCKET_NAME, f"{DISPATCH_JOURNAL_FOLDER}/")
+    assert not journal_keys, f"Dispatch journal left behind: {journal_keys}"
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
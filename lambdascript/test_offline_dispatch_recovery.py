@@ -0,0 +1,244 @@
+import json
+import logging
+import sys
+import time
+
+from datetime import timedelta
+
+from botocore.exceptions import ClientError
+
+import clients
+
+from dispatch_journal import get_dispatch_token
+from fakes import FakeClientProvider, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+from run_control import ShardLeases
+
+"""
+How tests are executed:
+- place request tickets and run the lambda handler against the fakes of S3 and CodeBuild, with the write of the
+first resource pool entry failing after its build was started. The desired behavior:
+    1. the run fails with the builds started and the tickets still queued, and its dispatch journal is left behind.
+- run the lambda handler again. The desired behavior:
+    1. the dispatches of the journal are completed: the pool entries are written and the tickets leave the queue.
+    2. no second build is started for any ticket, and the journal is deleted.
+- place a request ticket with the journal of a run killed before its build was started, and run the lambda handler.
+The desired behavior:
+    1. the dispatch is rolled back, and the ticket is dispatched again with a single build, under the same
+    idempotency token.
+- place request tickets and run the lambda handler with the deletes of the dispatched tickets failing, then again
+with the deletes of the recovery failing, past the idempotency window of the builds. The desired behavior:
+    1. the journals are kept while the dispatched tickets are still queued.
+    2. no second build is started for any ticket, and the tickets and journals are deleted once the deletes go
+    through.
+- place a p3 and a c4 request ticket with the journal of a killed run dispatching both, hold the lease of the p3
+shard under another owner, and run the lambda handler. The desired behavior:
+    1. only the dispatch of the c4 ticket is resolved, the journal is kept with the dispatch of the p3 ticket.
+- release the lease of the p3 shard and run the lambda handler again. The desired behavior:
+    1. the dispatch of the p3 ticket is resolved, and the journal is deleted.
+- place a journal that is deleted by a concurrent run right after it is listed, and run the lambda handler. The
+desired behavior:
+    1. the journal is skipped, and the run goes through.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge"
+JOB_TYPE = "training"
+CPU_INSTANCE_TYPE = "ml.c4.4xlarge"
+CPU_IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-cpu-py37-ubuntu18.04-example"
+)
+NUM_OF_TICKETS = 2
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+IN_PROGRESS_POOL_FOLDER = f"resource_pool/{INSTANCE_TYPE}-{JOB_TYPE}"
+DISPATCH_JOURNAL_FOLDER = "scheduler_state/dispatch"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def check_failed_run_completed():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        tickets = place_tickets(s3_client, "recovery", NUM_OF_TICKETS)
+
+        s3_client.failed_puts[f"{IN_PROGRESS_POOL_FOLDER}/"] = 1
+        try:
+            lambda_handler("dummy_event", FakeLambdaContext())
+            raise AssertionError("Failed write of a pool entry not raised.")
+        except ClientError as e:
+            assert e.response["Error"]["Code"] == "InternalError", f"Unexpected error: {e}"
+        assert len(cb_client.builds) == NUM_OF_TICKETS, f"Builds not started: {len(cb_client.builds)}"
+        assert s3_client.keys(BUCKET_NAME, f"{DISPATCH_JOURNAL_FOLDER}/"), "Journal of the failed run not left."
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(cb_client.builds) == NUM_OF_TICKETS, f"Tickets dispatched twice: {len(cb_client.builds)} builds"
+        pool_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/")
+        assert len(pool_keys) == len(tickets), f"Pool entries of the started builds not written: {pool_keys}"
+        assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Dispatched tickets left on the queue."
+        assert not s3_client.keys(BUCKET_NAME, f"{DISPATCH_JOURNAL_FOLDER}/"), "Resolved journal not deleted."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def check_killed_run_rolled_back():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        (ticket_key, ticket_body), = place_tickets(s3_client, "rollback", 1).items()
+        dispatch_token = get_dispatch_token(ticket_key, ticket_body)
+        dispatch = {
+            "TICKET_KEY": ticket_key,
+            "OBJECT_KEY": ticket_key,
+            "DISPATCH_TOKEN": dispatch_token,
+            "INSTANCE_TYPE": INSTANCE_TYPE,
+            "JOB_TYPE": JOB_TYPE,
+            "INSTANCES_NUM": 1,
+        }
+        # journal of a run killed right before start_build, its leases expired since
+        journal = {"CREATED": time.time() - 1, "EXPIRES": time.time() - 1, "DISPATCHES": [dispatch]}
+        s3_client.put_object(
+            Bucket=BUCKET_NAME, Key=f"{DISPATCH_JOURNAL_FOLDER}/killed-run.json", Body=json.dumps(journal).encode()
+        )
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(cb_client.builds) == 1, f"Rolled back ticket not dispatched once: {len(cb_client.builds)} builds"
+        (build,) = cb_client.builds.values()
+        assert build["idempotencyToken"] == dispatch_token, "Build not started with the token of the ticket."
+        assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Dispatched ticket left on the queue."
+        assert not s3_client.keys(BUCKET_NAME, f"{DISPATCH_JOURNAL_FOLDER}/"), "Journals not deleted."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def check_failed_deletes_kept_for_recovery():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        place_tickets(s3_client, "undeleted", NUM_OF_TICKETS)
+
+        for _ in range(2):
+            s3_client.failed_deletes[f"{REQUEST_TICKETS_FOLDER}/"] = 1
+            lambda_handler("dummy_event", FakeLambdaContext())
+            assert len(cb_client.builds) == NUM_OF_TICKETS, f"Tickets dispatched twice: {len(cb_client.builds)} builds"
+            assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Failed delete of a ticket not kept."
+            assert s3_client.keys(BUCKET_NAME, f"{DISPATCH_JOURNAL_FOLDER}/"), "Journal of an undeleted ticket lost."
+            # past the idempotency window, a second start_build would start a second build
+            for build_id in cb_client.start_times:
+                cb_client.start_times[build_id] -= timedelta(minutes=10)
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(cb_client.builds) == NUM_OF_TICKETS, f"Tickets dispatched twice: {len(cb_client.builds)} builds"
+        assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Dispatched tickets left on the queue."
+        assert not s3_client.keys(BUCKET_NAME, f"{DISPATCH_JOURNAL_FOLDER}/"), "Resolved journals not deleted."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def put_killed_run_journal(s3_client, name, tickets):
+    """
+    Put the journal of a run killed right before start_build, its leases expired since
+
+    :param tickets: <dict> key -> (body, instance type) of the tickets dispatched by the run
+    :return: <string> key of the journal
+    """
+    dispatches = [
+        {
+            "TICKET_KEY": ticket_key,
+            "OBJECT_KEY": ticket_key,
+            "DISPATCH_TOKEN": get_dispatch_token(ticket_key, ticket_body),
+            "INSTANCE_TYPE": instance_type,
+            "JOB_TYPE": JOB_TYPE,
+            "INSTANCES_NUM": 1,
+        }
+        for ticket_key, (ticket_body, instance_type) in tickets.items()
+    ]
+    journal = {"CREATED": time.time() - 1, "EXPIRES": time.time() - 1, "DISPATCHES": dispatches}
+    journal_key = f"{DISPATCH_JOURNAL_FOLDER}/{name}.json"
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=journal_key, Body=json.dumps(journal).encode())
+    return journal_key
+
+
+def read_journal(s3_client, journal_key):
+    return json.loads(s3_client.get_object(Bucket=BUCKET_NAME, Key=journal_key)["Body"].read().decode("utf-8"))
+
+
+def check_journal_resolved_by_shard():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        ((gpu_key, gpu_body),) = place_tickets(s3_client, "gpu", 1).items()
+        ((cpu_key, cpu_body),) = place_tickets(s3_client, "cpu", 1, image_uri=CPU_IMAGE_URI).items()
+        journal_key = put_killed_run_journal(
+            s3_client, "sharded-run", {gpu_key: (gpu_body, INSTANCE_TYPE), cpu_key: (cpu_body, CPU_INSTANCE_TYPE)}
+        )
+        other_run = ShardLeases(s3_client, BUCKET_NAME, "other-run")
+        assert other_run.acquire((INSTANCE_TYPE, JOB_TYPE), duration_seconds=60), "Free lease not acquired."
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == [gpu_key], "Ticket of a leased shard lost."
+        dispatches = read_journal(s3_client, journal_key)["DISPATCHES"]
+        assert [dispatch["TICKET_KEY"] for dispatch in dispatches] == [gpu_key], f"Unexpected dispatches: {dispatches}"
+
+        other_run.release_all()
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(cb_client.builds) == 2, f"Tickets not dispatched once each: {len(cb_client.builds)} builds"
+        assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Dispatched ticket left on the queue."
+        assert not s3_client.keys(BUCKET_NAME, f"{DISPATCH_JOURNAL_FOLDER}/"), "Resolved journal not deleted."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def check_journal_deleted_concurrently():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        ((ticket_key, ticket_body),) = place_tickets(s3_client, "concurrent", 1).items()
+        journal_key = put_killed_run_journal(s3_client, "resolved-run", {ticket_key: (ticket_body, INSTANCE_TYPE)})
+
+        # a concurrent run deletes the journal between the listing and the download
+        get_object = s3_client._get_object
+
+        def get_deleted_journal(Bucket, Key, **kwargs):
+            if Key == journal_key:
+                s3_client._delete_object(Bucket=Bucket, Key=Key)
+            return get_object(Bucket=Bucket, Key=Key, **kwargs)
+
+        s3_client._get_object = get_deleted_journal
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(cb_client.builds) == 1, f"Ticket not dispatched once: {len(cb_client.builds)} builds"
+        assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Dispatched ticket left on the queue."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def test():
+    check_failed_run_completed()
+    check_killed_run_rolled_back()
+    check_failed_deletes_kept_for_recovery()
+    check_journal_resolved_by_shard()
+    check_journal_deleted_concurrently()
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
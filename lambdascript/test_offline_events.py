@@ -0,0 +1,133 @@
+import json
+import logging
+import sys
+
+from urllib.parse import quote_plus
+
+import clients
+
+from fakes import FakeClientProvider, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+from ticket_events import get_created_tickets
+from ticket_index import TicketIndex
+
+"""
+How tests are executed:
+- build S3 ObjectCreated notifications of request tickets, delivered straight from S3, through SQS, SNS, SNS fanned
+out to SQS and EventBridge, with the keys URL-encoded as S3 does, along with notifications of other objects and events
+that are not S3 notifications. The desired behavior:
+    1. the created request tickets are extracted from every kind of event, with their decoded key and quoted ETag.
+    2. objects outside the request queue and removed objects are ignored, and other events are not taken for S3
+    notifications.
+- place two request tickets in the in-memory fake of S3, and send the lambda handler the notification of the creation
+of one of them, along with the notification of a ticket deleted since. The desired behavior:
+    1. the created ticket is dispatched and removed from the queue, without a pass over the whole queue: a ticket
+    placed earlier without a notification is left as is.
+    2. the deleted ticket is skipped: it is neither indexed nor dispatched, and the run completes.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+TICKET_KEY = "request_tickets/pr+build=1-0_2020-06-11-22-13-27.json"
+OTHER_TICKET_KEY = "request_tickets/nightly-0_2020-06-11-22-13-27.json"
+ETAG = "0123456789abcdef0123456789abcdef"
+DELETED_TICKET_KEY = "request_tickets/deleted-0_2020-06-11-22-13-27.json"
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def create_s3_record(key, etag=ETAG, event_name="ObjectCreated:Put"):
+    """
+    :return: <dict> record of an S3 notification, with the key URL-encoded as S3 does
+    """
+    return {
+        "eventSource": "aws:s3",
+        "eventName": event_name,
+        "s3": {"bucket": {"name": BUCKET_NAME}, "object": {"key": quote_plus(key), "eTag": etag}},
+    }
+
+
+def create_s3_notification(*records):
+    return {"Records": list(records)}
+
+
+def check_event_shapes():
+    notification = create_s3_notification(
+        create_s3_record(TICKET_KEY),
+        create_s3_record(OTHER_TICKET_KEY, etag=None),
+        create_s3_record("scheduler_state/ticket_index.json"),
+        create_s3_record(DELETED_TICKET_KEY, event_name="ObjectRemoved:Delete"),
+    )
+    expected_tickets = {TICKET_KEY: f'"{ETAG}"', OTHER_TICKET_KEY: None}
+    assert get_created_tickets(notification) == expected_tickets, "Tickets of an S3 notification not extracted."
+
+    sqs_event = {"Records": [{"eventSource": "aws:sqs", "body": json.dumps(notification)}]}
+    assert get_created_tickets(sqs_event) == expected_tickets, "Tickets of an SQS message not extracted."
+
+    sns_event = {"Records": [{"EventSource": "aws:sns", "Sns": {"Message": json.dumps(notification)}}]}
+    assert get_created_tickets(sns_event) == expected_tickets, "Tickets of an SNS message not extracted."
+
+    sns_envelope = {"Type": "Notification", "TopicArn": "DUMMY_TOPIC_ARN", "Message": json.dumps(notification)}
+    sns_sqs_event = {"Records": [{"eventSource": "aws:sqs", "body": json.dumps(sns_envelope)}]}
+    assert get_created_tickets(sns_sqs_event) == expected_tickets, "Tickets of an SNS message in SQS not extracted."
+
+    eventbridge_event = {
+        "source": "aws.s3",
+        "detail-type": "Object Created",
+        "detail": {"bucket": {"name": BUCKET_NAME}, "object": {"key": TICKET_KEY, "etag": ETAG}},
+    }
+    assert get_created_tickets(eventbridge_event) == {
+        TICKET_KEY: f'"{ETAG}"'
+    }, "Ticket of an EventBridge event not extracted."
+
+    # notifications of other objects are S3 notifications, but with no ticket to schedule
+    assert get_created_tickets(create_s3_notification(create_s3_record("resource_pool/README.txt"))) == {}
+    scheduled_event = {"source": "aws.events", "detail-type": "Scheduled Event", "detail": {}}
+    for event in ("dummy_event", scheduled_event, {}):
+        assert get_created_tickets(event) is None, f"Event taken for an S3 notification: {event}"
+
+
+def check_created_tickets_scheduled():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        (unannounced_key,) = place_tickets(s3_client, "unannounced", 1)
+        (ticket_key,) = place_tickets(s3_client, "pr+build=1", 1)
+        etag = s3_client.get_object(Bucket=BUCKET_NAME, Key=ticket_key)["ETag"].strip('"')
+        event = create_s3_notification(create_s3_record(ticket_key, etag), create_s3_record(DELETED_TICKET_KEY))
+
+        lambda_handler(event, FakeLambdaContext())
+
+        assert len(cb_client.builds) == 1, f"Created ticket not dispatched: {len(cb_client.builds)} builds"
+        (build,) = cb_client.builds.values()
+        environment = {variable["name"]: variable["value"] for variable in build["environmentVariablesOverride"]}
+        assert environment["TICKET_KEY"] == ticket_key, f"Wrong ticket dispatched: {environment['TICKET_KEY']}"
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == [
+            unannounced_key
+        ], "Dispatched ticket left on the queue, or other tickets handled."
+        index = TicketIndex.load(s3_client, BUCKET_NAME)
+        assert DELETED_TICKET_KEY not in index, "Deleted ticket indexed."
+        assert unannounced_key not in index, "Ticket without a notification indexed by an incremental run."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def test():
+    check_event_shapes()
+    check_created_tickets_scheduled()
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,182 @@
+import json
+import logging
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import clients
+import constants
+
+from fakes import TEST_IMAGE_URI, FakeClientProvider, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+from run_control import ResumeCursor, ShardLeases
+from ticket_index import TicketIndex
+
+"""
+How tests are executed:
+- hold the lease of the p3 training shard under another owner, place tickets for p3 and c4 training instances, and
+run the lambda handler against the fakes of S3 and CodeBuild. The desired behavior:
+    1. only the c4 tickets are scheduled; the p3 tickets are left untouched for the holder of their shard.
+- let the lease expire and run the lambda handler again. The desired behavior:
+    1. the expired lease is taken over and the p3 tickets are scheduled.
+- write the ticket index from two runs that loaded the same version of it. The desired behavior:
+    1. the second write detects the first one, and the index holds the changes of both runs.
+- save and clear the resume cursor from two runs that loaded the same version of it. The desired behavior:
+    1. a run completing its pass does not clear the cursor saved by the other run since it was loaded.
+    2. the second save detects the first one, and the cursor holds the tickets handled by both runs.
+- place more tickets than the limits of their instance types and run several lambda handlers at the same time, each
+leasing a single shard. The desired behavior:
+    1. no instance type is booked above its limit, and every ticket is either scheduled or still queued and indexed.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCES_LIMIT = 4
+GPU_IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04-example"
+)
+CPU_IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-cpu-py37-ubuntu18.04-example"
+)
+TIMEOUT_LIMIT = 14400
+CONCURRENT_RUNS = 4
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+IN_PROGRESS_POOL_FOLDER = "resource_pool"
+TICKET_INDEX_KEY = "scheduler_state/ticket_index.json"
+RESUME_CURSOR_KEY = "scheduler_state/cursor.json"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def read_index(s3_client):
+    return json.loads(s3_client.get_object(Bucket=BUCKET_NAME, Key=TICKET_INDEX_KEY)["Body"].read().decode("utf-8"))
+
+
+def check_shard_leases():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        other_run = ShardLeases(s3_client, BUCKET_NAME, "other-run")
+        assert other_run.acquire(("ml.p3.8xlarge", "training"), duration_seconds=2), "Free lease not acquired."
+        gpu_keys = list(place_tickets(s3_client, "gpu", 2, image_uri=GPU_IMAGE_URI))
+        cpu_keys = list(place_tickets(s3_client, "cpu", 2, image_uri=CPU_IMAGE_URI))
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert not s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/ml.p3.8xlarge-training/"), "Shard overrun."
+        assert len(s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/ml.c4.4xlarge-training/")) == len(cpu_keys)
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == sorted(gpu_keys), "Tickets lost."
+        ticket_index = read_index(s3_client)
+        for gpu_key in gpu_keys:
+            assert ticket_index[gpu_key]["SCHEDULING_TRIES"] == 0, f"Ticket {gpu_key} of a leased shard was tried."
+
+        # the lease of the other run expires without being released
+        time.sleep(2)
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(cb_client.builds) == len(gpu_keys) + len(cpu_keys), "Expired lease not taken over."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def check_index_merge():
+    provider = FakeClientProvider()
+    s3_client = provider.client("s3")
+    ticket = {
+        "CONTEXT": "PR",
+        "INSTANCES_NUM": 1,
+        "TIMESTAMP": "",
+        "SCHEDULING_TRIES": 0,
+        "TIMEOUT_LIMIT": 0,
+        "ECR-URI": TEST_IMAGE_URI,
+    }
+    seed = TicketIndex()
+    seed.add("request_tickets/a.json", ticket, '"a"', "ml.p3.8xlarge", "training")
+    seed.add("request_tickets/b.json", ticket, '"b"', "ml.p3.8xlarge", "training")
+    seed.save(s3_client, BUCKET_NAME)
+
+    first_run = TicketIndex.load(s3_client, BUCKET_NAME)
+    second_run = TicketIndex.load(s3_client, BUCKET_NAME)
+    first_run.update("request_tickets/a.json", SCHEDULING_TRIES=1)
+    first_run.save(s3_client, BUCKET_NAME)
+    second_run.remove("request_tickets/b.json")
+    second_run.add("request_tickets/c.json", ticket, '"c"', "ml.c4.4xlarge", "training")
+    second_run.save(s3_client, BUCKET_NAME)
+
+    ticket_index = read_index(s3_client)
+    assert sorted(ticket_index) == ["request_tickets/a.json", "request_tickets/c.json"], f"Bad merge: {ticket_index}"
+    assert ticket_index["request_tickets/a.json"]["SCHEDULING_TRIES"] == 1, "Changes of the first run overwritten."
+
+
+def check_cursor_merge():
+    provider = FakeClientProvider()
+    s3_client = provider.client("s3")
+    queued_keys = {"request_tickets/a.json", "request_tickets/b.json", "request_tickets/c.json"}
+    seed = ResumeCursor()
+    seed.mark_handled("request_tickets/a.json")
+    seed.save(s3_client, BUCKET_NAME, queued_keys)
+
+    first_run = ResumeCursor.load(s3_client, BUCKET_NAME)
+    second_run = ResumeCursor.load(s3_client, BUCKET_NAME)
+    third_run = ResumeCursor.load(s3_client, BUCKET_NAME)
+    first_run.mark_handled("request_tickets/b.json")
+    first_run.save(s3_client, BUCKET_NAME, queued_keys)
+    second_run.clear(s3_client, BUCKET_NAME)
+    assert s3_client.keys(BUCKET_NAME, RESUME_CURSOR_KEY), "Cursor saved by a concurrent run cleared."
+
+    third_run.mark_handled("request_tickets/c.json")
+    third_run.save(s3_client, BUCKET_NAME, queued_keys)
+    handled_keys = ResumeCursor.load(s3_client, BUCKET_NAME).handled_keys
+    assert handled_keys == queued_keys, f"Bad merge: {sorted(handled_keys)}"
+
+    ResumeCursor.load(s3_client, BUCKET_NAME).clear(s3_client, BUCKET_NAME)
+    assert not s3_client.keys(BUCKET_NAME, RESUME_CURSOR_KEY), "Cursor of a completed pass not cleared."
+
+
+def check_concurrent_runs():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    previous_max_shards = constants.MAX_SHARDS_PER_RUN
+    constants.MAX_SHARDS_PER_RUN = 1
+    try:
+        s3_client = provider.client("s3")
+        ticket_keys = list(place_tickets(s3_client, "gpu", INSTANCES_LIMIT + 2, image_uri=GPU_IMAGE_URI))
+        ticket_keys += list(place_tickets(s3_client, "cpu", INSTANCES_LIMIT + 2, image_uri=CPU_IMAGE_URI))
+
+        with ThreadPoolExecutor(max_workers=CONCURRENT_RUNS) as executor:
+            runs = [executor.submit(lambda_handler, "dummy_event", FakeLambdaContext()) for _ in range(CONCURRENT_RUNS)]
+            for run in runs:
+                run.result()
+
+        for instance_type in ("ml.p3.8xlarge", "ml.c4.4xlarge"):
+            pool_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{instance_type}-training/")
+            assert len(pool_keys) <= INSTANCES_LIMIT, f"{instance_type} booked above its limit: {pool_keys}"
+        unscheduled_keys = s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/")
+        assert len(provider.client("codebuild").builds) + len(unscheduled_keys) == len(ticket_keys), "Tickets lost."
+        ticket_index = read_index(s3_client)
+        for unscheduled_key in unscheduled_keys:
+            assert unscheduled_key in ticket_index, f"Index entry of {unscheduled_key} lost by a concurrent write."
+    finally:
+        constants.MAX_SHARDS_PER_RUN = previous_max_shards
+        clients.set_client_provider(previous_provider)
+
+
+def test():
+    check_shard_leases()
+    check_index_merge()
+    check_cursor_merge()
+    check_concurrent_runs()
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
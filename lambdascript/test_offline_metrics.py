@@ -0,0 +1,118 @@
+import io
+import json
+import logging
+import sys
+
+from contextlib import redirect_stdout
+
+import clients
+
+from fakes import FakeClientProvider, FakeCodeBuildClient, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+
+"""
+How tests are executed:
+- place more request tickets than the limit of their instance type in the in-memory fake of S3, and run the lambda
+handler against the fakes of S3 and CodeBuild with the first StartBuild call throttled, capturing what it prints to
+stdout. The desired behavior:
+    1. every line of Embedded Metric Format is a valid EMF document: each metric and dimension it declares is set at
+    its top level, in the namespace of the scheduler, with a unit CloudWatch knows.
+    2. the run summary counts the dispatched and requeued tickets, and all the AWS calls made.
+    3. each AWS operation reports its calls, latency and throttles, each phase its duration, and each resource class
+    its utilization, in their own dimension set.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge-training"
+INSTANCES_LIMIT = 4
+NUM_OF_TICKETS = 6
+METRICS_NAMESPACE = "DLCTestScheduler"
+UNITS = {"Count", "Milliseconds", "Percent"}
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def run_scheduler():
+    """
+    :return: <tuple> (EMF documents printed by the run, fake CodeBuild client)
+    """
+    cb_client = FakeCodeBuildClient(throttled_starts=1)
+    provider = FakeClientProvider(codebuild=cb_client)
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        place_tickets(provider.client("s3"), "metrics", NUM_OF_TICKETS)
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            lambda_handler("dummy_event", FakeLambdaContext())
+    finally:
+        clients.set_client_provider(previous_provider)
+    lines = [line for line in stdout.getvalue().splitlines() if line.startswith("{")]
+    documents = [json.loads(line) for line in lines]
+    return [document for document in documents if "_aws" in document], cb_client
+
+
+def check_emf_document(document):
+    """
+    :return: <tuple> names of the dimensions of the document, sorted
+    """
+    assert isinstance(document["_aws"]["Timestamp"], int), f"Timestamp not in milliseconds: {document}"
+    (directive,) = document["_aws"]["CloudWatchMetrics"]
+    assert directive["Namespace"] == METRICS_NAMESPACE, f"Wrong namespace: {directive['Namespace']}"
+    (dimensions,) = directive["Dimensions"]
+    for dimension in dimensions:
+        assert isinstance(document.get(dimension), str), f"Dimension {dimension} not set: {document}"
+    for metric in directive["Metrics"]:
+        assert metric["Unit"] in UNITS, f"Unknown unit {metric['Unit']} of {metric['Name']}"
+        assert isinstance(document.get(metric["Name"]), (int, float)), f"Metric {metric['Name']} not set: {document}"
+    return tuple(sorted(dimensions))
+
+
+def get_unit(document, name):
+    (directive,) = document["_aws"]["CloudWatchMetrics"]
+    return next(metric["Unit"] for metric in directive["Metrics"] if metric["Name"] == name)
+
+
+def test():
+    documents, cb_client = run_scheduler()
+    assert documents, "No EMF document printed to stdout."
+    documents_by_dimensions = {}
+    for document in documents:
+        documents_by_dimensions.setdefault(check_emf_document(document), []).append(document)
+        assert document["Function"] == "scheduler", f"Wrong function: {document['Function']}"
+
+    # check the run summary
+    (summary,) = documents_by_dimensions[("Function",)]
+    assert summary["TicketsDispatched"] == len(cb_client.builds) == INSTANCES_LIMIT, "Dispatched tickets not counted."
+    assert summary["TicketsRequeued"] == NUM_OF_TICKETS - INSTANCES_LIMIT, "Requeued tickets not counted."
+    operations = {document["Operation"]: document for document in documents_by_dimensions[("Function", "Operation")]}
+    assert summary["ApiCalls"] == sum(document["Calls"] for document in operations.values()), "AWS calls not summed."
+
+    # check the AWS calls, with the throttled StartBuild
+    start_build = operations["codebuild.StartBuild"]
+    assert start_build["Calls"] == len(cb_client.builds) + 1, f"StartBuild calls not counted: {start_build}"
+    assert start_build["Throttles"] == 1, f"Throttled StartBuild not counted: {start_build}"
+    assert get_unit(start_build, "Latency") == "Milliseconds", "Latency not in milliseconds."
+    assert get_unit(start_build, "Calls") == "Count", "Calls not counted."
+
+    # check the phases and the utilization of the resource classes
+    phases = {document["Phase"]: document for document in documents_by_dimensions[("Function", "Phase")]}
+    assert "Dispatch" in phases, f"Dispatch phase not timed: {sorted(phases)}"
+    assert get_unit(phases["Dispatch"], "PhaseDuration") == "Milliseconds", "Phase duration not in milliseconds."
+    resource_classes = {
+        document["ResourceClass"]: document for document in documents_by_dimensions[("Function", "ResourceClass")]
+    }
+    utilization = resource_classes[INSTANCE_TYPE]
+    assert utilization["InstancesInUse"] == utilization["InstanceLimit"] == INSTANCES_LIMIT, f"{utilization}"
+    assert utilization["Utilization"] == 100, f"Full resource class not fully utilized: {utilization}"
+    assert get_unit(utilization, "Utilization") == "Percent", "Utilization not in percent."
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
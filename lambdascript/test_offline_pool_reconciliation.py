@@ -0,0 +1,121 @@
+import json
+import logging
+import sys
+
+from datetime import datetime, timedelta, timezone
+
+import clients
+
+from fakes import FakeClientProvider, FakeLambdaContext, FakeSageMakerClient, place_tickets
+from lambda_function import lambda_handler
+
+"""
+How tests are executed:
+- fill the resource pool of an instance type up to its limit with fresh pool entries, with a single matching
+training job in SageMaker, and run the lambda handler against the fakes of S3, CodeBuild and SageMaker with request
+tickets waiting. The desired behavior:
+    1. no SageMaker call is made, entries within the grace period are trusted; no ticket is scheduled.
+- backdate all pool entries but one past the grace period, and run the lambda handler again. The desired behavior:
+    1. the oldest stale entries not accounted for by the training job are deleted, and the entry of the training job
+    and the fresh entry are kept.
+    2. the reclaimed capacity is used by the waiting tickets right away.
+- dispatch a request ticket with no SageMaker job for its build, backdate its pool entry past the grace period, and
+run the lambda handler while the build is in progress, then once it completed. The desired behavior:
+    1. the entry of the build in progress is kept, e.g. for a build setting up its first job.
+    2. the entry is reclaimed once the build is no longer in progress.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge"
+JOB_TYPE = "training"
+INSTANCES_LIMIT = 4
+RUNNING_JOBS = 1
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+IN_PROGRESS_POOL_FOLDER = f"resource_pool/{INSTANCE_TYPE}-{JOB_TYPE}"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def place_pool_entries(s3_client, num_of_entries):
+    """
+    Put running resource pool entries of one instance each in the fake S3
+
+    :return: <list> keys of the entries, oldest first once backdated
+    """
+    pool_keys = []
+    for i in range(num_of_entries):
+        pool_key = f"{IN_PROGRESS_POOL_FOLDER}/pool-{str(i)}#1-running.json"
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=pool_key, Body=json.dumps({"STATUS": "running"}).encode("UTF-8"))
+        pool_keys.append(pool_key)
+    return pool_keys
+
+
+def check_reclaimed_by_count():
+    sm_client = FakeSageMakerClient()
+    for i in range(RUNNING_JOBS):
+        sm_client.add_training_job(f"running-job-{str(i)}", INSTANCE_TYPE)
+    sm_client.add_training_job("completed-job", INSTANCE_TYPE, status="Completed")
+    provider = FakeClientProvider(sagemaker=sm_client)
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        pool_keys = place_pool_entries(s3_client, INSTANCES_LIMIT)
+        place_tickets(s3_client, "reconciliation", INSTANCES_LIMIT)
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert not sm_client.api_calls, f"SageMaker queried for fresh pool entries: {dict(sm_client.api_calls)}"
+        assert not cb_client.builds, "Tickets scheduled while the resource pool is full."
+
+        # all entries but the last one went stale, the oldest first
+        now = datetime.now(timezone.utc)
+        for i, pool_key in enumerate(pool_keys[:-1]):
+            s3_client.set_last_modified(BUCKET_NAME, pool_key, now - timedelta(hours=len(pool_keys) - i))
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        num_of_reclaimed = INSTANCES_LIMIT - 1 - RUNNING_JOBS
+        remaining_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/pool-")
+        assert remaining_keys == pool_keys[num_of_reclaimed:], f"Unexpected entries reclaimed: {remaining_keys}"
+        assert len(cb_client.builds) == num_of_reclaimed, f"Reclaimed capacity not used: {len(cb_client.builds)} builds"
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def check_build_in_progress_kept():
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        place_tickets(s3_client, "setup", 1)
+        lambda_handler("dummy_event", FakeLambdaContext())
+        (build_id,) = cb_client.builds
+        (pool_key,) = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/")
+
+        s3_client.set_last_modified(BUCKET_NAME, pool_key, datetime.now(timezone.utc) - timedelta(hours=1))
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert s3_client.keys(BUCKET_NAME, pool_key), "Entry of a build in progress reclaimed."
+
+        cb_client.finish_build(build_id)
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert not s3_client.keys(BUCKET_NAME, pool_key), "Entry of a completed build not reclaimed."
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def test():
+    check_reclaimed_by_count()
+    check_build_in_progress_kept()
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
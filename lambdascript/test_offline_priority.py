@@ -0,0 +1,111 @@
+import json
+import logging
+import sys
+
+from datetime import datetime, timedelta
+
+import clients
+import constants
+
+from fakes import FakeClientProvider, FakeCodeBuildClient, FakeLambdaContext
+from lambda_function import lambda_handler
+
+"""
+How tests are executed:
+- place a MAINLINE request ticket and a PR request ticket requested a little earlier, both requiring all the
+instances of the same instance type, and run the lambda handler against the fakes of S3 and CodeBuild. The desired
+behavior:
+    1. the MAINLINE ticket is dispatched first, its context has the higher priority.
+- place the same tickets, but with the PR ticket waiting for long enough to be promoted to the priority class of the
+MAINLINE ticket, and run the lambda handler. The desired behavior:
+    1. the aged PR ticket overtakes the newer MAINLINE ticket, and the MAINLINE ticket stays on the queue.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCES_LIMIT = 4
+IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04-example"
+)
+SQS_RETURN_QUEUE = "DUMMY_SQS_URL"
+TIMEOUT_LIMIT = 14400
+# a PR ticket needs two promotions to reach the priority class of MAINLINE
+SHORT_WAIT = timedelta(seconds=constants.PRIORITY_AGING_SECONDS // 2)
+LONG_WAIT = timedelta(seconds=constants.PRIORITY_AGING_SECONDS * 2 + 60)
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def place_ticket(s3_client, name, context, request_time):
+    """
+    Put a request ticket requiring all the instances of its instance type on the request queue of the fake S3
+
+    :param context: <string> CONTEXT of the ticket, e.g. MAINLINE or PR
+    :param request_time: <datetime> time the ticket was requested
+    :return: <string> key of the ticket
+    """
+    timestamp = request_time.strftime(constants.TIMESTAMP_FORMAT)
+    ticket_key = f"{REQUEST_TICKETS_FOLDER}/{name}-0_{timestamp}.json"
+    content = {
+        "CONTEXT": context,
+        "TIMESTAMP": timestamp,
+        "ECR-URI": IMAGE_URI,
+        "RETURN-SQS-URL": SQS_RETURN_QUEUE,
+        "SCHEDULING_TRIES": 0,
+        "INSTANCES_NUM": INSTANCES_LIMIT,
+        "TIMEOUT_LIMIT": TIMEOUT_LIMIT,
+    }
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=ticket_key, Body=json.dumps(content).encode("UTF-8"))
+    return ticket_key
+
+
+def run_scheduler(pr_wait):
+    """
+    Run the lambda handler on a MAINLINE ticket requested now and a PR ticket requested pr_wait earlier
+
+    :param pr_wait: <timedelta> time the PR ticket has been waiting
+    :return: <tuple> (key of the ticket dispatched, key of the ticket left on the queue)
+    """
+    cb_client = FakeCodeBuildClient()
+    provider = FakeClientProvider(codebuild=cb_client)
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        now = datetime.now()
+        place_ticket(s3_client, "mainline", "MAINLINE", now)
+        place_ticket(s3_client, "pr", "PR", now - pr_wait)
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        assert len(cb_client.builds) == 1, f"Expected a single dispatch: {len(cb_client.builds)} builds"
+        (build,) = cb_client.builds.values()
+        environment = {variable["name"]: variable["value"] for variable in build["environmentVariablesOverride"]}
+        (queued_key,) = s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/")
+        return environment["TICKET_KEY"], queued_key
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def test():
+    # check the context decides while the PR ticket has not waited long
+    dispatched_key, queued_key = run_scheduler(SHORT_WAIT)
+    assert "/mainline-" in dispatched_key, f"MAINLINE ticket not dispatched first: {dispatched_key}"
+    assert "/pr-" in queued_key, f"PR ticket not left on the queue: {queued_key}"
+
+    # check the aged PR ticket overtakes the newer MAINLINE ticket
+    dispatched_key, queued_key = run_scheduler(LONG_WAIT)
+    assert "/pr-" in dispatched_key, f"Aged PR ticket not dispatched first: {dispatched_key}"
+    assert "/mainline-" in queued_key, f"MAINLINE ticket not left on the queue: {queued_key}"
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,103 @@
+import logging
+import os
+import sys
+
+import clients
+import run_trace
+
+from fakes import FakeClientProvider, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+from replay import build_workload, load_traces_from_s3, parse_limits, simulate
+from test_offline_completion import create_state_change_event
+
+"""
+How tests are executed:
+- run the lambda handler against the fakes of S3 and CodeBuild without tracing turned on. The desired behavior:
+    1. no trace is written.
+- turn tracing on, place more request tickets than the limit of their instance type, run the lambda handler, send
+the state change events of completed builds, and run it again. The desired behavior:
+    1. every run writes its trace, and the traces hold every ticket with the dispatch and release of the builds.
+- replay the traces with the current limits, a lower limit and a limit of 0. The desired behavior:
+    1. with the current limits every ticket is dispatched, none is dead-lettered.
+    2. with a lower limit, tickets wait longer and the instance type is used more.
+    3. with no capacity at all, every ticket is dead-lettered once it runs out of scheduling tries.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge"
+JOB_TYPE = "training"
+INSTANCES_LIMIT = 4
+NUM_OF_TICKETS = 6
+BUILD_SECONDS = 600
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+TRACE_FOLDER = "scheduler_traces"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def record_traces():
+    """
+    :return: <list> content of the traces recorded by the runs
+    """
+    provider = FakeClientProvider()
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        cb_client = provider.client("codebuild")
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert not s3_client.keys(BUCKET_NAME, f"{TRACE_FOLDER}/"), "Trace written without tracing turned on."
+
+        os.environ[run_trace.TRACING_ENV_VARIABLE] = "1"
+        place_tickets(s3_client, "replay", NUM_OF_TICKETS)
+        lambda_handler("dummy_event", FakeLambdaContext())
+        for build_id in sorted(cb_client.builds)[: NUM_OF_TICKETS - INSTANCES_LIMIT]:
+            lambda_handler(create_state_change_event(cb_client, build_id, "SUCCEEDED"), FakeLambdaContext())
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert len(cb_client.builds) == NUM_OF_TICKETS, f"Tickets not dispatched: {len(cb_client.builds)} builds"
+
+        trace_keys = s3_client.keys(BUCKET_NAME, f"{TRACE_FOLDER}/")
+        assert len(trace_keys) == 2 + NUM_OF_TICKETS - INSTANCES_LIMIT, f"Runs not traced: {trace_keys}"
+        return load_traces_from_s3(s3_client, BUCKET_NAME, f"{TRACE_FOLDER}/")
+    finally:
+        os.environ.pop(run_trace.TRACING_ENV_VARIABLE, None)
+        clients.set_client_provider(previous_provider)
+
+
+def test():
+    traces = record_traces()
+    decisions = [decision for trace in traces for _, _, decision in trace["DECISIONS"]]
+    assert decisions.count(run_trace.DISPATCHED) == NUM_OF_TICKETS, f"Dispatches not traced: {decisions}"
+    assert decisions.count(run_trace.BLOCKED) == NUM_OF_TICKETS - INSTANCES_LIMIT, f"Blocks not traced: {decisions}"
+    assert decisions.count(run_trace.RELEASED) == NUM_OF_TICKETS - INSTANCES_LIMIT, f"Releases not traced: {decisions}"
+
+    workload = build_workload(traces)
+    assert len(workload) == NUM_OF_TICKETS, f"Tickets missing from the workload: {sorted(workload)}"
+    for ticket in workload.values():
+        ticket["BUILD_SECONDS"] = BUILD_SECONDS
+
+    current = simulate(workload, **parse_limits([f"{INSTANCE_TYPE}-{JOB_TYPE}={INSTANCES_LIMIT}"], []))
+    assert current["DISPATCHED"] == NUM_OF_TICKETS and current["DEAD_LETTER_RATE"] == 0, f"Bad replay: {current}"
+
+    lower = simulate(workload, **parse_limits([f"{INSTANCE_TYPE}-{JOB_TYPE}=1"], []))
+    assert lower["DISPATCHED"] == NUM_OF_TICKETS, f"Tickets lost with a lower limit: {lower}"
+    assert lower["WAIT_SECONDS"]["P90"] > current["WAIT_SECONDS"]["P90"], "Lower limit did not increase waits."
+    resource_class = f"{INSTANCE_TYPE}-{JOB_TYPE}"
+    lower_utilization = lower["UTILIZATION"][resource_class]["UTILIZATION"]
+    assert current["UTILIZATION"][resource_class]["UTILIZATION"] < lower_utilization <= 100, "Bad utilization."
+
+    no_capacity = simulate(workload, **parse_limits([f"{INSTANCE_TYPE}-{JOB_TYPE}=0"], []))
+    assert no_capacity["DEAD_LETTER_RATE"] == 100, f"Tickets not dead-lettered without capacity: {no_capacity}"
+    assert no_capacity["DEAD_LETTER_REASONS"] == {"maxRetries": NUM_OF_TICKETS}, f"Bad reasons: {no_capacity}"
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,130 @@
+import json
+import logging
+import sys
+
+import clients
+
+from capacity import CapacityLedger, get_pool_key
+from fakes import FakeClientProvider, FakeCodeBuildClient, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+from planner import plan_run
+from ticket_index import TicketIndex
+
+"""
+How tests are executed:
+- fill the resource pool of an instance type up to its limit, place request tickets for that instance type ahead of
+request tickets for another instance type with free capacity, and plan a run over them. The desired behavior:
+    1. the full instance type is marked saturated, its tickets are blocked, and the tickets of the other instance type
+    behind them are planned for dispatch.
+- place the same pool entries and tickets in the in-memory fake of S3, and run the lambda handler against the fakes
+of S3 and CodeBuild. The desired behavior:
+    1. no Job Executor build is started for the tickets of the full instance type, not even an attempt: they stay on
+    the queue with number of tries add one in the ticket index.
+    2. the tickets of the other instance type are dispatched.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCES_LIMIT = 4
+SATURATED_INSTANCE_TYPE = "ml.p3.8xlarge"
+FREE_INSTANCE_TYPE = "ml.c4.4xlarge"
+JOB_TYPE = "training"
+GPU_IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-gpu-py37-cu101-ubuntu18.04-example"
+)
+CPU_IMAGE_URI = (
+    "754106851545.dkr.ecr.us-west-2.amazonaws.com/pr-tensorflow-training:2.2.0-cpu-py37-ubuntu18.04-example"
+)
+NUM_OF_TICKETS = 2
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+TICKET_INDEX_KEY = "scheduler_state/ticket_index.json"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def get_full_pool_keys():
+    """
+    :return: <list> keys of pool entries using every instance of the saturated instance type
+    """
+    return [
+        get_pool_key(
+            f"{REQUEST_TICKETS_FOLDER}/running-{i}_2020-06-11-22-13-27.json",
+            SATURATED_INSTANCE_TYPE,
+            JOB_TYPE,
+            1,
+            "running",
+        )
+        for i in range(INSTANCES_LIMIT)
+    ]
+
+
+def check_saturated_class_planned():
+    s3_client = FakeClientProvider().client("s3")
+    # the tickets of the saturated instance type are requested first, they are ahead in the queue
+    saturated_tickets = place_tickets(s3_client, "blocked", NUM_OF_TICKETS, image_uri=GPU_IMAGE_URI)
+    free_tickets = place_tickets(s3_client, "waiting", NUM_OF_TICKETS, image_uri=CPU_IMAGE_URI)
+
+    index = TicketIndex()
+    for ticket_key, ticket_body in saturated_tickets.items():
+        index.add(ticket_key, ticket_body, '"etag"', SATURATED_INSTANCE_TYPE, JOB_TYPE)
+    for ticket_key, ticket_body in free_tickets.items():
+        index.add(ticket_key, ticket_body, '"etag"', FREE_INSTANCE_TYPE, JOB_TYPE)
+    ledger = CapacityLedger()
+    for pool_key in get_full_pool_keys():
+        ledger.add_pool_entry(pool_key)
+
+    plan = plan_run(list(saturated_tickets) + list(free_tickets), index, ledger)
+    assert plan.saturated_classes == {
+        (SATURATED_INSTANCE_TYPE, JOB_TYPE)
+    }, f"Wrong saturated classes: {plan.saturated_classes}"
+    assert plan.blocked == list(saturated_tickets), f"Tickets of the saturated class not blocked: {plan.blocked}"
+    assert plan.dispatch == list(free_tickets), f"Tickets of the free class starved: {plan.dispatch}"
+
+
+def check_saturated_class_not_dispatched():
+    cb_client = FakeCodeBuildClient()
+    provider = FakeClientProvider(codebuild=cb_client)
+    previous_provider = clients.set_client_provider(provider)
+    try:
+        s3_client = provider.client("s3")
+        for pool_key in get_full_pool_keys():
+            s3_client.put_object(Bucket=BUCKET_NAME, Key=pool_key, Body=json.dumps({"STATUS": "running"}))
+        saturated_keys = list(place_tickets(s3_client, "blocked", NUM_OF_TICKETS, image_uri=GPU_IMAGE_URI))
+        free_keys = list(place_tickets(s3_client, "waiting", NUM_OF_TICKETS, image_uri=CPU_IMAGE_URI))
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        assert cb_client.api_calls["StartBuild"] == NUM_OF_TICKETS, "StartBuild called for the saturated class."
+        dispatched_keys = set()
+        for build in cb_client.builds.values():
+            environment = {variable["name"]: variable["value"] for variable in build["environmentVariablesOverride"]}
+            dispatched_keys.add(environment["TICKET_KEY"])
+        assert dispatched_keys == set(free_keys), f"Tickets of the free class not dispatched: {dispatched_keys}"
+
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == sorted(
+            saturated_keys
+        ), "Tickets of the saturated class not left on the queue."
+        index_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=TICKET_INDEX_KEY)
+        ticket_index = json.loads(index_object["Body"].read().decode("utf-8"))
+        for ticket_key in saturated_keys:
+            assert ticket_index[ticket_key]["SCHEDULING_TRIES"] == 1, f"Scheduling tries not updated for {ticket_key}"
+    finally:
+        clients.set_client_provider(previous_provider)
+
+
+def test():
+    check_saturated_class_planned()
+    check_saturated_class_not_dispatched()
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
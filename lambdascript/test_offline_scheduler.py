@@ -0,0 +1,145 @@
+import json
+import logging
+import sys
+
+import clients
+import metrics
+
+from fakes import FakeClientProvider, FakeCodeBuildClient, FakeLambdaContext, place_tickets
+from lambda_function import lambda_handler
+from ticket_index import TicketIndex
+
+"""
+How tests are executed:
+- place request tickets in the in-memory fake of S3, requiring the same instance type, more than the limit of that
+instance type, and run the lambda handler against the fakes of S3 and CodeBuild. The desired behavior:
+    1. the in-progress pool is properly updated (showing "preparing" tickets), and jobs on the in-progress pool do not
+    exceed the limit for the instance type. Scheduled request tickets are removed from the queue, and one Job Executor
+    build is started for each of them.
+    2. the remaining tickets stay on the queue, with number of tries add one in the ticket index.
+    3. the metrics of the run count the dispatched and requeued tickets, and the AWS calls made.
+- run the lambda handler again right away, with no capacity freed. The desired behavior:
+    1. the remaining tickets are backing off and deferred: their number of tries is unchanged, and neither the tickets
+    nor the ticket index are written.
+- free the capacity and run the lambda handler again. The desired behavior:
+    1. the deferred tickets are scheduled without waiting for the end of their backoff.
+- place request tickets that reached the max number of scheduling tries, with no capacity left, and run the lambda
+handler again. The desired behavior:
+    1. the tickets are moved to the dead letter queue with the reason "maxRetries", and removed from the queue.
+- place a request ticket, run the lambda handler with no capacity left until its number of tries reaches the max in
+the ticket index, and run the lambda handler again. The desired behavior:
+    1. the dead letter ticket holds the number of tries of the ticket index, not the one of the request ticket.
+
+Note: no AWS account is needed, the test runs against the fakes in fakes.py.
+"""
+
+# Test parameters
+INSTANCE_TYPE = "ml.p3.8xlarge-training"
+INSTANCES_LIMIT = 4
+INSTANCES_NUM_PER_TICKET = 1
+MAX_SCHEDULING_TRIES = 5
+
+# S3 path to tickets
+BUCKET_NAME = "dlc-test-tickets"
+REQUEST_TICKETS_FOLDER = "request_tickets"
+IN_PROGRESS_POOL_FOLDER = "resource_pool"
+DEAD_LETTER_QUEUE_FOLDER = "dead_letter_queue"
+TICKET_INDEX_KEY = "scheduler_state/ticket_index.json"
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+
+def test():
+    provider = FakeClientProvider(codebuild=FakeCodeBuildClient())
+    previous_provider = clients.set_client_provider(provider)
+    s3_client = provider.client("s3")
+    cb_client = provider.client("codebuild")
+
+    try:
+        # place more requests on the queue than the quota
+        num_of_tickets = (INSTANCES_LIMIT // INSTANCES_NUM_PER_TICKET) * 2
+        ticket_keys = list(place_tickets(s3_client, "testing", num_of_tickets))
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        # check the in-progress pool is updated, within the limit of the instance type
+        scheduled_keys = s3_client.keys(BUCKET_NAME, f"{IN_PROGRESS_POOL_FOLDER}/{INSTANCE_TYPE}/")
+        assert (
+            len(scheduled_keys) * INSTANCES_NUM_PER_TICKET == INSTANCES_LIMIT
+        ), f"Instance limit not used exactly: {scheduled_keys}"
+        assert len(cb_client.builds) == len(scheduled_keys), "One Job Executor build must be started per scheduled job."
+
+        # check the number of tries for the tickets remain on the queue is updated to 1 in the ticket index
+        unscheduled_keys = s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/")
+        index_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=TICKET_INDEX_KEY)
+        ticket_index = json.loads(index_object["Body"].read().decode("utf-8"))
+        for unscheduled_key in unscheduled_keys:
+            assert (
+                ticket_index[unscheduled_key]["SCHEDULING_TRIES"] == 1
+            ), f"Scheduling tries not updated for ticket {unscheduled_key}"
+
+        # check the metrics of the run match what happened to the tickets
+        recorder = metrics.get_recorder()
+        assert recorder.counters["TicketsDispatched"] == len(scheduled_keys), "Dispatched tickets not counted."
+        assert recorder.counters["TicketsRequeued"] == len(unscheduled_keys), "Requeued tickets not counted."
+        assert recorder.api_calls["codebuild.StartBuild"]["Calls"] == len(cb_client.builds), "API calls not recorded."
+
+        # check that all request tickets are either scheduled or on the queue
+        assert len(scheduled_keys) + len(unscheduled_keys) == len(
+            ticket_keys
+        ), "Some request tickets are lost: neither scheduled or on the queue."
+
+        # tickets backing off are deferred while no capacity is freed, without any write
+        provider.reset_api_calls()
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/") == unscheduled_keys, "Deferred tickets lost."
+        assert metrics.get_recorder().counters["TicketsDeferred"] == len(unscheduled_keys), "Tickets not deferred."
+        assert not provider.api_calls()["s3 PutObject"], "Deferred tickets must not be written."
+
+        # freed capacity wakes the deferred tickets up early
+        for scheduled_key in scheduled_keys:
+            s3_client.delete_object(Bucket=BUCKET_NAME, Key=scheduled_key)
+        lambda_handler("dummy_event", FakeLambdaContext())
+        assert not s3_client.keys(BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"), "Deferred tickets not scheduled."
+
+        # no capacity is left, tickets at the max number of tries are moved to the dead letter queue
+        dead_letter_candidates = list(place_tickets(s3_client, "retries", 3, scheduling_tries=MAX_SCHEDULING_TRIES))
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+
+        dead_letter_keys = s3_client.keys(BUCKET_NAME, f"{DEAD_LETTER_QUEUE_FOLDER}/")
+        assert len(dead_letter_keys) == len(dead_letter_candidates), "Some tickets not moved to dead letter queue."
+        for dead_letter_key in dead_letter_keys:
+            assert dead_letter_key.endswith(
+                "-maxRetries.json"
+            ), f"Scheduling failure reason not correct set for ticket {dead_letter_key}."
+        assert not s3_client.keys(
+            BUCKET_NAME, f"{REQUEST_TICKETS_FOLDER}/"
+        ), "Some tickets not correctly removed from the queue."
+
+        # the retry state of a ticket is kept in the ticket index, and carried into its dead letter ticket
+        (retried_key,) = place_tickets(s3_client, "indexed", 1)
+        lambda_handler("dummy_event", FakeLambdaContext())
+        index = TicketIndex.load(s3_client, BUCKET_NAME)
+        index.update(retried_key, SCHEDULING_TRIES=MAX_SCHEDULING_TRIES, NEXT_ELIGIBLE="2000-01-01-00-00-00")
+        index.save(s3_client, BUCKET_NAME)
+
+        lambda_handler("dummy_event", FakeLambdaContext())
+        dead_letter_key = retried_key.replace(REQUEST_TICKETS_FOLDER, DEAD_LETTER_QUEUE_FOLDER, 1)
+        dead_letter_key = dead_letter_key.replace(".json", "-maxRetries.json")
+        dead_letter_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=dead_letter_key)
+        dead_letter_body = json.loads(dead_letter_object["Body"].read().decode("utf-8"))
+        assert (
+            dead_letter_body["SCHEDULING_TRIES"] == MAX_SCHEDULING_TRIES
+        ), f"Retry state of the ticket index not dead-lettered: {dead_letter_body}"
+    finally:
+        clients.set_client_provider(previous_provider)
+
+    LOGGER.info("Tests passed.")
+    return
+
+
+if __name__ == "__main__":
+    test()
@@ -14,7 +14,8 @@ from lambda_function import lambda_handler
 How tests are executed:
 - place request tickets on the S3 queue requiring the same instance type, which exceeds the limit of that instance
 - run the lambda handler, the desired behavior:
-    1. have some later request tickets remain on queue (insufficient SageMaker resources), with number of tries add one.
+    1. have some later request tickets remain on queue (insufficient SageMaker resources), with number of tries add one
+    in the ticket index.
     2. the in-progress pool is properly updated (showing "preparing" tickets), and jobs on the in-progress pool do not 
     exceed the total limit for the instance type. Scheduled request tickets correctly removed from the queue.
 - clean up the artifacts on S3. 
@@ -36,6 +37,7 @@ TIMEOUT_LIMIT = 14400
 BUCKET_NAME = "dlc-test-tickets"
 REQUEST_TICKETS_FOLDER = "request_tickets"
 IN_PROGRESS_POOL_FOLDER = "resource_pool"
+TICKET_INDEX_KEY = "scheduler_state/ticket_index.json"
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.StreamHandler(sys.stdout))
@@ -95,13 +97,15 @@ def test():
     # call the lambda scheduler
     lambda_handler("dummy_event", "dummy_context")
 
-    # check the number of tries for the tickets remain on the queue is updated to 1
+    # check the number of tries for the tickets remain on the queue is updated to 1 in the ticket index
     unscheduled_tickets = s3_client.list_objects(Bucket=BUCKET_NAME, Prefix=f"{REQUEST_TICKETS_FOLDER}/testing")
     unscheduled_keys = [ticket_record["Key"] for ticket_record in unscheduled_tickets["Contents"]]
+    index_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=TICKET_INDEX_KEY)
+    ticket_index = json.loads(index_object["Body"].read().decode("utf-8"))
     for unscheduled_key in unscheduled_keys:
-        ticket_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=unscheduled_key)
-        ticket_body = json.loads(ticket_object["Body"].read().decode("utf-8"))
-        assert ticket_body["SCHEDULING_TRIES"] == 1, f"Scheduling tries not updated for ticket {unscheduled_key}"
+        assert (
+            ticket_index[unscheduled_key]["SCHEDULING_TRIES"] == 1
+        ), f"Scheduling tries not updated for ticket {unscheduled_key}"
 
     # check the in-progress pool is updated
     scheduled_jobs = s3_client.list_objects(
@@ -0,0 +1,105 @@
+import json
+import logging
+
+from urllib.parse import unquote_plus
+
+import constants
+
+
+LOGGER = logging.getLogger(__name__)
+
+REQUEST_TICKETS_PREFIX = "request_tickets/"
+
+
+def _is_request_ticket(key):
+    return key.startswith(REQUEST_TICKETS_PREFIX) and key.endswith(".json")
+
+
+def _normalize_etag(etag):
+    # notifications carry the bare ETag, listings and GETs return it quoted
+    return f'"{etag.strip(chr(34))}"' if etag else None
+
+
+def _collect_s3_records(records, created_tickets):
+    for record in records:
+        event_source = record.get("eventSource")
+
+        # S3 notification delivered straight to the function, or through SNS/SQS
+        if event_source == "aws:s3" and record.get("eventName", "").startswith("ObjectCreated"):
+            s3_object = record["s3"]["object"]
+            key = unquote_plus(s3_object["key"])
+            if _is_request_ticket(key):
+                created_tickets[key] = _normalize_etag(s3_object.get("eTag"))
+
+        elif event_source == "aws:sqs":
+            _collect_notification(json.loads(record["body"]), created_tickets)
+
+        elif record.get("EventSource") == "aws:sns":
+            _collect_notification(json.loads(record["Sns"]["Message"]), created_tickets)
+
+
+def _collect_notification(notification, created_tickets):
+    if "Records" in notification:
+        _collect_s3_records(notification["Records"], created_tickets)
+
+    # SNS message delivered through SQS, e.g. an S3 notification fanned out by SNS to SQS queues
+    elif notification.get("Type") == "Notification" and "Message" in notification:
+        _collect_notification(json.loads(notification["Message"]), created_tickets)
+
+    # S3 notification delivered through EventBridge
+    elif notification.get("source") == "aws.s3" and notification.get("detail-type") == "Object Created":
+        s3_object = notification["detail"]["object"]
+        if _is_request_ticket(s3_object["key"]):
+            created_tickets[s3_object["key"]] = _normalize_etag(s3_object.get("etag"))
+
+
+def get_completed_builds(event):
+    """
+    Extract the Job Executor build that completed according to a CodeBuild build state change event,
+    delivered by EventBridge
+
+    :param event: Lambda event
+    :return: <list> environment variables (name -> value) of the completed builds, empty for builds not started by
+    the scheduler, or None if the event is not a CodeBuild state change of the Job Executor
+    """
+    if not isinstance(event, dict) or event.get("source") != "aws.codebuild":
+        return None
+    if event.get("detail-type") != "CodeBuild Build State Change":
+        return None
+    detail = event["detail"]
+    if detail.get("project-name") != constants.JOB_EXECUTOR_PROJECT_NAME:
+        return None
+
+    # the build is still running, its instances are still in use
+    if detail.get("build-status") == "IN_PROGRESS":
+        return []
+    environment = detail.get("additional-information", {}).get("environment", {})
+    environment = {variable["name"]: variable["value"] for variable in environment.get("environment-variables", [])}
+    missing = [name for name in ("TICKET_KEY", "NUM_INSTANCES") if name not in environment]
+    # builds started before the instance type and job type were passed to the build have them derived from the image
+    if not ("INSTANCE_TYPE" in environment and "JOB_TYPE" in environment) and "DLC_IMAGE" not in environment:
+        missing.append("INSTANCE_TYPE/JOB_TYPE or DLC_IMAGE")
+    if missing:
+        # e.g. a build started by hand, it booked no capacity
+        LOGGER.warning(f"Build {detail.get('build-id')} has no {', '.join(missing)}, no capacity to release.")
+        return []
+    return [environment]
+
+
+def get_created_tickets(event):
+    """
+    Extract the request tickets created according to an S3 ObjectCreated notification, or a batch of them.
+    Notifications may come straight from S3, or wrapped in SQS, SNS or EventBridge events.
+
+    :param event: Lambda event
+    :return: <dict> key -> ETag of the created tickets (ETag may be None), or None if the event is not an
+    S3 notification, e.g. the scheduled event of the periodic reconciliation pass
+    """
+    if not isinstance(event, dict):
+        return None
+    if "Records" not in event and event.get("source") != "aws.s3":
+        return None
+
+    created_tickets = {}
+    _collect_notification(event, created_tickets)
+    return created_tickets
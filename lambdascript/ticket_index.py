@@ -0,0 +1,296 @@
+import json
+import logging
+
+from botocore.exceptions import ClientError
+
+import constants
+
+from run_control import CONDITIONAL_WRITE_CONFLICTS
+
+
+LOGGER = logging.getLogger(__name__)
+
+# fields of the request ticket kept in the index, enough to take scheduling decisions without the ticket body, and
+# to assign the instance type again when the instance type rules change
+INDEXED_TICKET_FIELDS = ("CONTEXT", "INSTANCES_NUM", "TIMESTAMP", "SCHEDULING_TRIES", "TIMEOUT_LIMIT", "ECR-URI")
+
+
+class TicketIndex:
+    """
+    Compact index of the queued request tickets, stored as a single S3 object.
+    Each entry is keyed by the ticket key and holds the ETag of the ticket object it was built from, so entries
+    of tickets that were rewritten by their submitter are detected from the listing and rebuilt.
+    The index is the source of truth for the retry state of a ticket once the ticket has been indexed.
+    Each entry of a batch ticket is indexed as a ticket of its own, holding the key of its batch instead of an ETag;
+    the batch object has a record of its own with its ETag and the keys of its remaining entries.
+    Runs overlapping in time write the index with conditional writes: a run that lost against a concurrent write
+    merges the entries it changed into the latest index and tries again, so no run overwrites the changes of another.
+    """
+
+    def __init__(self, entries=None, etag=None):
+        """
+        :param entries: <dict> ticket key -> index entry
+        :param etag: <string> ETag of the index object the entries were read from, None if there is no index yet
+        """
+        self._entries = entries or {}
+        self._etag = etag
+        self._dirty = False
+        # keys of the entries added, updated or removed during the run
+        self._changed_keys = set()
+        # key of a batch ticket -> keys of its entries that left the queue during the run
+        self._changed_batches = {}
+
+    @classmethod
+    def load(cls, s3_client, bucket, key=constants.TICKET_INDEX_KEY):
+        """
+        Load the index from S3; a missing index is treated as empty
+
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param key: <string> key of the index object
+        :return: <TicketIndex>
+        """
+        try:
+            index_object = s3_client.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            LOGGER.warning(f"Ticket index {key} not found, all tickets will be indexed from their body.")
+            return cls()
+        return cls(json.loads(index_object["Body"].read().decode("utf-8")), etag=index_object["ETag"])
+
+    def save(self, s3_client, bucket, key=constants.TICKET_INDEX_KEY):
+        """
+        Write the index back to S3 if it changed during the run
+
+        :param s3_client: boto3 S3 client
+        :param bucket: <string> bucket name
+        :param key: <string> key of the index object
+        """
+        if not self._dirty:
+            return
+        for attempt in range(1, constants.STATE_WRITE_ATTEMPTS + 1):
+            conditions = {"IfMatch": self._etag} if self._etag is not None else {"IfNoneMatch": "*"}
+            try:
+                response = s3_client.put_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Body=json.dumps(self._entries, separators=(",", ":")).encode("UTF-8"),
+                    **conditions,
+                )
+            except ClientError as e:
+                conflict = e.response["Error"]["Code"] in CONDITIONAL_WRITE_CONFLICTS + ("NoSuchKey",)
+                if not conflict or attempt == constants.STATE_WRITE_ATTEMPTS:
+                    raise
+                LOGGER.warning("Ticket index written by a concurrent run, merging the changes of this run into it.")
+                self._merge(TicketIndex.load(s3_client, bucket, key))
+                continue
+            self._etag = response["ETag"]
+            self._dirty = False
+            self._changed_keys = set()
+            return
+
+    def _merge(self, latest):
+        """
+        Rebase the changes of the current run onto the latest index: entries changed by the current run are taken
+        from it, all others from the latest index. The remaining entries of each batch are those of both runs.
+
+        :param latest: <TicketIndex> index as written by a concurrent run
+        """
+        entries = dict(latest._entries)
+        for ticket_key in self._changed_keys:
+            if ticket_key in self._entries:
+                entries[ticket_key] = self._entries[ticket_key]
+            else:
+                entries.pop(ticket_key, None)
+
+        batch_entries = {}
+        for ticket_key, entry in entries.items():
+            if "BATCH_KEY" in entry:
+                batch_entries.setdefault(entry["BATCH_KEY"], []).append(ticket_key)
+        for ticket_key, entry in entries.items():
+            if "BATCH_ENTRIES" in entry:
+                entries[ticket_key] = dict(entry, BATCH_ENTRIES=batch_entries.get(ticket_key, []))
+
+        self._entries = entries
+        self._etag = latest._etag
+
+    def __contains__(self, ticket_key):
+        return ticket_key in self._entries
+
+    def __len__(self):
+        return sum(1 for entry in self._entries.values() if "BATCH_ENTRIES" not in entry)
+
+    def keys(self):
+        """
+        :return: <list> keys of the indexed tickets, batch entries included and batch records left out
+        """
+        return [ticket_key for ticket_key, entry in self._entries.items() if "BATCH_ENTRIES" not in entry]
+
+    def get_object_key(self, ticket_key):
+        """
+        :param ticket_key: <string> key of an indexed ticket
+        :return: <string> key of the S3 object holding the ticket: its batch for a batch entry, the ticket otherwise
+        """
+        return self._entries[ticket_key].get("BATCH_KEY", ticket_key)
+
+    def is_batch_entry(self, ticket_key):
+        """
+        :param ticket_key: <string> key of an indexed ticket
+        :return: <bool> True if the ticket is an entry of a batch ticket
+        """
+        return "BATCH_KEY" in self._entries[ticket_key]
+
+    def get_changed_batches(self):
+        """
+        :return: <list> keys of the batch tickets whose entries left the queue since they were last written, and of
+        the batch tickets without any entry left
+        """
+        empty_batches = [
+            ticket_key
+            for ticket_key, entry in self._entries.items()
+            if "BATCH_ENTRIES" in entry and not entry["BATCH_ENTRIES"]
+        ]
+        return sorted(set(self._changed_batches).union(empty_batches))
+
+    def get_removed_batch_entries(self, batch_key):
+        """
+        :param batch_key: <string> key of the batch ticket
+        :return: <set> keys of the entries of the batch that left the queue since it was last written
+        """
+        return set(self._changed_batches.get(batch_key, ()))
+
+    def get(self, ticket_key, etag=None):
+        """
+        :param ticket_key: <string> key of the ticket
+        :param etag: <string> current ETag of the ticket; entries built from another version of the ticket are ignored
+        :return: <dict> index entry of the ticket, or None
+        """
+        entry = self._entries.get(ticket_key)
+        if entry is None or (etag is not None and entry["ETAG"] != etag):
+            return None
+        return entry
+
+    def add(self, ticket_key, ticket_body, etag, instance_type, job_type, rules_version=None):
+        """
+        Index a ticket from its body
+
+        :param ticket_key: <string> key of the ticket
+        :param ticket_body: <dict> body of the ticket
+        :param etag: <string> ETag of the ticket object the body was read from
+        :param instance_type: <string> instance type required by the ticket
+        :param job_type: <string> (training/inference)
+        :param rules_version: <string> version of the instance type rules the instance type was assigned with
+        :return: <dict> the new index entry
+        """
+        entry = {field: ticket_body[field] for field in INDEXED_TICKET_FIELDS}
+        entry.update(
+            {"ETAG": etag, "INSTANCE_TYPE": instance_type, "JOB_TYPE": job_type, "RULES_VERSION": rules_version}
+        )
+        self._entries[ticket_key] = entry
+        self._changed_keys.add(ticket_key)
+        self._dirty = True
+        return entry
+
+    def add_batch(self, batch_key, etag, entries, rules_version=None):
+        """
+        Index a batch ticket from its entries, in place of any earlier version of the batch
+
+        :param batch_key: <string> key of the batch ticket
+        :param etag: <string> ETag of the batch object the entries were read from
+        :param entries: <list> (entry key, entry body, instance type, job type) of each entry
+        :param rules_version: <string> version of the instance type rules the instance types were assigned with
+        """
+        self.remove(batch_key)
+        for entry_key, entry_body, instance_type, job_type in entries:
+            entry = {field: entry_body[field] for field in INDEXED_TICKET_FIELDS}
+            entry.update(
+                {
+                    "BATCH_KEY": batch_key,
+                    "ENTRY_ID": entry_body["ENTRY_ID"],
+                    "INSTANCE_TYPE": instance_type,
+                    "JOB_TYPE": job_type,
+                    "RULES_VERSION": rules_version,
+                }
+            )
+            self._entries[entry_key] = entry
+            self._changed_keys.add(entry_key)
+        self._entries[batch_key] = {"ETAG": etag, "BATCH_ENTRIES": [entry_key for entry_key, _, _, _ in entries]}
+        self._changed_keys.add(batch_key)
+        self._changed_batches.pop(batch_key, None)
+        self._dirty = True
+
+    def batch_written(self, batch_key, etag):
+        """
+        Record the new version of a batch ticket rewritten with its remaining entries
+
+        :param batch_key: <string> key of the batch ticket
+        :param etag: <string> ETag of the rewritten batch object
+        """
+        self._entries[batch_key]["ETAG"] = etag
+        self._changed_keys.add(batch_key)
+        self._changed_batches.pop(batch_key, None)
+        self._dirty = True
+
+    def reassign_instance_types(self, rules_version, get_instance_type):
+        """
+        Assign the instance type of the tickets indexed under other instance type rules again
+
+        :param rules_version: <string> version of the instance type rules in use
+        :param get_instance_type: <function> instance type of an ECR URI under the rules in use
+        :return: <list> keys of the tickets whose instance type changed
+        """
+        reassigned_keys = []
+        for ticket_key, entry in self._entries.items():
+            if "INSTANCE_TYPE" not in entry or entry["RULES_VERSION"] == rules_version:
+                continue
+            instance_type = get_instance_type(entry["ECR-URI"])
+            if instance_type != entry["INSTANCE_TYPE"]:
+                reassigned_keys.append(ticket_key)
+            entry.update({"INSTANCE_TYPE": instance_type, "RULES_VERSION": rules_version})
+            self._changed_keys.add(ticket_key)
+            self._dirty = True
+        return reassigned_keys
+
+    def update(self, ticket_key, **fields):
+        """
+        Update fields of an index entry, e.g. SCHEDULING_TRIES
+
+        :param ticket_key: <string> key of the ticket
+        """
+        self._entries[ticket_key].update(fields)
+        self._changed_keys.add(ticket_key)
+        self._dirty = True
+
+    def remove(self, ticket_key):
+        """
+        Drop the entry of a ticket that left the queue.
+        The entry of a batch entry is also dropped from its batch, and the entries of a batch ticket go with it.
+
+        :param ticket_key: <string> key of the ticket
+        """
+        entry = self._entries.pop(ticket_key, None)
+        if entry is None:
+            return
+        self._changed_keys.add(ticket_key)
+        self._dirty = True
+        if "BATCH_KEY" in entry and entry["BATCH_KEY"] in self._entries:
+            self._entries[entry["BATCH_KEY"]]["BATCH_ENTRIES"].remove(ticket_key)
+            self._changed_keys.add(entry["BATCH_KEY"])
+            self._changed_batches.setdefault(entry["BATCH_KEY"], set()).add(ticket_key)
+        for entry_key in entry.get("BATCH_ENTRIES", []):
+            self._entries.pop(entry_key, None)
+            self._changed_keys.add(entry_key)
+        self._changed_batches.pop(ticket_key, None)
+
+    def prune(self, queued_keys):
+        """
+        Drop the entries of tickets that are no longer queued
+
+        :param queued_keys: <container> keys of the ticket objects currently in the queue
+        """
+        for ticket_key in [ticket_key for ticket_key in self._entries if ticket_key not in queued_keys]:
+            # entries of batches are dropped along with their batch
+            entry = self._entries.get(ticket_key)
+            if entry is not None and entry.get("BATCH_KEY") not in self._entries:
+                self.remove(ticket_key)